@@ -4,7 +4,11 @@
 "Electronic Mail"
 
 from electronic_mail import ElectronicMail, Mailbox, MailboxParent, \
-        ReadUser, WriteUser, Header
+        MailboxClosure, ReadUser, WriteUser, Pack, Content, Attachment, \
+        Address, HeaderLine, Header
+from conversation import Thread, ThreadMessage
+from importer import MailboxImport, ImportMailboxStart, ImportMailboxDone, \
+        ImportMailbox
 
 from trytond.pool import Pool
 
@@ -13,9 +17,24 @@ def register():
     Pool.register(
         Mailbox,
         MailboxParent,
+        MailboxClosure,
         ReadUser,
         WriteUser,
         ElectronicMail,
+        Pack,
+        Content,
+        Attachment,
+        Address,
+        HeaderLine,
         Header,
+        Thread,
+        ThreadMessage,
+        MailboxImport,
+        ImportMailboxStart,
+        ImportMailboxDone,
         module='electronic_mail', type_='model',
     )
+    Pool.register(
+        ImportMailbox,
+        module='electronic_mail', type_='wizard',
+    )
@@ -0,0 +1,458 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+"Conversation Threads"
+
+import re
+import logging
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids
+from trytond.pool import Pool
+
+
+__all__ = ['Thread', 'ThreadMessage', 'message_ids']
+
+MESSAGE_ID = re.compile(r'<[^<>\s]+>')
+
+
+def message_ids(value):
+    """
+    Returns the list of the message IDs found in the value of a
+    Message-ID, In-Reply-To or References header
+    """
+    if not value:
+        return []
+    found = MESSAGE_ID.findall(value)
+    if not found and value.strip():
+        found = [value.strip()]
+    return found
+
+
+def thread_key(date, mail_id):
+    "Returns the sortable key of a mail among its siblings"
+    # The date is formatted by hand as strftime rejects the old years
+    return '%s%010d' % (date and '%04d%02d%02d%02d%02d%02d'
+        % date.timetuple()[:6] or '0' * 14, mail_id)
+
+
+class Thread(ModelSQL, ModelView):
+    "E-mail Thread"
+    __name__ = 'electronic_mail.thread'
+
+    subject = fields.Function(fields.Char('Subject',
+            help='Subject of the root of the mails the user reads'),
+        'get_root', searcher='search_subject')
+    root = fields.Function(fields.Many2One('electronic_mail', 'Root',
+            help='First mail of the thread the user reads'),
+        'get_root')
+    date = fields.DateTime('Date', readonly=True, select=1,
+        help='Date of the last mail of the thread')
+    mails = fields.One2Many('electronic_mail', 'thread', 'Mails',
+        readonly=True, order=[('thread_path', 'ASC')])
+    message_ids = fields.One2Many('electronic_mail.thread.message', 'thread',
+        'Message IDs', readonly=True)
+    mailbox_read_access = fields.Function(
+        fields.One2Many('res.user', None, 'Read Access Users',
+            help='Users reading a mail of the thread'),
+        'get_mailbox_read_access', searcher='search_mailbox_read_access')
+
+    @classmethod
+    def __setup__(cls):
+        super(Thread, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+
+    @classmethod
+    def get_root(cls, threads, names):
+        """
+        Returns the first mail in tree order of the threads and its subject
+        among the mails the user reads, the threads gathering the mails of
+        several mailboxes do not disclose the others
+        """
+        Mail = Pool().get('electronic_mail')
+        cursor = Transaction().cursor
+        thread_ids = [t.id for t in threads]
+        roots = {}
+        for i in range(0, len(thread_ids), cursor.IN_MAX):
+            sub_ids = thread_ids[i:i + cursor.IN_MAX]
+            query, args = Mail.search([
+                    ('thread', 'in', sub_ids),
+                    ], order=[], query_string=True)
+            cursor.execute('SELECT MIN(thread_path) '
+                'FROM "' + Mail._table + '" '
+                'WHERE id IN (' + query + ') GROUP BY thread', args)
+            paths = [r[0] for r in cursor.fetchall()]
+            if not paths:
+                continue
+            red_sql, red_ids = reduce_ids('thread', sub_ids)
+            cursor.execute('SELECT thread, id, subject '
+                'FROM "' + Mail._table + '" '
+                'WHERE ' + red_sql + ' AND thread_path IN ('
+                    + ','.join(('%s',) * len(paths)) + ')', red_ids + paths)
+            for thread_id, mail_id, subject in cursor.fetchall():
+                roots[thread_id] = (mail_id, subject)
+        result = {}
+        for name in names:
+            index = name == 'subject' and 1 or 0
+            result[name] = dict((i, roots.get(i, (None, None))[index])
+                for i in thread_ids)
+        return result
+
+    @classmethod
+    def search_subject(cls, name, clause):
+        return [('mails.subject',) + clause[1:]]
+
+    @classmethod
+    def get_mailbox_read_access(cls, threads, name):
+        Mail = Pool().get('electronic_mail')
+        cursor = Transaction().cursor
+        thread_ids = [t.id for t in threads]
+        users = {}
+        for i in range(0, len(thread_ids), cursor.IN_MAX):
+            sub_ids = thread_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('thread', sub_ids)
+            query, args = Mail._mailbox_users_query(name,
+                'mailbox IN (SELECT mailbox FROM "' + Mail._table + '" '
+                    'WHERE ' + red_sql + ')', red_ids)
+            red_sql, red_ids = reduce_ids('m.thread', sub_ids)
+            cursor.execute('SELECT DISTINCT m.thread, a."user" '
+                'FROM "' + Mail._table + '" AS m '
+                    'JOIN (' + query + ') AS a ON a.mailbox = m.mailbox '
+                'WHERE ' + red_sql, args + red_ids)
+            for thread_id, user_id in cursor.fetchall():
+                users.setdefault(thread_id, []).append(user_id)
+        return dict((i, users.get(i, [])) for i in thread_ids)
+
+    @classmethod
+    def search_mailbox_read_access(cls, name, clause):
+        Mail = Pool().get('electronic_mail')
+        user_ids = Mail._user_ids(clause)
+        if user_ids is None:
+            return [('mails.mailbox_read_access',) + clause[1:]]
+        # The access rules use this clause so it is compiled into a single
+        # sub-query on the mails as the one of the mails
+        red_sql, red_ids = reduce_ids('"user"', user_ids)
+        query, args = Mail._mailbox_users_query(name, red_sql, red_ids)
+        return [('id', 'inselect', ('SELECT thread '
+                    'FROM "' + Mail._table + '" '
+                    'WHERE mailbox IN (SELECT mailbox FROM (' + query + ') '
+                        'AS a)', args))]
+
+    @classmethod
+    def _get_references(cls, mail_ids):
+        """
+        Returns a dictionary of the message IDs referenced by each mail
+        from its References header
+        """
+        Mail = Pool().get('electronic_mail')
+        cursor = Transaction().cursor
+        references = {}
+        for i in range(0, len(mail_ids), cursor.IN_MAX):
+            sub_ids = mail_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('id', sub_ids)
+            cursor.execute('SELECT id, references_ '
+                'FROM "' + Mail._table + '" '
+                'WHERE references_ IS NOT NULL AND ' + red_sql, red_ids)
+            for mail_id, value in cursor.fetchall():
+                references[mail_id] = message_ids(value)
+        return references
+
+    @classmethod
+    def _get_ancestors(cls, row, references):
+        """
+        Returns the message IDs of the ancestors of the mail from the
+        oldest to the parent
+        """
+        mail_id, _, in_reply_to = row[:3]
+        ancestors = list(references.get(mail_id, []))
+        for message_id in message_ids(in_reply_to):
+            if not ancestors or ancestors[-1] != message_id:
+                ancestors.append(message_id)
+        return ancestors
+
+    @classmethod
+    def add_mails(cls, mail_ids):
+        """
+        Files the mails in the threads of the messages they reply to or
+        which reply to them, merging the threads they link together and
+        creating a thread for the others
+
+        :param mail_ids: List of the IDs of the mails to file
+        """
+        pool = Pool()
+        Mail = pool.get('electronic_mail')
+        ThreadMessage = pool.get('electronic_mail.thread.message')
+        cursor = Transaction().cursor
+        if not mail_ids:
+            return
+
+        rows = []
+        for i in range(0, len(mail_ids), cursor.IN_MAX):
+            sub_ids = mail_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('id', sub_ids)
+            cursor.execute('SELECT id, message_id, in_reply_to '
+                'FROM "' + Mail._table + '" WHERE ' + red_sql, red_ids)
+            rows.extend(cursor.fetchall())
+        references = cls._get_references(mail_ids)
+
+        # Group the mails and the existing threads sharing a message ID
+        parents = {}
+
+        def find(node):
+            parents.setdefault(node, node)
+            while parents[node] != node:
+                node = parents[node]
+            return node
+
+        def union(node1, node2):
+            root1, root2 = find(node1), find(node2)
+            if root1 != root2:
+                parents[root1] = root2
+
+        mail_messages = {}
+        for row in rows:
+            ids = message_ids(row[1]) + cls._get_ancestors(row, references)
+            mail_messages[row[0]] = ids
+            find(('mail', row[0]))
+            for message_id in ids:
+                union(('mail', row[0]), ('message', message_id))
+        known = ThreadMessage.get_threads(
+            list(set(m for ids in mail_messages.itervalues() for m in ids)))
+        for message_id, thread_id in known.iteritems():
+            union(('message', message_id), ('thread', thread_id))
+
+        groups = {}
+        for node in list(parents):
+            groups.setdefault(find(node), []).append(node)
+
+        to_create = []
+        thread_ids = set()
+        for nodes in groups.itervalues():
+            mails = [n[1] for n in nodes if n[0] == 'mail']
+            messages = [n[1] for n in nodes
+                if n[0] == 'message' and n[1] not in known]
+            threads = sorted(set(known[n[1]] for n in nodes
+                    if n[0] == 'message' and n[1] in known))
+            if not mails:
+                continue
+            if not threads:
+                to_create.append((mails, messages))
+                continue
+            thread_id = threads[0]
+            cls._merge(thread_id, threads[1:])
+            cls._file(thread_id, mails, messages)
+            thread_ids.add(thread_id)
+        if to_create:
+            with Transaction().set_user(0):
+                threads = cls.create([{} for _ in to_create])
+            for thread, (mails, messages) in zip(threads, to_create):
+                cls._file(thread.id, mails, messages)
+                thread_ids.add(thread.id)
+        cls.update_threads(list(thread_ids))
+
+    @staticmethod
+    def _invalidate(model, ids):
+        """
+        Clears the cached values of the records updated by SQL as
+        ModelStorage.write does
+        """
+        transaction = Transaction()
+        transaction.counter += 1
+        for cache in transaction.cursor.cache.itervalues():
+            records = cache.get(model)
+            if records:
+                for id_ in ids:
+                    records.pop(id_, None)
+
+    @classmethod
+    def _file(cls, thread_id, mail_ids, messages):
+        "Sets the thread of the mails and records its new message IDs"
+        Mail = Pool().get('electronic_mail')
+        ThreadMessage = Pool().get('electronic_mail.thread.message')
+        cursor = Transaction().cursor
+        for i in range(0, len(mail_ids), cursor.IN_MAX):
+            sub_ids = mail_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('id', sub_ids)
+            cursor.execute('UPDATE "' + Mail._table + '" SET thread = %s '
+                'WHERE ' + red_sql, [thread_id] + red_ids)
+        cls._invalidate(Mail.__name__, mail_ids)
+        if messages:
+            with Transaction().set_user(0):
+                ThreadMessage.create([{
+                            'thread': thread_id,
+                            'message_id': m,
+                            } for m in messages])
+
+    @classmethod
+    def _merge(cls, thread_id, other_ids):
+        "Moves the mails and message IDs of the other threads to the thread"
+        Mail = Pool().get('electronic_mail')
+        ThreadMessage = Pool().get('electronic_mail.thread.message')
+        cursor = Transaction().cursor
+        if not other_ids:
+            return
+        red_sql, red_ids = reduce_ids('thread', other_ids)
+        cursor.execute('SELECT id FROM "' + Mail._table + '" '
+            'WHERE ' + red_sql, red_ids)
+        mail_ids = [r[0] for r in cursor.fetchall()]
+        for table in (Mail._table, ThreadMessage._table):
+            cursor.execute('UPDATE "' + table + '" SET thread = %s '
+                'WHERE ' + red_sql, [thread_id] + red_ids)
+        cls._invalidate(Mail.__name__, mail_ids)
+        with Transaction().set_user(0):
+            cls.delete(cls.browse(other_ids))
+
+    @classmethod
+    def update_threads(cls, thread_ids):
+        """
+        Computes the parent, the depth and the path of the mails of the
+        threads from their message IDs. Out of order mails are attached to
+        their parent once it arrives and the mails whose ancestors are all
+        missing are roots. Only the changed mails are updated.
+
+        :param thread_ids: List of the IDs of the threads
+        """
+        Mail = Pool().get('electronic_mail')
+        cursor = Transaction().cursor
+        for i in range(0, len(thread_ids), cursor.IN_MAX):
+            sub_ids = thread_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('thread', sub_ids)
+            cursor.execute('SELECT id, message_id, in_reply_to, thread, '
+                    'date, thread_parent, thread_depth, thread_path '
+                'FROM "' + Mail._table + '" WHERE ' + red_sql, red_ids)
+            threads = {}
+            for row in cursor.fetchall():
+                threads.setdefault(row[3], []).append(row)
+            references = cls._get_references(
+                [r[0] for rows in threads.itervalues() for r in rows])
+            empty = set(sub_ids) - set(threads)
+            if empty:
+                with Transaction().set_user(0):
+                    cls.delete(cls.browse(list(empty)))
+            for thread_id, rows in threads.iteritems():
+                cls._update_thread(thread_id, rows, references)
+
+    @classmethod
+    def _update_thread(cls, thread_id, rows, references):
+        Mail = Pool().get('electronic_mail')
+        cursor = Transaction().cursor
+        rows.sort(key=lambda r: r[0])
+        by_message = {}
+        for row in rows:
+            for message_id in message_ids(row[1])[:1]:
+                # The copies of a message in several mailboxes are attached
+                # to the parent of the first one
+                by_message.setdefault(message_id, row[0])
+        mail_parents = {}
+        for row in rows:
+            for message_id in reversed(cls._get_ancestors(row, references)):
+                parent_id = by_message.get(message_id)
+                if parent_id is not None and parent_id != row[0]:
+                    mail_parents[row[0]] = parent_id
+                    break
+        # Break the cycles of inconsistent references
+        for row in rows:
+            seen = set([row[0]])
+            mail_id = row[0]
+            while mail_id in mail_parents:
+                mail_id = mail_parents[mail_id]
+                if mail_id in seen:
+                    del mail_parents[mail_id]
+                    break
+                seen.add(mail_id)
+
+        values = dict((r[0], r) for r in rows)
+        paths, depths = {}, {}
+
+        def compute(mail_id):
+            chain = []
+            while mail_id not in paths:
+                chain.append(mail_id)
+                if mail_id not in mail_parents:
+                    break
+                mail_id = mail_parents[mail_id]
+            for mail_id in reversed(chain):
+                parent_id = mail_parents.get(mail_id)
+                key = thread_key(values[mail_id][4], mail_id)
+                if parent_id is None:
+                    paths[mail_id], depths[mail_id] = key, 0
+                else:
+                    paths[mail_id] = paths[parent_id] + '/' + key
+                    depths[mail_id] = depths[parent_id] + 1
+
+        updated = []
+        for row in rows:
+            compute(row[0])
+            mail_id = row[0]
+            new = (mail_parents.get(mail_id), depths[mail_id],
+                paths[mail_id])
+            if tuple(row[5:8]) != new:
+                cursor.execute('UPDATE "' + Mail._table + '" '
+                    'SET thread_parent = %s, thread_depth = %s, '
+                        'thread_path = %s '
+                    'WHERE id = %s', new + (mail_id,))
+                updated.append(mail_id)
+        cls._invalidate(Mail.__name__, updated)
+        dates = [r[4] for r in rows if r[4]]
+        cursor.execute('UPDATE "' + cls._table + '" '
+            'SET date = %s WHERE id = %s',
+            (dates and max(dates) or None, thread_id))
+        cls._invalidate(cls.__name__, [thread_id])
+
+    @classmethod
+    def backfill(cls, batch_size=500, commit=True):
+        """
+        Files the existing mails without thread by batches
+
+        :param batch_size: Number of mails filed at once
+        :param commit: Commit the transaction after each batch
+        :return: Number of mails filed
+        """
+        Mail = Pool().get('electronic_mail')
+        cursor = Transaction().cursor
+        logger = logging.getLogger('electronic_mail')
+        count = 0
+        while True:
+            cursor.execute('SELECT id FROM "' + Mail._table + '" '
+                'WHERE thread IS NULL ORDER BY id '
+                'LIMIT %s', (batch_size,))
+            mail_ids = [r[0] for r in cursor.fetchall()]
+            if not mail_ids:
+                break
+            cls.add_mails(mail_ids)
+            count += len(mail_ids)
+            if commit:
+                cursor.commit()
+            logger.info('%s mails filed in threads', count)
+        return count
+
+
+class ThreadMessage(ModelSQL):
+    "E-mail Thread Message ID"
+    __name__ = 'electronic_mail.thread.message'
+
+    thread = fields.Many2One('electronic_mail.thread', 'Thread',
+        required=True, ondelete='CASCADE', select=1)
+    message_id = fields.Char('Message-ID', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ThreadMessage, cls).__setup__()
+        cls._sql_constraints += [
+            ('message_id_uniq', 'UNIQUE(message_id)',
+                'A Message-ID can belong to only one thread.'),
+            ]
+
+    @classmethod
+    def get_threads(cls, message_ids):
+        "Returns a dictionary of the thread of the known message IDs"
+        cursor = Transaction().cursor
+        threads = {}
+        for i in range(0, len(message_ids), cursor.IN_MAX):
+            sub_ids = message_ids[i:i + cursor.IN_MAX]
+            cursor.execute('SELECT message_id, thread '
+                'FROM "' + cls._table + '" '
+                'WHERE message_id IN (' + ','.join(('%s',) * len(sub_ids))
+                + ')', sub_ids)
+            threads.update(cursor.fetchall())
+        return threads
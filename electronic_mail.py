@@ -3,35 +3,148 @@
 "Electronic Mail"
 
 import os
+import re
 import base64
-from sys import getsizeof
-try:
-    import hashlib
-except ImportError:
-    hashlib = None
-    import md5
-from datetime import datetime
-from time import mktime
-from email.utils import parsedate
+import hashlib
+import logging
+import json
+import struct
+from datetime import datetime, timedelta
+from time import time
+from email import message_from_string
 
 from trytond.model import ModelView, ModelSQL, fields
+from trytond.backend import TableHandler
 from trytond.config import CONFIG
 from trytond.transaction import Transaction
+from trytond.tools import reduce_ids
 from trytond.pool import Pool, PoolMeta
+from trytond.rpc import RPC
 
+from .storage import get_storage, get_codec, content_name, encode, decode, \
+    decode_file, SplicedFile, get_write_behind, CACHE
+from .mime import iter_parts, is_attachment, decode_body, parse_date, \
+    received_date, parse_addresses, mbox_from_line, mbox_quote, parse_headers
+from .instrumentation import INSTRUMENTATION
+from .fulltext import get_index, has_index, extract_text, \
+    decode_header_text, fold
 
-__all__ = ['Mailbox', 'MailboxParent', 'ReadUser', 'WriteUser', 
-                'ElectronicMail', 'Header']
+
+__all__ = ['Mailbox', 'MailboxParent', 'MailboxClosure', 'ReadUser',
+    'WriteUser', 'ElectronicMail', 'Pack', 'Content', 'Attachment',
+    'Address', 'HeaderLine', 'Header']
 
 __metaclass__ = PoolMeta
 
+# The headers stored in columns of the mails to be queried, with the index
+# of their rows in the header view
+PROMOTED_HEADERS = [
+    ('List-Id', 'list_id'),
+    ('References', 'references_'),
+    ('Return-Path', 'return_path'),
+    ('X-Spam-Flag', 'spam_flag'),
+    ('X-Spam-Status', 'spam_status'),
+    ]
+# The number of IDs in the header view per mail whose headers are stored
+# compactly
+HEADER_SLOTS = 1 << 16
+SPAM_SCORE = re.compile(r'score=(-?[0-9.]+)')
+# The counter columns of the mailboxes and the expression on the mails
+# summed into each of them
+MAILBOX_COUNTERS = [
+    ('mail_count', '1'),
+    ('unseen_count', 'CASE WHEN flag_seen THEN 0 ELSE 1 END'),
+    ('flagged_count', 'CASE WHEN flag_flagged THEN 1 ELSE 0 END'),
+    ('recent_count', 'CASE WHEN flag_recent THEN 1 ELSE 0 END'),
+    ('mail_size', 'COALESCE(size, 0)'),
+    ]
+# The fields of the mails changing the counters
+COUNTED_FIELDS = ['mailbox', 'flag_seen', 'flag_flagged', 'flag_recent',
+    'size']
+# The roles of the addresses of the mails with their column
+ADDRESS_ROLES = [
+    ('from', 'from_'),
+    ('sender', 'sender'),
+    ('to', 'to'),
+    ('cc', 'cc'),
+    ('bcc', 'bcc'),
+    ]
+# The columns of the IMAP system flags
+FLAGS = {
+    'seen': 'flag_seen',
+    'answered': 'flag_answered',
+    'flagged': 'flag_flagged',
+    'draft': 'flag_draft',
+    'recent': 'flag_recent',
+    }
+
+
+def get_header_storage():
+    """
+    Returns how the headers of the new mails are stored, selected by the
+    email_header_storage option of the configuration: 'rows' for a header
+    line per header or 'compact' for the header section in a column of the
+    mail
+    """
+    return CONFIG.get('email_header_storage') or 'rows'
+
+
+def get_attachment_min_size():
+    """
+    Returns the size in bytes from which the attachments are stored apart
+    from their email, set by the email_attachment_min_size option of the
+    configuration
+    """
+    min_size = CONFIG.get('email_attachment_min_size')
+    if min_size is None:
+        return 4096
+    return int(min_size)
+
+
+def get_changes_window():
+    """
+    Returns the timedelta behind the cursor of get_changes in which the
+    changes are searched again for the transactions committed after the
+    cursor was returned, set in seconds by the email_changes_window option
+    of the configuration
+    """
+    window = CONFIG.get('email_changes_window')
+    if window is None:
+        window = 300
+    return timedelta(seconds=float(window))
+
+
+def parse_sequence_set(sequence_set, largest):
+    """
+    Returns the ranges of an IMAP sequence set of UIDs as '1:4,7,10:*'
+
+    :param sequence_set: The sequence set, '*' stands for the largest UID
+    :param largest: The largest UID of the mailbox
+    :return: List of tuples of the first and last UIDs of each range
+    """
+    def number(value):
+        if value == '*':
+            return largest
+        value = int(value)
+        if value < 1:
+            raise ValueError('Invalid UID "%s"' % value)
+        return value
+
+    ranges = []
+    for item in str(sequence_set).split(','):
+        first, _, last = item.strip().partition(':')
+        first = number(first)
+        last = number(last) if last else first
+        ranges.append((min(first, last), max(first, last)))
+    return ranges
+
 
 class Mailbox(ModelSQL, ModelView):
     "Mailbox"
     __name__ = "electronic_mail.mailbox"
 
     name = fields.Char('Name', required=True)
-    user = fields.Many2One('res.user', 'Owner')
+    user = fields.Many2One('res.user', 'Owner', select=1)
     parents = fields.Many2Many(
              'electronic_mail.mailbox-mailbox',
              'parent', 'child' ,'Parents')
@@ -40,6 +153,369 @@ class Mailbox(ModelSQL, ModelView):
             'mailbox', 'user', 'Read Users')
     write_users = fields.Many2Many('electronic_mail.mailbox-write-res.user',
             'mailbox', 'user', 'Write Users')
+    mail_count = fields.Integer('Mails', readonly=True,
+        help='Number of mails of the mailbox')
+    unseen_count = fields.Integer('Unseen', readonly=True,
+        help='Number of unseen mails of the mailbox')
+    flagged_count = fields.Integer('Flagged', readonly=True,
+        help='Number of flagged mails of the mailbox')
+    recent_count = fields.Integer('Recent', readonly=True,
+        help='Number of recent mails of the mailbox')
+    mail_size = fields.BigInteger('Size', readonly=True,
+        help='Size of the mails of the mailbox')
+    uid_next = fields.Integer('Next UID', readonly=True,
+        help='UID of the next mail of the mailbox')
+    uid_validity = fields.Integer('UID Validity', readonly=True,
+        help='Changes when the UIDs of the mails are assigned again')
+    archive_days = fields.Integer('Archive After Days',
+        help='Age in days from which the mails are moved to the archive')
+    archive_size = fields.BigInteger('Archive Above Size',
+        help='Size in bytes of the mails kept out of the archive, the '
+        'oldest mails above it are moved to the archive')
+    total_mails = fields.Function(fields.Integer('Total Mails',
+            help='Number of mails of the mailbox and its children'),
+        'get_counts')
+    unseen_mails = fields.Function(fields.Integer('Unseen Mails',
+            help='Number of unseen mails of the mailbox and its children'),
+        'get_counts')
+    mails_size = fields.Function(fields.BigInteger('Mails Size',
+            help='Size of the mails of the mailbox and its children'),
+        'get_counts')
+
+    @classmethod
+    def __register__(cls, module_name):
+        Mail = Pool().get('electronic_mail')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+        counted = table.column_exist('mail_count')
+
+        super(Mailbox, cls).__register__(module_name)
+
+        # Migration from 2.8.1: count the mails of the mailboxes
+        if (not counted
+                and TableHandler.table_exist(cursor, Mail._table)):
+            cls.reconcile_counters()
+
+    @staticmethod
+    def default_mail_count():
+        return 0
+
+    @staticmethod
+    def default_unseen_count():
+        return 0
+
+    @staticmethod
+    def default_flagged_count():
+        return 0
+
+    @staticmethod
+    def default_recent_count():
+        return 0
+
+    @staticmethod
+    def default_mail_size():
+        return 0
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [x.copy() for x in vlist]
+        for values in vlist:
+            for counter, _ in MAILBOX_COUNTERS:
+                values[counter] = 0
+            values['uid_next'] = 1
+            values['uid_validity'] = int(time())
+        mailboxes = super(Mailbox, cls).create(vlist)
+        cls.update_closure([m.id for m in mailboxes])
+        return mailboxes
+
+    @classmethod
+    def copy(cls, mailboxes, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        for counter, _ in MAILBOX_COUNTERS:
+            default[counter] = 0
+        return super(Mailbox, cls).copy(mailboxes, default=default)
+
+    @classmethod
+    def write(cls, mailboxes, values):
+        # The counters and the UIDs are only updated from the mails
+        values = dict((k, v) for k, v in values.iteritems()
+            if k not in dict(MAILBOX_COUNTERS)
+            and k not in ('uid_next', 'uid_validity'))
+        super(Mailbox, cls).write(mailboxes, values)
+        if 'parents' in values:
+            cls.update_closure([m.id for m in mailboxes])
+
+    @classmethod
+    def delete(cls, mailboxes):
+        Closure = Pool().get('electronic_mail.mailbox.closure')
+        # The paths through the deleted mailboxes are removed
+        descendants = Closure.get_descendants([m.id for m in mailboxes])
+        super(Mailbox, cls).delete(mailboxes)
+        cls.update_closure(list(descendants - set(m.id for m in mailboxes)))
+
+    @classmethod
+    def update_closure(cls, mailbox_ids):
+        """
+        Computes the closure rows of the mailboxes and of their descendants
+        from the parents of all the mailboxes
+
+        :param mailbox_ids: List of the IDs of the mailboxes whose parents
+            changed
+        """
+        pool = Pool()
+        MailboxParent = pool.get('electronic_mail.mailbox-mailbox')
+        Closure = pool.get('electronic_mail.mailbox.closure')
+        cursor = Transaction().cursor
+        if not mailbox_ids:
+            return
+        # The parent column holds the mailbox and child its parent
+        cursor.execute('SELECT parent, child FROM "%s"'
+            % MailboxParent._table)
+        parents, children = {}, {}
+        for mailbox_id, parent_id in cursor.fetchall():
+            parents.setdefault(mailbox_id, set()).add(parent_id)
+            children.setdefault(parent_id, set()).add(mailbox_id)
+
+        affected = set()
+        to_visit = list(mailbox_ids)
+        while to_visit:
+            mailbox_id = to_visit.pop()
+            if mailbox_id not in affected:
+                affected.add(mailbox_id)
+                to_visit.extend(children.get(mailbox_id, ()))
+
+        rows = []
+        for mailbox_id in affected:
+            # Breadth first to record the shortest path to each ancestor
+            depths = {mailbox_id: 0}
+            level = [mailbox_id]
+            depth = 0
+            while level:
+                depth += 1
+                next_level = []
+                for node in level:
+                    for parent_id in parents.get(node, ()):
+                        if parent_id == mailbox_id:
+                            mailbox = cls(mailbox_id)
+                            cls.raise_user_error('recursion_error', {
+                                    'rec_name': mailbox.rec_name,
+                                    'parent_rec_name': ', '.join(
+                                        p.rec_name for p in mailbox.parents),
+                                    })
+                        if parent_id not in depths:
+                            depths[parent_id] = depth
+                            next_level.append(parent_id)
+                level = next_level
+            rows.extend((ancestor, mailbox_id, depth)
+                for ancestor, depth in depths.iteritems())
+        Closure.set_rows(list(affected), rows)
+
+    @classmethod
+    def get_counts(cls, mailboxes, names):
+        """
+        Returns the number of mails, of unseen mails and the size of the
+        mails of the mailboxes and their descendants by summing their
+        counters with one grouped query per IN_MAX mailboxes
+        """
+        Closure = Pool().get('electronic_mail.mailbox.closure')
+        cursor = Transaction().cursor
+        result = dict((name, dict((m.id, 0) for m in mailboxes))
+            for name in names)
+        mailbox_ids = [m.id for m in mailboxes]
+        for i in range(0, len(mailbox_ids), cursor.IN_MAX):
+            sub_ids = mailbox_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('c.ancestor', sub_ids)
+            cursor.execute('SELECT c.ancestor, SUM(b.mail_count), '
+                    'SUM(b.unseen_count), SUM(b.mail_size) '
+                'FROM "' + Closure._table + '" AS c '
+                'JOIN "' + cls._table + '" AS b '
+                    'ON b.id = c.descendant '
+                'WHERE ' + red_sql + ' '
+                'GROUP BY c.ancestor', red_ids)
+            for mailbox_id, total, unseen, size in cursor.fetchall():
+                for name, value in (('total_mails', total),
+                        ('unseen_mails', unseen), ('mails_size', size)):
+                    if name in result:
+                        result[name][mailbox_id] = int(value or 0)
+        return result
+
+    @classmethod
+    def count_mails(cls, mail_ids):
+        """
+        Returns the counters of the mails grouped by mailbox
+
+        :param mail_ids: List of the IDs of the mails
+        :return: Dictionary of the mailbox ID and the list of the values
+            of MAILBOX_COUNTERS
+        """
+        Mail = Pool().get('electronic_mail')
+        cursor = Transaction().cursor
+        counts = {}
+        for i in range(0, len(mail_ids), cursor.IN_MAX):
+            sub_ids = mail_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('id', sub_ids)
+            cursor.execute('SELECT mailbox, '
+                + ', '.join('SUM(%s)' % e for _, e in MAILBOX_COUNTERS) + ' '
+                'FROM "' + Mail._table + '" '
+                'WHERE ' + red_sql + ' '
+                'GROUP BY mailbox', red_ids)
+            for row in cursor.fetchall():
+                values = counts.setdefault(row[0], [0] * len(MAILBOX_COUNTERS))
+                for index, value in enumerate(row[1:]):
+                    values[index] += int(value or 0)
+        return counts
+
+    @classmethod
+    def update_counters(cls, previous, current):
+        """
+        Adds to the counters of the mailboxes the difference between the
+        counts returned by count_mails before and after a change of mails.
+        The columns are incremented in place so concurrent transactions
+        do not lose their changes.
+        """
+        cursor = Transaction().cursor
+        mailbox_ids = []
+        for mailbox_id in set(previous) | set(current):
+            zero = [0] * len(MAILBOX_COUNTERS)
+            deltas = [c - p for p, c in zip(previous.get(mailbox_id, zero),
+                    current.get(mailbox_id, zero))]
+            if not any(deltas):
+                continue
+            cursor.execute('UPDATE "' + cls._table + '" SET '
+                + ', '.join('%s = COALESCE(%s, 0) + %%s' % (c, c)
+                    for c, _ in MAILBOX_COUNTERS) + ' '
+                'WHERE id = %s', deltas + [mailbox_id])
+            mailbox_ids.append(mailbox_id)
+        if mailbox_ids:
+            cls._invalidate(mailbox_ids)
+
+    @classmethod
+    def reconcile_counters(cls, mailbox_ids=None):
+        """
+        Counts again the mails of the mailboxes, or of all the mailboxes
+        when none are given, to repair their counters
+
+        :param mailbox_ids: List of the IDs of the mailboxes
+        """
+        Mail = Pool().get('electronic_mail')
+        cursor = Transaction().cursor
+        if mailbox_ids is None:
+            cursor.execute('SELECT id FROM "' + cls._table + '"')
+            mailbox_ids = [r[0] for r in cursor.fetchall()]
+        for i in range(0, len(mailbox_ids), cursor.IN_MAX):
+            sub_ids = mailbox_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('id', sub_ids)
+            cursor.execute('UPDATE "' + cls._table + '" SET '
+                + ', '.join('%s = (SELECT COALESCE(SUM(%s), 0) '
+                    'FROM "%s" WHERE mailbox = "%s".id)'
+                    % (c, e, Mail._table, cls._table)
+                    for c, e in MAILBOX_COUNTERS) + ' '
+                'WHERE ' + red_sql, red_ids)
+        cls._invalidate(mailbox_ids)
+
+    @classmethod
+    def allocate_uids(cls, mailbox_id, count):
+        """
+        Reserves UIDs for new mails of the mailbox. The update of the
+        mailbox row serializes the concurrent allocations.
+
+        :param mailbox_id: ID of the mailbox
+        :param count: Number of UIDs
+        :return: List of the UIDs in increasing order
+        """
+        cursor = Transaction().cursor
+        cursor.execute('UPDATE "' + cls._table + '" '
+            'SET uid_next = COALESCE(uid_next, 1) + %s '
+            'WHERE id = %s', (count, mailbox_id))
+        cursor.execute('SELECT uid_next FROM "' + cls._table + '" '
+            'WHERE id = %s', (mailbox_id,))
+        uid_next, = cursor.fetchone()
+        cls._invalidate([mailbox_id])
+        return range(uid_next - count, uid_next)
+
+    @classmethod
+    def archive_mails(cls, mailbox_ids=None, batch_size=200, commit=True):
+        """
+        Moves the contents of the mails out of the retention policy of their
+        mailbox into pack files: the mails older than archive_days and the
+        oldest mails above archive_size. The mails stay readable and
+        searchable, their stored files are removed once the pack file is
+        committed.
+
+        :param mailbox_ids: List of IDs of the mailboxes, all when None
+        :param batch_size: Number of mails packed in one pack file
+        :param commit: Commit the transaction after each pack file, else
+            the stored files of the packed contents are left to
+            Content.collect_files which removes them after its delay
+        :return: Number of archived mails
+        """
+        pool = Pool()
+        Mail = pool.get('electronic_mail')
+        Content = pool.get('electronic_mail.content')
+        cursor = Transaction().cursor
+        storage = get_storage()
+
+        where = '(archive_days IS NOT NULL OR archive_size IS NOT NULL)'
+        args = []
+        if mailbox_ids is not None:
+            if not mailbox_ids:
+                return 0
+            red_sql, args = reduce_ids('id', mailbox_ids)
+            where += ' AND ' + red_sql
+        cursor.execute('SELECT id, archive_days, archive_size '
+            'FROM "' + cls._table + '" WHERE ' + where + ' ORDER BY id', args)
+        count = 0
+        for mailbox_id, days, max_size in cursor.fetchall():
+            limit = None
+            if days is not None:
+                # The dates of the mails are stored in UTC
+                limit = datetime.utcnow() - timedelta(days=days)
+            # The mails are walked from the most recent so the size kept
+            # out of the archive is the one of the most recent mails
+            cursor.execute('SELECT id, digest, size, '
+                    'CASE WHEN COALESCE(date, create_date) < %s '
+                        'THEN 1 ELSE 0 END '
+                'FROM "' + Mail._table + '" '
+                'WHERE mailbox = %s AND (archived IS NULL OR archived = %s) '
+                'ORDER BY COALESCE(date, create_date) DESC, id DESC',
+                (limit, mailbox_id, False))
+            selected = []
+            total = 0
+            for mail_id, digest, size, old in cursor.fetchall():
+                total += size or 0
+                if old or (max_size is not None and total > max_size):
+                    selected.append((mail_id, digest))
+            selected.reverse()
+            for i in range(0, len(selected), batch_size):
+                batch = selected[i:i + batch_size]
+                names = Content.pack_contents([d for _, d in batch if d])
+                mail_ids = [m for m, _ in batch]
+                red_sql, red_ids = reduce_ids('id', mail_ids)
+                cursor.execute('UPDATE "' + Mail._table + '" '
+                    'SET archived = %s WHERE ' + red_sql, [True] + red_ids)
+                Mail._invalidate(mail_ids)
+                count += len(batch)
+                if commit:
+                    cursor.commit()
+                    for name in names:
+                        storage.delete(name)
+        return count
+
+    @staticmethod
+    def _invalidate(ids):
+        """
+        Clears the cached values of the mailboxes updated by SQL as
+        ModelStorage.write does
+        """
+        transaction = Transaction()
+        transaction.counter += 1
+        for cache in transaction.cursor.cache.itervalues():
+            records = cache.get('electronic_mail.mailbox')
+            if records:
+                for id_ in ids:
+                    records.pop(id_, None)
 
 
 class MailboxParent(ModelSQL):
@@ -52,6 +528,69 @@ class MailboxParent(ModelSQL):
             ondelete='CASCADE', required=True, select=1)
 
 
+class MailboxClosure(ModelSQL):
+    """
+    Mailbox Closure
+
+    A row per mailbox and each of its ancestors, itself included, with the
+    length of the shortest path between them
+    """
+    __name__ = 'electronic_mail.mailbox.closure'
+
+    ancestor = fields.Many2One('electronic_mail.mailbox', 'Ancestor',
+            ondelete='CASCADE', required=True, select=1)
+    descendant = fields.Many2One('electronic_mail.mailbox', 'Descendant',
+            ondelete='CASCADE', required=True, select=1)
+    depth = fields.Integer('Depth', required=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        Mailbox = Pool().get('electronic_mail.mailbox')
+        cursor = Transaction().cursor
+        created = not TableHandler.table_exist(cursor, cls._table)
+
+        super(MailboxClosure, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['ancestor', 'descendant'], 'add')
+
+        # Migration from 2.8.1: compute the closure of the mailboxes
+        if created:
+            cursor.execute('SELECT id FROM "%s"' % Mailbox._table)
+            Mailbox.update_closure([r[0] for r in cursor.fetchall()])
+
+    @classmethod
+    def set_rows(cls, mailbox_ids, rows):
+        """
+        Replaces the rows of the mailboxes as descendants
+
+        :param mailbox_ids: List of the IDs of the descendant mailboxes
+        :param rows: List of tuples of the ancestor, descendant and depth
+        """
+        cursor = Transaction().cursor
+        for i in range(0, len(mailbox_ids), cursor.IN_MAX):
+            sub_ids = mailbox_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('descendant', sub_ids)
+            cursor.execute('DELETE FROM "' + cls._table + '" '
+                'WHERE ' + red_sql, red_ids)
+        for row in rows:
+            cursor.execute('INSERT INTO "' + cls._table + '" '
+                '(ancestor, descendant, depth) VALUES (%s, %s, %s)', row)
+
+    @classmethod
+    def get_descendants(cls, mailbox_ids):
+        "Returns the set of the IDs of the mailboxes and their descendants"
+        cursor = Transaction().cursor
+        descendants = set()
+        for i in range(0, len(mailbox_ids), cursor.IN_MAX):
+            sub_ids = mailbox_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('ancestor', sub_ids)
+            cursor.execute('SELECT descendant FROM "' + cls._table + '" '
+                'WHERE ' + red_sql, red_ids)
+            descendants.update(r[0] for r in cursor.fetchall())
+        return descendants
+
+
 class ReadUser(ModelSQL):
     'Electronic Mail - read - User'
     __name__ = 'electronic_mail.mailbox-read-res.user'
@@ -84,20 +623,33 @@ class ElectronicMail(ModelSQL, ModelView):
     cc = fields.Char('CC')
     bcc = fields.Char('BCC')
     subject = fields.Char('Subject')
-    date = fields.DateTime('Date')
-    message_id = fields.Char('Message-ID', help='Unique Message Identifier')
-    in_reply_to = fields.Char('In-Reply-To')
+    date = fields.DateTime('Date', select=1)
+    message_id = fields.Char('Message-ID', help='Unique Message Identifier',
+        select=1)
+    in_reply_to = fields.Char('In-Reply-To', select=1)
     headers = fields.One2Many(
         'electronic_mail.header', 'electronic_mail', 'Headers')
-    digest = fields.Char('MD5 Digest', size=32)
-    collision = fields.Integer('Collision')
+    digest = fields.Char('Digest', size=64)
+    collision = fields.Integer('Collision',
+        help='Index of the MD5 digest collision of the mails stored before '
+        'SHA-256 digests')
     email = fields.Function(fields.Binary('Email'), 'get_email', 'set_email')
+    email_headers = fields.Function(fields.Text('Email Headers'),
+        'get_email_headers')
     flag_seen = fields.Boolean('Seen')
     flag_answered = fields.Boolean('Answered')
     flag_flagged = fields.Boolean('Flagged')
     flag_draft = fields.Boolean('Draft')
     flag_recent = fields.Boolean('Recent')
     size = fields.Integer('Size')
+    size_measured = fields.Boolean('Size Measured', readonly=True,
+        help='The size of the content stored without its content record '
+        'was measured or it could not be')
+    uid = fields.Integer('UID', readonly=True,
+        help='Identifier of the mail in its mailbox, increasing with the '
+        'mails added to the mailbox')
+    archived = fields.Boolean('Archived', readonly=True, select=1,
+        help='The content of the mail is stored in a pack file')
     mailbox_owner = fields.Function(
         fields.Many2One('res.user', 'Owner'),
         'get_mailbox_owner', searcher='search_mailbox_owner')
@@ -107,6 +659,106 @@ class ElectronicMail(ModelSQL, ModelView):
     mailbox_write_users = fields.Function(
         fields.One2Many('res.user', None, 'Write Users'),
         'get_mailbox_users', searcher='search_mailbox_users')
+    mailbox_read_access = fields.Function(
+        fields.One2Many('res.user', None, 'Read Access Users',
+            help='Owner, read users and write users of the mailbox'),
+        'get_mailbox_users', searcher='search_mailbox_users')
+    mailbox_write_access = fields.Function(
+        fields.One2Many('res.user', None, 'Write Access Users',
+            help='Owner and write users of the mailbox'),
+        'get_mailbox_users', searcher='search_mailbox_users')
+    mailbox_ancestors = fields.Function(
+        fields.One2Many('electronic_mail.mailbox', None, 'Mailbox Ancestors',
+            help='Mailbox of the mail and its ancestors'),
+        'get_mailbox_ancestors', searcher='search_mailbox_ancestors')
+    thread = fields.Many2One('electronic_mail.thread', 'Thread',
+        readonly=True, select=1, ondelete='SET NULL')
+    thread_parent = fields.Many2One('electronic_mail', 'Thread Parent',
+        readonly=True, ondelete='SET NULL',
+        help='Mail this mail replies to in the thread')
+    thread_depth = fields.Integer('Thread Depth', readonly=True)
+    thread_path = fields.Char('Thread Path', readonly=True,
+        help='Sorts the mails of the thread as a tree')
+    list_id = fields.Char('List-Id', select=1)
+    references_ = fields.Text('References', loading='lazy')
+    return_path = fields.Char('Return-Path')
+    spam_flag = fields.Char('X-Spam-Flag')
+    spam_status = fields.Char('X-Spam-Status')
+    spam_score = fields.Float('Spam Score', select=1)
+    raw_headers = fields.Text('Raw Headers', loading='lazy',
+        help='Header section of the mails whose headers are stored compactly')
+    attachments = fields.One2Many('electronic_mail.attachment', 'mail',
+        'Attachments', readonly=True)
+    addresses = fields.One2Many('electronic_mail.address', 'mail',
+        'Addresses', readonly=True)
+    correspondent = fields.Function(fields.Char('Correspondent',
+            help='Address of the sender, the mails are searched by the '
+            'address of any sender or recipient'),
+        'get_correspondent', searcher='search_correspondent')
+    search_text = fields.Function(fields.Text('Search Text',
+            help='Words of the subject, addresses and body of the mail'),
+        'get_search_text', searcher='search_search_text')
+
+    @classmethod
+    def __setup__(cls):
+        super(ElectronicMail, cls).__setup__()
+        cls._error_messages.update({
+                'digest_mismatch': 'The content stored under the digest '
+                    '"%s" differs from the email.',
+                'invalid_flag': 'The flag "%s" is not a system flag.',
+                'invalid_uid_range': 'The UIDs "%s" are not a valid '
+                    'sequence set.',
+                'invalid_cursor': 'The cursor "%s" is not a valid cursor '
+                    'of changes.',
+                })
+        cls.__rpc__.update({
+                'read_email_range': RPC(instantiate=0),
+                'get_cache_stats': RPC(),
+                'get_instrumentation_stats': RPC(),
+                'set_flags': RPC(readonly=False),
+                'get_changes': RPC(),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        Mailbox = Pool().get('electronic_mail.mailbox')
+        cursor = Transaction().cursor
+        uid_exist = TableHandler(cursor, cls, module_name).column_exist('uid')
+
+        super(ElectronicMail, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        # Migration from 2.8.1: number the mails of each mailbox
+        if not uid_exist:
+            cursor.execute('SELECT id, mailbox FROM "' + cls._table + '" '
+                'ORDER BY mailbox, id')
+            uid, mailbox_id = 0, None
+            for mail_id, mail_mailbox_id in cursor.fetchall():
+                if mail_mailbox_id != mailbox_id:
+                    uid, mailbox_id = 0, mail_mailbox_id
+                uid += 1
+                cursor.execute('UPDATE "' + cls._table + '" SET uid = %s '
+                    'WHERE id = %s', (uid, mail_id))
+            cursor.execute('UPDATE "' + Mailbox._table + '" '
+                'SET uid_next = COALESCE((SELECT MAX(uid) '
+                        'FROM "' + cls._table + '" '
+                        'WHERE mailbox = "' + Mailbox._table + '".id), 0) '
+                    '+ 1, '
+                    'uid_validity = %s', (int(time()),))
+
+        # The mails of a mailbox are listed by date and the stored contents
+        # are looked up by digest and collision, the leading columns serve
+        # the lookups by mailbox or by digest alone
+        table.index_action(['mailbox', 'date'], 'add')
+        table.index_action(['digest', 'collision'], 'add')
+        # The mails of a thread are fetched in tree order
+        table.index_action(['thread', 'thread_path'], 'add')
+        # The flags are set by ranges of UIDs
+        table.index_action(['mailbox', 'uid'], 'add')
+
+        index = get_index()
+        if index:
+            index.create()
 
     @staticmethod
     def default_collision():
@@ -128,21 +780,154 @@ class ElectronicMail(ModelSQL, ModelView):
     def default_flag_recent():
         return False
 
+    @staticmethod
+    def default_archived():
+        return False
+
     @classmethod
     def get_mailbox_owner(cls, mails, name):
         "Returns owner of mailbox"
-        return dict([(mail.id, mail.mailbox.user.id) for mail in mails])
+        Mailbox = Pool().get('electronic_mail.mailbox')
+        cursor = Transaction().cursor
+        mailbox_ids = list(set(m.mailbox.id for m in mails))
+        owners = {}
+        for i in range(0, len(mailbox_ids), cursor.IN_MAX):
+            sub_ids = mailbox_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('id', sub_ids)
+            cursor.execute('SELECT id, "user" FROM "' + Mailbox._table + '" '
+                'WHERE ' + red_sql, red_ids)
+            owners.update(cursor.fetchall())
+        return dict([(m.id, owners.get(m.mailbox.id)) for m in mails])
+
+    @classmethod
+    def get_mailbox_ancestors(cls, mails, name):
+        Closure = Pool().get('electronic_mail.mailbox.closure')
+        cursor = Transaction().cursor
+        mailbox_ids = list(set(m.mailbox.id for m in mails))
+        ancestors = {}
+        for i in range(0, len(mailbox_ids), cursor.IN_MAX):
+            sub_ids = mailbox_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('descendant', sub_ids)
+            cursor.execute('SELECT descendant, ancestor '
+                'FROM "' + Closure._table + '" '
+                'WHERE ' + red_sql + ' ORDER BY depth', red_ids)
+            for mailbox_id, ancestor_id in cursor.fetchall():
+                ancestors.setdefault(mailbox_id, []).append(ancestor_id)
+        return dict((m.id, ancestors.get(m.mailbox.id, [])) for m in mails)
+
+    @classmethod
+    def get_correspondent(cls, mails, name):
+        Address = Pool().get('electronic_mail.address')
+        cursor = Transaction().cursor
+        result = dict((m.id, None) for m in mails)
+        mail_ids = result.keys()
+        for i in range(0, len(mail_ids), cursor.IN_MAX):
+            red_sql, red_ids = reduce_ids('mail',
+                mail_ids[i:i + cursor.IN_MAX])
+            cursor.execute('SELECT mail, MIN(address) '
+                'FROM "' + Address._table + '" '
+                'WHERE role = %s AND ' + red_sql + ' GROUP BY mail',
+                ['from'] + red_ids)
+            result.update(cursor.fetchall())
+        return result
+
+    @classmethod
+    def search_correspondent(cls, name, clause):
+        """
+        Returns the mails sent from or to the addresses with one sub-query
+        seeking the index of the addresses
+        """
+        Address = Pool().get('electronic_mail.address')
+        _, operator, value = clause[:3]
+        if operator not in ('=', 'in'):
+            return [('addresses.address', operator, value)]
+        if operator == '=':
+            value = [value]
+        addresses = [v.strip().lower() for v in value if v]
+        if not addresses:
+            return [('id', '=', None)]
+        return [('id', 'inselect', (
+                    'SELECT mail FROM "' + Address._table + '" '
+                    'WHERE address IN ('
+                    + ','.join(('%s',) * len(addresses)) + ')',
+                    addresses))]
+
+    @classmethod
+    def search_mailbox_ancestors(cls, name, clause):
+        """
+        Returns the mails of the mailboxes under the given mailboxes with
+        one sub-query on the closure of the mailboxes
+        """
+        Closure = Pool().get('electronic_mail.mailbox.closure')
+        mailbox_ids = cls._user_ids(clause)
+        if mailbox_ids is None:
+            return [('mailbox', 'child_of', clause[2], 'parents')]
+        if not mailbox_ids:
+            return [('id', '=', None)]
+        return [('mailbox', 'inselect', (
+                    'SELECT descendant FROM "' + Closure._table + '" '
+                    'WHERE ancestor IN ('
+                    + ','.join(('%s',) * len(mailbox_ids)) + ')',
+                    mailbox_ids))]
+
+    @classmethod
+    def _mailbox_users_query(cls, name, where, args):
+        """
+        Returns the query selecting the mailbox and user pairs giving the
+        users of the function field name, filtered by the where clause on
+        the mailbox and user columns
+
+        :param name: Name of the function field
+        :param where: SQL clause on the "mailbox" and "user" columns
+        :param args: Arguments of the where clause
+        :return: Tuple of the query and its arguments
+        """
+        pool = Pool()
+        Mailbox = pool.get('electronic_mail.mailbox')
+        ReadUser = pool.get('electronic_mail.mailbox-read-res.user')
+        WriteUser = pool.get('electronic_mail.mailbox-write-res.user')
+        owner = ('SELECT id AS mailbox, "user" FROM "' + Mailbox._table + '" '
+            'WHERE "user" IS NOT NULL')
+        readers = 'SELECT mailbox, "user" FROM "' + ReadUser._table + '"'
+        writers = 'SELECT mailbox, "user" FROM "' + WriteUser._table + '"'
+        tables = {
+            'mailbox_read_users': [readers],
+            'mailbox_write_users': [writers],
+            'mailbox_read_access': [owner, readers, writers],
+            'mailbox_write_access': [owner, writers],
+            }[name]
+        query = ' UNION '.join('SELECT mailbox, "user" FROM (' + table
+            + ') AS u WHERE ' + where for table in tables)
+        return query, args * len(tables)
 
     @classmethod
     def get_mailbox_users(cls, mails, name):
-        assert name in ('mailbox_read_users', 'mailbox_write_users')
-        res = {}
-        for mail in mails:
-            if name == 'mailbox_read_users':
-                res[mail.id] = [x.id for x in mail.mailbox['read_users']]
-            else:
-                res[mail.id] = [x.id for x in mail.mailbox['write_users']]
-        return res
+        assert name in ('mailbox_read_users', 'mailbox_write_users',
+            'mailbox_read_access', 'mailbox_write_access')
+        cursor = Transaction().cursor
+        mailbox_ids = list(set(m.mailbox.id for m in mails))
+        users = {}
+        for i in range(0, len(mailbox_ids), cursor.IN_MAX):
+            sub_ids = mailbox_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('mailbox', sub_ids)
+            cursor.execute(*cls._mailbox_users_query(name, red_sql, red_ids))
+            for mailbox_id, user_id in cursor.fetchall():
+                users.setdefault(mailbox_id, []).append(user_id)
+        return dict([(m.id, users.get(m.mailbox.id, [])) for m in mails])
+
+    @staticmethod
+    def _user_ids(clause):
+        "Returns the user IDs of a '=' or 'in' clause on users or None"
+        if clause[1] == '=':
+            user_ids = [clause[2]]
+        elif clause[1] == 'in':
+            user_ids = list(clause[2])
+        else:
+            return None
+        if not user_ids or not all(isinstance(u, (int, long))
+                and not isinstance(u, bool) for u in user_ids):
+            return None
+        return user_ids
 
     @classmethod
     def search_mailbox_owner(cls, name, clause):
@@ -150,98 +935,529 @@ class ElectronicMail(ModelSQL, ModelView):
 
     @classmethod
     def search_mailbox_users(cls, name, clause):
-        return [('mailbox.' + name[8:],) + clause[1:]]
+        user_ids = cls._user_ids(clause)
+        if user_ids is not None:
+            # The access rules use this clause so it is compiled into a
+            # single sub-query on the mailbox
+            red_sql, red_ids = reduce_ids('"user"', user_ids)
+            query, args = cls._mailbox_users_query(name, red_sql, red_ids)
+            return [('mailbox', 'inselect',
+                    ('SELECT mailbox FROM (' + query + ') AS a', args))]
+        if name in ('mailbox_read_users', 'mailbox_write_users'):
+            return [('mailbox.' + name[8:],) + clause[1:]]
+        domain = ['OR',
+            ('mailbox.user',) + clause[1:],
+            ('mailbox.write_users',) + clause[1:],
+            ]
+        if name == 'mailbox_read_access':
+            domain.append(('mailbox.read_users',) + clause[1:])
+        return [domain]
 
-    def _get_email(self):
+    def _content_digest(self):
         """
-        Returns the email object from reading the FS
+        Returns the digest of the content record of the stored email or None.
+        The emails stored apart because of an MD5 collision predate the
+        content records so they are never compressed nor split.
         """
-        db_name = Transaction().cursor.dbname
-        value = u''
-        if self.digest:
-            filename = self.digest
-            if self.collision:
-                filename = filename + '-' + str(self.collision)
-            filename = os.path.join(
-                CONFIG['data_path'], db_name, 
-                'email', filename[0:2], filename)
-            try:
-                with open(filename, 'r') as file_p:
-                    value =  file_p.read()
-            except IOError:
-                pass
-        return value
+        if self.collision:
+            return None
+        return self.digest
+
+    def open_email(self, codec=False, parts=False):
+        """
+        Returns a file-like object reading the stored email or None. The
+        content is streamed so the caller can read it in chunks and must
+        close it.
+
+        :param codec: Codec of the stored content, looked up when False
+        :param parts: Attachments stored apart, looked up when False
+        """
+        Content = Pool().get('electronic_mail.content')
+        if not self.digest:
+            return None
+        name = self.digest
+        if self.collision:
+            name = name + '-' + str(self.collision)
+        if codec is False:
+            codec = Content.get_codecs([self.digest]).get(
+                self._content_digest())
+        if parts is False:
+            parts = Content.get_parts([self.digest]).get(
+                self._content_digest())
+        return Content.open_content(name, codec, parts)
+
+    def map_email(self, codec=False, parts=False):
+        """
+        Returns a read-only buffer of the stored email or None. When the
+        content is not compressed nor has attachments stored apart it is a
+        memory map of the stored file so it is not copied and the functions
+        of the mime module can parse it. The caller must close it. Other
+        contents are returned as the decompressed string.
+
+        :param codec: Codec of the stored content, looked up when False
+        :param parts: Attachments stored apart, looked up when False
+        """
+        Content = Pool().get('electronic_mail.content')
+        if not self.digest:
+            return None
+        name = self.digest
+        if self.collision:
+            name = name + '-' + str(self.collision)
+        if codec is False:
+            codec = Content.get_codecs([self.digest]).get(
+                self._content_digest())
+        if parts is False:
+            parts = Content.get_parts([self.digest]).get(
+                self._content_digest())
+        if not parts and not codec:
+            mapped = get_storage().map(name)
+            if mapped is not None:
+                return mapped
+        file_p = Content.open_content(name, codec, parts)
+        if file_p is None:
+            return None
+        with file_p:
+            return file_p.read()
+
+    def read_email(self, offset=0, length=None, codec=False, parts=False):
+        """
+        Returns a slice of the stored email without reading the rest of it
+
+        :param offset: Position of the first byte
+        :param length: Number of bytes, until the end when None
+        :param codec: Codec of the stored content, looked up when False
+        :param parts: Attachments stored apart, looked up when False
+        """
+        file_p = self.open_email(codec, parts)
+        if file_p is None:
+            return ''
+        with file_p:
+            if offset:
+                file_p.seek(offset)
+            if length is None:
+                return file_p.read()
+            return file_p.read(length)
+
+    def iter_email(self, chunk_size=65536, codec=False):
+        """
+        Yields the stored email in chunks
+
+        :param chunk_size: Maximum size of the chunks
+        :param codec: Codec of the stored content, looked up when False
+        """
+        file_p = self.open_email(codec)
+        if file_p is None:
+            return
+        with file_p:
+            while True:
+                data = file_p.read(chunk_size)
+                if not data:
+                    break
+                yield data
+
+    def _get_email_headers(self, codec=False):
+        """
+        Returns the header section of the stored email. Only the lines up
+        to the blank line separating it from the body are read.
+        """
+        if self.raw_headers:
+            return self.raw_headers
+        file_p = self.open_email(codec)
+        if file_p is None:
+            return u''
+        lines = []
+        with file_p:
+            for line in iter(file_p.readline, ''):
+                if line in ('\n', '\r\n'):
+                    break
+                lines.append(line)
+        return unicode(''.join(lines), 'utf-8', 'replace')
+
+    def _cache_key(self):
+        "Returns the key of the stored email in the content cache"
+        return (Transaction().cursor.dbname, self.digest, self.collision or 0)
+
+    def _get_email(self, codec=False):
+        """
+        Returns the email object from the storage or the content cache
+
+        :param codec: Codec of the stored content, looked up when False
+        """
+        if not self.digest:
+            return u''
+        key = self._cache_key()
+        value = CACHE.get('data', key)
+        if value is None:
+            with INSTRUMENTATION.stage('read'):
+                value = self.read_email(codec=codec)
+            if value:
+                CACHE.set('data', key, value, len(value))
+        return value or u''
+
+    def get_message(self, codec=False):
+        """
+        Returns the parsed email.message of the stored email or None. It is
+        shared through the content cache so it must not be modified.
+
+        :param codec: Codec of the stored content, looked up when False
+        """
+        if not self.digest:
+            return None
+        key = self._cache_key()
+        message = CACHE.get('message', key)
+        if message is None:
+            data = self._get_email(codec)
+            if not data:
+                return None
+            message = message_from_string(data)
+            CACHE.set('message', key, message, len(data))
+        return message
+
+    @classmethod
+    def get_cache_stats(cls):
+        """
+        Returns the statistics of the content cache of the process: the
+        number of entries, the cached size, the maximum size and the hits
+        and misses of the contents (data) and parsed messages (message)
+        """
+        return CACHE.stats()
+
+    @classmethod
+    def get_instrumentation_stats(cls):
+        """
+        Returns the latency histograms and the counters of the storage and
+        the ingestion of the process as Instrumentation.stats
+        """
+        return INSTRUMENTATION.stats()
 
     @classmethod
     def get_email(cls, mails, name):
         """Fetches email from the data_path as email object
         """
+        Content = Pool().get('electronic_mail.content')
+        codecs = Content.get_codecs([m.digest for m in mails if m.digest])
         result = { }
         for mail in mails:
             result[mail.id] = base64.encodestring(
-                mail._get_email()
+                mail._get_email(codecs.get(mail._content_digest()))
                 ) or False
         return result
 
+    @classmethod
+    def get_email_headers(cls, mails, name):
+        Content = Pool().get('electronic_mail.content')
+        codecs = Content.get_codecs([m.digest for m in mails if m.digest])
+        return dict([(m.id,
+                    m._get_email_headers(codecs.get(m._content_digest())))
+                for m in mails])
+
+    @classmethod
+    def read_email_range(cls, mails, offset, length):
+        """
+        Returns a slice of the stored emails, encoded in base64, for the
+        clients which do not need the whole email
+
+        :param offset: Position of the first byte
+        :param length: Number of bytes
+        :return: Dictionary of the slice per mail ID
+        """
+        Content = Pool().get('electronic_mail.content')
+        # Check the read access rules
+        cls.read([m.id for m in mails], ['id'])
+        digests = [m.digest for m in mails if m.digest]
+        codecs = Content.get_codecs(digests)
+        parts = Content.get_parts(digests)
+        return dict([(m.id, base64.encodestring(
+                        m.read_email(offset, length,
+                            codecs.get(m._content_digest()),
+                            parts.get(m._content_digest()))))
+                for m in mails])
+
+    @classmethod
+    def iter_mbox(cls, mails, chunk_size=65536):
+        """
+        Yields the stored emails in the mbox format in chunks. The emails are
+        streamed from the storage, the lines starting with "From " are
+        quoted as in the mboxrd format.
+
+        :param mails: List of the mail records
+        :param chunk_size: Size from which a chunk is yielded
+        """
+        Content = Pool().get('electronic_mail.content')
+        digests = [m.digest for m in mails if m.digest]
+        codecs = Content.get_codecs(digests)
+        parts = Content.get_parts(digests)
+        chunk, size = [], 0
+        for mail in mails:
+            file_p = mail.open_email(codecs.get(mail._content_digest()),
+                parts.get(mail._content_digest()))
+            if file_p is None:
+                continue
+            addresses = parse_addresses(mail.from_)
+            line = mbox_from_line(addresses and addresses[0][1] or None,
+                mail.date or mail.create_date)
+            chunk.append(line)
+            size += len(line)
+            with file_p:
+                for line in iter(file_p.readline, ''):
+                    line = mbox_quote(line)
+                    chunk.append(line)
+                    size += len(line)
+                    if size >= chunk_size:
+                        yield ''.join(chunk)
+                        chunk, size = [], 0
+            # The messages are separated by a blank line
+            chunk.append(line.endswith('\n') and '\n' or '\n\n')
+            size += len(chunk[-1])
+        if chunk:
+            yield ''.join(chunk)
+
+    @classmethod
+    def get_changes(cls, domain=None, cursor=None, limit=500):
+        """
+        Returns the mails created or written after the cursor, the flags
+        set by set_flags included, in the order of their changes.
+
+        A transaction started before a cursor was returned but committed
+        after it dates its changes before the cursor. So the changes are
+        searched again from the changes window before the cursor, see
+        get_changes_window, and the cursor keeps the IDs of the mails
+        returned in it to skip them. Only the transactions running longer
+        than the window can be missed.
+
+        :param domain: Domain of the mails as a mailbox or a range of dates
+            or IDs, the read access rules are enforced as by search
+        :param cursor: The cursor returned by the previous call, from the
+            first change when None
+        :param limit: Maximum number of mails
+        :return: Tuple of the list of the IDs of the mails and the cursor
+            of the last one, the given cursor when there is none
+        """
+        db_cursor = Transaction().cursor
+        window = get_changes_window()
+        query, args = cls.search(domain or [], order=[], query_string=True)
+        stamp = 'COALESCE(write_date, create_date)'
+        where = 'id IN (' + query + ')'
+        position, seen = None, set()
+        if cursor:
+            try:
+                watermark, mail_id, seen = (cursor.split('/') + [''])[:3]
+                position = (datetime.strptime(watermark,
+                        '%Y-%m-%dT%H:%M:%S.%f'), int(mail_id))
+                seen = set(int(i) for i in seen.split(',') if i)
+            except (ValueError, AttributeError):
+                cls.raise_user_error('invalid_cursor', (cursor,))
+            where += ' AND ' + stamp + ' > %s'
+            args = args + [position[0] - window]
+        # The mails returned in the window are skipped
+        db_cursor.execute(db_cursor.limit_clause(
+                'SELECT id, ' + stamp + ' FROM "' + cls._table + '" '
+                'WHERE ' + where + ' '
+                'ORDER BY ' + stamp + ', id', limit + len(seen)), args)
+        rows = [(cls._parse_stamp(s), i) for i, s in db_cursor.fetchall()]
+        returned = []
+        for row in rows:
+            if len(returned) >= limit:
+                break
+            if position and row <= position and row[1] in seen:
+                continue
+            returned.append(row)
+        if not returned:
+            return [], cursor
+        if not position or returned[-1] > position:
+            position = returned[-1]
+        fetched = dict((i, s) for s, i in rows)
+        seen = sorted(i for i in seen | set(i for _, i in returned)
+            if i not in fetched or fetched[i] > position[0] - window)
+        return ([i for _, i in returned], '%s/%s/%s' % (
+                position[0].strftime('%Y-%m-%dT%H:%M:%S.%f'), position[1],
+                ','.join(str(i) for i in seen)))
+
+    @staticmethod
+    def _parse_stamp(value):
+        "Returns the datetime of a timestamp computed by the database"
+        if value is None or isinstance(value, datetime):
+            return value
+        # The type of the expression is unknown to SQLite
+        if '.' not in value:
+            value += '.0'
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+
+    @classmethod
+    def export_mbox(cls, path, domain=None, cursor=None, batch_size=500,
+            callback=None):
+        """
+        Appends to a mbox file the mails changed after the cursor as
+        returned by get_changes, so an export can be resumed or kept in
+        sync from the returned cursor
+
+        :param path: Path of the mbox file on the server
+        :param domain: Domain of the mails as in get_changes
+        :param cursor: The cursor returned by the previous export, from
+            the first change when None
+        :param batch_size: Number of mails read at once
+        :param callback: Function called with the cursor of the last mail
+            written once each batch is on the disk, to save it so an
+            interrupted export resumes after the batch
+        :return: The cursor of the last mail exported
+        """
+        with open(path, 'ab') as file_p:
+            while True:
+                mail_ids, cursor = cls.get_changes(domain, cursor, batch_size)
+                if not mail_ids:
+                    return cursor
+                for chunk in cls.iter_mbox(cls.browse(mail_ids)):
+                    file_p.write(chunk)
+                if callback:
+                    file_p.flush()
+                    os.fsync(file_p.fileno())
+                    callback(cursor)
+
     @classmethod
     def set_email(cls, mails, name, data):
         """Saves an email to the data path
 
         :param data: Email as string
         """
+        Attachment = Pool().get('electronic_mail.attachment')
         if data is False or data is None:
             return
-        db_name = Transaction().cursor.dbname
-        # Prepare Directory <DATA PATH>/<DB NAME>/email
-        directory = os.path.join(CONFIG['data_path'], db_name)
-        if not os.path.isdir(directory):
-            os.makedirs(directory, 0770)
-        digest = cls.make_digest(data)
-        directory = os.path.join(directory, 'email', digest[0:2])
-        if not os.path.isdir(directory):
-            os.makedirs(directory, 0770)
-        # Filename <DIRECTORY>/<DIGEST>
-        filename = os.path.join(directory, digest)
-        collision = 0
-
-        if not os.path.isfile(filename):
-            # File doesnt exist already
-            with open(filename, 'w') as file_p:
-                file_p.write(data)
-        else:
-            # File already exists, may be its the same email data
-            # or maybe different. 
+        with INSTRUMENTATION.stage('prepare'):
+            content, attachments = cls.prepare_data(data, get_codec())
+        writer = get_write_behind()
+        try:
+            digest, = cls._store_contents([content], writer)
+            cls.write(mails, {
+                    'digest': digest,
+                    'collision': 0,
+                    'size': len(data),
+                    })
+        except Exception:
+            if writer:
+                writer.abort()
+            raise
+        if writer:
+            with INSTRUMENTATION.stage('storage_join'):
+                writer.join()
+        Attachment.delete(Attachment.search([
+                    ('mail', 'in', [m.id for m in mails]),
+                    ]))
+        Attachment.create([dict(a, mail=m.id)
+                for m in mails for a in attachments])
+        if has_index():
+            body = extract_text(message_from_string(data))
+            cls._index_texts(mails, [body] * len(mails))
 
-            # Case 1: If different: we have to write file with updated
-            # Collission index
+    @classmethod
+    def _store_email(cls, data):
+        """Stores the email data unless it is already stored
 
-            # Case 2: Same file: Leave it as such
-            with open(filename, 'r') as file_p:
-                data2 = file_p.read()
-            if data != data2:
-                cursor = Transaction().cursor
-                cursor.execute(
-                    'SELECT DISTINCT(collision) FROM electronic_mail '
-                    'WHERE digest = %s AND collision !=0 '
-                    'ORDER BY collision', (digest,))
-                collision2 = 0
-                for row in cursor.fetchall():
-                    collision2 = row[0]
-                    filename = os.path.join(
-                        directory, digest + '-' + str(collision2))
-                    if os.path.isfile(filename):
-                        with open(filename, 'r') as file_p:
-                            data2 = file_p.read()
-                        if data == data2:
-                            collision = collision2
-                            break
-                if collision == 0:
-                    collision = collision2 + 1
-                    filename = os.path.join(
-                        directory, digest + '-' + str(collision))
-                    with open(filename, 'w') as file_p:
-                        file_p.write(data)
-        cls.write(mails, {'digest': digest, 'collision': collision})
+        :param data: Email as string
+        :return: Digest of the data
+        """
+        return cls._store_emails([data])[0]
+
+    @classmethod
+    def _store_emails(cls, datas):
+        """Stores the emails data unless they are already stored
+
+        :param datas: List of emails as string
+        :return: List of the digests of the datas
+        """
+        codec = get_codec()
+        return cls._store_contents([{
+                    'digest': cls.make_digest(data),
+                    'length': len(data),
+                    'codec': codec,
+                    'content': encode(data, codec),
+                    } for data in datas])
+
+    @classmethod
+    def _store_contents(cls, contents, writer=None):
+        """Stores the encoded contents unless they are already stored. The
+        contents are addressed by their SHA-256 digest so a duplicate is
+        detected from the digest and size recorded in
+        electronic_mail.content without opening the stored content. The
+        email_paranoid_dedup option compares the bytes of duplicates too.
+
+        :param contents: List of dictionaries with the digest, the length
+            and the codec of the data and the content encoded by the codec.
+            The contents whose attachments are stored apart have the
+            positions of the attachments as parts and their contents.
+        :param writer: The WriteBehind writing the new contents, they are
+            written before returning when None
+        :return: List of the digests of the contents
+        """
+        Content = Pool().get('electronic_mail.content')
+        storage = get_storage()
+        paranoid = CONFIG.get('email_paranoid_dedup')
+        digests = [c['digest'] for c in contents]
+        with INSTRUMENTATION.stage('content_lookup'):
+            sizes = Content.get_sizes(digests)
+            # The duplicates of contents marked by the garbage collector
+            # are revived, the ones collected meanwhile are stored again
+            revived = Content.revive([d for d in digests if d in sizes])
+            if revived is not None:
+                sizes = Content.get_sizes(digests)
+        revived = revived or {}
+        INSTRUMENTATION.count('dedup_queries')
+        codecs = paranoid and Content.get_codecs(digests) or {}
+        to_create = []
+        for content in contents:
+            digest, length = content['digest'], content['length']
+            size = sizes.get(digest)
+            INSTRUMENTATION.count(size is None and 'dedup_misses'
+                or 'dedup_hits')
+            if size is None:
+                name = content_name(digest, content['codec'])
+                if content.get('contents'):
+                    # The attachments are stored before the content which
+                    # references them
+                    cls._store_contents(content['contents'], writer)
+                # The content may be stored without its record from a
+                # rolled back transaction, it is written again so the
+                # garbage collector finds a recent file
+                with INSTRUMENTATION.stage('storage_write'):
+                    (writer or storage).set(name, content['content'])
+                sizes[digest] = length
+                codecs[digest] = content['codec']
+                to_create.append({
+                        'digest': digest,
+                        'size': length,
+                        'codec': content['codec'],
+                        'parts': (content.get('parts')
+                            and json.dumps(content['parts']) or None),
+                        })
+            elif (size != length
+                    or (paranoid and cls._read_content(digest,
+                            codecs[digest])
+                        != decode(content['content'], content['codec']))):
+                cls.raise_user_error('digest_mismatch', (digest,))
+            elif digest in revived:
+                codec, pack_id = revived.pop(digest)
+                if content.get('contents'):
+                    cls._store_contents(content['contents'], writer)
+                # The stored file may have been removed by a collection
+                # rolled back after it
+                name = content_name(digest, codec)
+                if not pack_id and not storage.exists(name):
+                    storage.set(name,
+                        encode(decode(content['content'], content['codec']),
+                            codec))
+        if to_create:
+            with INSTRUMENTATION.stage('content_create'):
+                Content.create_contents(to_create)
+        return digests
+
+    @classmethod
+    def _read_content(cls, digest, codec):
+        "Returns the stored content of the digest without its attachments"
+        Content = Pool().get('electronic_mail.content')
+        file_p = Content.open_content(digest, codec)
+        if file_p is None:
+            return None
+        with file_p:
+            return file_p.read()
 
     @classmethod
     def make_digest(cls, data):
@@ -251,23 +1467,36 @@ class ElectronicMail(ModelSQL, ModelView):
         :param data: Data String
         :return: Digest
         """
-        if hashlib:
-            digest = hashlib.md5(data).hexdigest()
-        else:
-            digest = md5.new(data).hexdigest()
-        return digest
+        INSTRUMENTATION.count('bytes_hashed', len(data))
+        with INSTRUMENTATION.stage('hash'):
+            return hashlib.sha256(data).hexdigest()
 
     @classmethod
-    def create_from_email(cls, mail, mailbox):
+    def get_values_from_email(cls, mail, mailbox):
         """
-        Creates a mail record from a given mail
+        Returns the values to create a mail record from a given mail.
+        The email content itself is not included.
+
         :param mail: email object
         :param mailbox: ID of the mailbox
         """
-        Header = Pool().get('electronic_mail.header')
-        email_date = mail.get('date') and datetime.fromtimestamp(
-                mktime(parsedate(mail.get('date'))))
-        values = {
+        # The dates are stored in UTC, the date of the delivery stands for
+        # a missing or malformed one
+        email_date = parse_date(mail.get('date')) or received_date(mail)
+        values = dict((column, mail.get(name))
+            for name, column in PROMOTED_HEADERS)
+        spam_score = mail.get('x-spam-score')
+        if not spam_score and values['spam_status']:
+            match = SPAM_SCORE.search(values['spam_status'])
+            spam_score = match and match.group(1)
+        try:
+            values['spam_score'] = spam_score and float(spam_score) or None
+        except ValueError:
+            values['spam_score'] = None
+        if get_header_storage() == 'compact':
+            values['raw_headers'] = unicode(''.join('%s: %s\n' % item
+                    for item in mail.items()), 'utf-8', 'replace')
+        values.update({
             'mailbox': mailbox,
             'from_': mail.get('from'),
             'sender': mail.get('sender'),
@@ -278,34 +1507,1472 @@ class ElectronicMail(ModelSQL, ModelView):
             'date': email_date,
             'message_id': mail.get('message-id'),
             'in_reply_to': mail.get('in-reply-to'),
-            'email': mail.as_string(),
-            'size': getsizeof(mail.as_string()),
-            }
-        mail_created = cls.create([values])[0]
-        Header.create_from_email(mail, mail_created.id)
-        return mail_created
+            })
+        return values
+
+    @classmethod
+    def create_from_email(cls, mail, mailbox):
+        """
+        Creates a mail record from a given mail
+        :param mail: email object
+        :param mailbox: ID of the mailbox
+        """
+        return cls.create_from_emails([mail], mailbox)[0]
+
+    @classmethod
+    def prepare_email(cls, mail, codec):
+        """
+        Returns the values to store a given mail: it is serialized, hashed
+        and encoded by the codec and the values of its record, its headers
+        and its text are extracted. It does not access the database so it
+        can run in another process.
+
+        :param mail: email object
+        :param codec: Codec of the stored content
+        :return: Dictionary with the content of the stored email as
+            returned by prepare_data, the values of the record without
+            mailbox, the values of its attachments, the header items and
+            the text to index
+        """
+        with INSTRUMENTATION.stage('prepare'):
+            with INSTRUMENTATION.stage('serialize'):
+                data = mail.as_string()
+            values = cls.get_values_from_email(mail, None)
+            # The octet count of the stored message
+            values['size'] = len(data)
+            prepared, attachments = cls.prepare_data(data, codec)
+            with INSTRUMENTATION.stage('extract_text'):
+                text = has_index() and extract_text(mail) or None
+            prepared.update({
+                    'values': values,
+                    'attachments': attachments,
+                    'headers': mail.items(),
+                    'text': text,
+                    })
+            return prepared
+
+    @classmethod
+    def prepare_data(cls, data, codec):
+        """
+        Returns the content to store for the serialized email and the values
+        of its attachments. The bodies of the attachments from
+        get_attachment_min_size are cut out of the email and stored apart
+        under their own digest so they are stored once whatever the number
+        of emails carrying them.
+
+        :param data: Email as string
+        :param codec: Codec of the stored contents
+        :return: Tuple of the dictionary of the content for _store_contents
+            and of the list of the values of the attachments without mail
+        """
+        min_size = get_attachment_min_size()
+        attachments, parts, contents, skeleton = [], [], [], []
+        position = 0
+        for headers, start, end in iter_parts(data):
+            if not is_attachment(headers) or start >= end:
+                continue
+            body = data[start:end]
+            encoding = headers.get('Content-Transfer-Encoding')
+            encoding = encoding and encoding.strip().lower() or None
+            filename = headers.get_filename()
+            if isinstance(filename, str):
+                filename = decode_header_text(filename)
+            digest = cls.make_digest(body)
+            attachments.append({
+                    'filename': filename,
+                    'content_type': headers.get_content_type(),
+                    'encoding': encoding,
+                    'size': len(decode_body(body, encoding)),
+                    'digest': digest,
+                    'start': start,
+                    'end': end,
+                    })
+            if len(body) >= min_size:
+                parts.append([start, end, digest])
+                contents.append({
+                        'digest': digest,
+                        'length': len(body),
+                        'codec': codec,
+                        'content': cls._encode(body, codec),
+                        })
+                skeleton.append(data[position:start])
+                position = end
+        skeleton.append(data[position:])
+        return {
+            'digest': cls.make_digest(data),
+            'length': len(data),
+            'codec': codec,
+            'content': cls._encode(''.join(skeleton), codec),
+            'parts': parts,
+            'contents': contents,
+            }, attachments
+
+    @staticmethod
+    def _encode(data, codec):
+        "Encodes the data with the codec timing it"
+        with INSTRUMENTATION.stage('encode'):
+            return encode(data, codec)
+
+    @classmethod
+    def create_from_emails(cls, mails, mailbox):
+        """
+        Creates mail records from a list of mails. Each mail is serialized
+        once, its content is stored before the records are created and all
+        the records and headers are created with one call each.
+
+        :param mails: list of email objects
+        :param mailbox: ID of the mailbox
+        :return: list of the created mail records in the order of mails
+        """
+        codec = get_codec()
+        return cls.create_from_prepared(
+            [cls.prepare_email(mail, codec) for mail in mails], mailbox)
+
+    @classmethod
+    def create_from_prepared(cls, prepared, mailbox):
+        """
+        Creates mail records from the values returned by prepare_email
+
+        :param prepared: list of the dictionaries returned by prepare_email
+        :param mailbox: ID of the mailbox
+        :return: list of the created mail records in the order of prepared
+        """
+        stage = INSTRUMENTATION.stage
+        writer = get_write_behind()
+        with stage('create_from_prepared'), \
+                INSTRUMENTATION.count_statements(Transaction().cursor):
+            try:
+                mails_created = cls._create_from_prepared(prepared, mailbox,
+                    writer)
+            except Exception:
+                if writer:
+                    writer.abort()
+                raise
+            if writer:
+                # The files are published before the records are committed
+                with stage('storage_join'):
+                    writer.join()
+        INSTRUMENTATION.count('mails_created', len(mails_created))
+        return mails_created
+
+    @classmethod
+    def _create_from_prepared(cls, prepared, mailbox, writer=None):
+        "Creates the mail records, the new contents are written by writer"
+        pool = Pool()
+        Header = pool.get('electronic_mail.header')
+        Thread = pool.get('electronic_mail.thread')
+        Attachment = pool.get('electronic_mail.attachment')
+        stage = INSTRUMENTATION.stage
+        vlist = []
+        with stage('store'):
+            digests = cls._store_contents(prepared, writer)
+        for values, digest in zip(prepared, digests):
+            values = values['values'].copy()
+            values.update({
+                'mailbox': mailbox,
+                'digest': digest,
+                'collision': 0,
+                })
+            vlist.append(values)
+        with stage('create'):
+            mails_created = cls.create(vlist)
+        mail_ids = [m.id for m in mails_created]
+        with stage('attachments'):
+            Attachment.create([dict(a, mail=mail_id)
+                    for p, mail_id in zip(prepared, mail_ids)
+                    for a in p.get('attachments', [])])
+        with stage('headers'):
+            Header.create_from_items([p['headers'] for p in prepared],
+                mail_ids)
+        with stage('threads'):
+            Thread.add_mails(mail_ids)
+        with stage('index'):
+            cls._index_texts(mails_created,
+                [p['text'] for p in prepared])
+        return mails_created
+
+    @classmethod
+    def copy(cls, mails, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        # The addresses are created from the address columns
+        default.setdefault('addresses', None)
+        return super(ElectronicMail, cls).copy(mails, default=default)
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Mailbox = pool.get('electronic_mail.mailbox')
+        Address = pool.get('electronic_mail.address')
+        vlist = [x.copy() for x in vlist]
+        mailbox_vlist = {}
+        for values in vlist:
+            if values.get('mailbox'):
+                mailbox_vlist.setdefault(int(values['mailbox']), []
+                    ).append(values)
+        for mailbox_id, mailbox_values in mailbox_vlist.iteritems():
+            uids = Mailbox.allocate_uids(mailbox_id, len(mailbox_values))
+            for values, uid in zip(mailbox_values, uids):
+                values['uid'] = uid
+        mails = super(ElectronicMail, cls).create(vlist)
+        Mailbox.update_counters({},
+            Mailbox.count_mails([m.id for m in mails]))
+        Address.create([dict(a, mail=m.id)
+                for m, values in zip(mails, vlist)
+                for a in Address.get_values(values)])
+        return mails
+
+    @classmethod
+    def write(cls, mails, values):
+        pool = Pool()
+        Mailbox = pool.get('electronic_mail.mailbox')
+        Address = pool.get('electronic_mail.address')
+        values = values.copy()
+        values.pop('uid', None)
+        if set(values) & set(c for _, c in ADDRESS_ROLES):
+            Address.delete(Address.search([
+                        ('mail', 'in', [m.id for m in mails]),
+                        ]))
+            Address.create([dict(a, mail=m.id) for m in mails
+                    for a in Address.get_values(dict(
+                            (c, values.get(c, getattr(m, c)))
+                            for _, c in ADDRESS_ROLES))])
+        mail_ids = [m.id for m in mails]
+        if not set(values) & set(COUNTED_FIELDS):
+            super(ElectronicMail, cls).write(mails, values)
+        else:
+            moved = []
+            if values.get('mailbox'):
+                mailbox_id = int(values['mailbox'])
+                moved = sorted((m.uid, m.id) for m in mails
+                    if m.mailbox.id != mailbox_id)
+            previous = Mailbox.count_mails(mail_ids)
+            super(ElectronicMail, cls).write(mails, values)
+            Mailbox.update_counters(previous, Mailbox.count_mails(mail_ids))
+            if moved:
+                # The mails moved get new UIDs in their mailbox
+                cursor = Transaction().cursor
+                uids = Mailbox.allocate_uids(mailbox_id, len(moved))
+                for (_, mail_id), uid in zip(moved, uids):
+                    cursor.execute('UPDATE "' + cls._table + '" '
+                        'SET uid = %s WHERE id = %s', (uid, mail_id))
+                cls._invalidate([m for _, m in moved])
+        # The title of the full-text index is made of these columns, the
+        # emails written are indexed by set_email
+        if (has_index() and 'email' not in values
+                and set(values) & set(['subject', 'from_', 'to', 'cc'])):
+            cls.index_texts(cls.browse(mail_ids))
+
+    @classmethod
+    def set_flags(cls, mailbox, uid_range, add=None, remove=None):
+        """
+        Adds and removes system flags of the mails of a range of UIDs of
+        the mailbox with one UPDATE. The write access to the model and the
+        write rules of the mails are enforced as by write.
+
+        :param mailbox: ID of the mailbox
+        :param uid_range: IMAP sequence set of the UIDs as '1:4,7,10:*'
+        :param add: List of the flags to add as 'seen' or '\\Seen'
+        :param remove: List of the flags to remove
+        :return: List of the IDs of the mails updated
+        """
+        pool = Pool()
+        Mailbox = pool.get('electronic_mail.mailbox')
+        ModelAccess = pool.get('ir.model.access')
+        Rule = pool.get('ir.rule')
+        cursor = Transaction().cursor
+
+        ModelAccess.check(cls.__name__, 'write')
+        columns = {}
+        for flags, value in ((add or [], True), (remove or [], False)):
+            for flag in flags:
+                column = FLAGS.get(flag.lstrip('\\').lower())
+                if not column:
+                    cls.raise_user_error('invalid_flag', flag)
+                columns[column] = value
+        if not columns:
+            return []
+
+        cursor.execute('SELECT uid_next FROM "' + Mailbox._table + '" '
+            'WHERE id = %s', (mailbox,))
+        row = cursor.fetchone()
+        largest = row and (row[0] or 1) - 1 or 0
+        try:
+            ranges = parse_sequence_set(uid_range, largest)
+        except ValueError:
+            cls.raise_user_error('invalid_uid_range', uid_range)
+        where = ('mailbox = %s AND ('
+            + ' OR '.join(('uid BETWEEN %s AND %s',) * len(ranges)) + ')')
+        args = [mailbox] + [uid for range_ in ranges for uid in range_]
+
+        domain1, domain2 = Rule.domain_get(cls.__name__, mode='write')
+        if domain1:
+            cursor.execute('SELECT COUNT(id) FROM "' + cls._table + '" '
+                'WHERE ' + where + ' AND NOT (' + domain1 + ')',
+                args + domain2)
+            if cursor.fetchone()[0]:
+                cls.raise_user_error('access_error', cls.__name__)
+
+        cursor.execute('SELECT id FROM "' + cls._table + '" '
+            'WHERE ' + where, args)
+        mail_ids = [r[0] for r in cursor.fetchall()]
+        if not mail_ids:
+            return []
+        counted = set(columns) & set(COUNTED_FIELDS)
+        if counted:
+            previous = Mailbox.count_mails(mail_ids)
+        cursor.execute('UPDATE "' + cls._table + '" SET '
+            + ', '.join('%s = %%s' % c for c in columns) + ', '
+            'write_uid = %s, write_date = %s '
+            'WHERE ' + where,
+            columns.values() + [Transaction().user, datetime.now()] + args)
+        if counted:
+            Mailbox.update_counters(previous, Mailbox.count_mails(mail_ids))
+        cls._invalidate(mail_ids)
+        return mail_ids
+
+    @staticmethod
+    def _invalidate(ids):
+        """
+        Clears the cached values of the mails updated by SQL as
+        ModelStorage.write does
+        """
+        transaction = Transaction()
+        transaction.counter += 1
+        for cache in transaction.cursor.cache.itervalues():
+            records = cache.get('electronic_mail')
+            if records:
+                for id_ in ids:
+                    records.pop(id_, None)
+
+    @classmethod
+    def delete(cls, mails):
+        pool = Pool()
+        Mailbox = pool.get('electronic_mail.mailbox')
+        Thread = pool.get('electronic_mail.thread')
+        thread_ids = list(set(m.thread.id for m in mails if m.thread))
+        mail_ids = [m.id for m in mails]
+        previous = Mailbox.count_mails(mail_ids)
+        super(ElectronicMail, cls).delete(mails)
+        Mailbox.update_counters(previous, {})
+        Thread.update_threads(thread_ids)
+        index = get_index()
+        if index:
+            index.delete(mail_ids)
+
+    @classmethod
+    def get_search_text(cls, mails, name):
+        # The indexed text is only searched
+        return dict((m.id, None) for m in mails)
+
+    @classmethod
+    def search_search_text(cls, name, clause):
+        """
+        Returns the mails matching all the words of the text in the
+        full-text index or, when the database backend has none, in their
+        subject and addresses
+        """
+        text = clause[2] or ''
+        index = get_index()
+        if not index:
+            domain = []
+            for word in text.split():
+                domain.append(['OR',
+                        ('subject', 'ilike', '%' + word + '%'),
+                        ('from_', 'ilike', '%' + word + '%'),
+                        ('to', 'ilike', '%' + word + '%'),
+                        ])
+            return domain
+        if not fold(text).split():
+            return []
+        return [('id', 'inselect', index.search(text))]
+
+    @classmethod
+    def _index_texts(cls, mails, bodies):
+        """
+        Indexes the subject, the addresses and the text parts of the mails
+
+        :param mails: List of the mail records
+        :param bodies: List of the text extracted from each mail or None
+        """
+        index = get_index()
+        if not index:
+            return
+        values = []
+        for mail, body in zip(mails, bodies):
+            title = fold(u' '.join(decode_header_text(v) for v in (
+                        mail.subject, mail.from_, mail.to, mail.cc) if v))
+            values.append((mail.id, title, body or u''))
+        index.set(values)
+
+    @classmethod
+    def index_texts(cls, mails):
+        "Indexes the text of the stored emails of the mails"
+        messages = [m.get_message() for m in mails]
+        cls._index_texts(mails, [m is not None and extract_text(m) or None
+                for m in messages])
+
+    @classmethod
+    def update_text_index(cls, batch_size=100, commit=True):
+        """
+        Indexes by batches the mails missing from the full-text index
+
+        :param batch_size: Number of mails indexed at once
+        :param commit: Commit the transaction after each batch
+        :return: Number of mails indexed
+        """
+        cursor = Transaction().cursor
+        logger = logging.getLogger('electronic_mail')
+        index = get_index()
+        if not index:
+            return 0
+        count = 0
+        while True:
+            cursor.execute('SELECT id FROM "' + cls._table + '" '
+                'WHERE id NOT IN (' + index.indexed() + ') '
+                'ORDER BY id LIMIT %s', (batch_size,))
+            mail_ids = [r[0] for r in cursor.fetchall()]
+            if not mail_ids:
+                break
+            with Transaction().set_user(0):
+                cls.index_texts(cls.browse(mail_ids))
+            count += len(mail_ids)
+            if commit:
+                cursor.commit()
+            logger.info('%s mails indexed', count)
+        return count
+
+    @classmethod
+    def rebuild_text_index(cls, batch_size=100, commit=True):
+        """
+        Indexes again all the mails, after a change of the text extraction
+        or of the text search configuration
+
+        :return: Number of mails indexed
+        """
+        index = get_index()
+        if not index:
+            return 0
+        index.clear()
+        return cls.update_text_index(batch_size=batch_size, commit=commit)
+
+    @classmethod
+    def update_sizes(cls, batch_size=100, commit=True):
+        """
+        Sets the size of the mails to the octet count of their stored
+        content. It is copied from the content records with one query and
+        the contents stored before them are measured by streaming their
+        files by batches. The content records of these are then created so
+        they are measured once, the mails of the MD5 collisions and of the
+        missing files are marked as measured instead.
+
+        Migration from 2.8.1: the mails stored before the content records are
+        measured by the Update E-mail Sizes cron which runs once after the
+        update of the module, it commits after each batch so the update does
+        not stream every stored content in one transaction.
+
+        :param batch_size: Number of mails measured at once
+        :param commit: Commit the transaction after each batch
+        :return: Number of mails updated
+        """
+        pool = Pool()
+        Content = pool.get('electronic_mail.content')
+        Mailbox = pool.get('electronic_mail.mailbox')
+        cursor = Transaction().cursor
+        logger = logging.getLogger('electronic_mail')
+
+        content_size = ('(SELECT c.size FROM "' + Content._table + '" AS c '
+            'WHERE c.digest = "' + cls._table + '".digest)')
+        where = ('collision = 0 '
+            'AND digest IN (SELECT digest FROM "' + Content._table + '") '
+            'AND (size IS NULL OR size != ' + content_size + ')')
+        cursor.execute('SELECT DISTINCT mailbox FROM "' + cls._table + '" '
+            'WHERE ' + where)
+        mailbox_ids = [r[0] for r in cursor.fetchall()]
+        cursor.execute('SELECT COUNT(id) FROM "' + cls._table + '" '
+            'WHERE ' + where)
+        count, = cursor.fetchone()
+        if count:
+            cursor.execute('UPDATE "' + cls._table + '" '
+                'SET size = ' + content_size + ' WHERE ' + where)
+            Mailbox.reconcile_counters(mailbox_ids)
+            if commit:
+                cursor.commit()
+
+        last_id = 0
+        while True:
+            cursor.execute('SELECT id, mailbox, digest, collision, size '
+                'FROM "' + cls._table + '" '
+                'WHERE id > %s AND digest IS NOT NULL '
+                    'AND (size_measured IS NULL OR size_measured = %s) '
+                    'AND (collision != 0 OR digest NOT IN ('
+                        'SELECT digest FROM "' + Content._table + '")) '
+                'ORDER BY id LIMIT %s', (last_id, False, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            mailbox_ids = set()
+            contents = {}
+            measured_ids = []
+            for mail_id, mailbox_id, digest, collision, size in rows:
+                # The contents stored before the records are not compressed
+                with Transaction().set_user(0):
+                    file_p = cls(mail_id).open_email(codec=None)
+                if file_p is None:
+                    measured_ids.append(mail_id)
+                    continue
+                length = 0
+                with file_p:
+                    while True:
+                        data = file_p.read(65536)
+                        if not data:
+                            break
+                        length += len(data)
+                if length != size:
+                    cursor.execute('UPDATE "' + cls._table + '" '
+                        'SET size = %s WHERE id = %s', (length, mail_id))
+                    mailbox_ids.add(mailbox_id)
+                    count += 1
+                if not collision:
+                    contents[digest] = {
+                        'digest': digest,
+                        'size': length,
+                        'codec': None,
+                        }
+                else:
+                    measured_ids.append(mail_id)
+            for i in range(0, len(measured_ids), cursor.IN_MAX):
+                red_sql, red_ids = reduce_ids('id',
+                    measured_ids[i:i + cursor.IN_MAX])
+                cursor.execute('UPDATE "' + cls._table + '" '
+                    'SET size_measured = %s WHERE ' + red_sql,
+                    [True] + red_ids)
+            if contents:
+                with Transaction().set_user(0):
+                    Content.create(contents.values())
+            cls._invalidate([r[0] for r in rows])
+            Mailbox.reconcile_counters(list(mailbox_ids))
+            if commit:
+                cursor.commit()
+            logger.info('%s mail sizes updated', count)
+        return count
+
+
+class Pack(ModelSQL):
+    """
+    E-mail Pack
+
+    A stored file holding the contents of the archived emails, see
+    Content.pack_contents for its format.
+    """
+    __name__ = 'electronic_mail.pack'
+
+    name = fields.Char('Name', required=True, select=1)
+    size = fields.BigInteger('Size', help='Size of the pack file in bytes')
+
+
+class Content(ModelSQL):
+    "E-mail Content"
+    __name__ = 'electronic_mail.content'
+
+    digest = fields.Char('Digest', size=64, required=True, select=1)
+    size = fields.Integer('Size', required=True,
+        help='Size of the content in bytes')
+    codec = fields.Char('Codec', help='Compression of the stored content')
+    parts = fields.Text('Parts',
+        help='Positions and digests of the attachments stored apart')
+    orphaned = fields.DateTime('Orphaned',
+        help='When the garbage collector found the content unreferenced')
+    pack = fields.Many2One('electronic_mail.pack', 'Pack', select=1,
+        ondelete='RESTRICT', help='Pack file holding the archived content')
+    pack_offset = fields.BigInteger('Pack Offset')
+    pack_length = fields.Integer('Pack Length',
+        help='Length of the stored content in the pack file')
+
+    @classmethod
+    def __setup__(cls):
+        super(Content, cls).__setup__()
+        cls._sql_constraints += [
+            ('digest_uniq', 'UNIQUE(digest)',
+                'A content can be stored only once.'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+
+        # Migration: the contents stored twice by concurrent transactions
+        # are removed before the digests are made unique
+        if (table.column_exist('digest')
+                and cls._table + '_digest_uniq' not in table._constraints):
+            cursor.execute('DELETE FROM "' + cls._table + '" '
+                'WHERE EXISTS (SELECT 1 FROM "' + cls._table + '" AS o '
+                    'WHERE o.digest = "' + cls._table + '".digest '
+                        'AND o.id < "' + cls._table + '".id)')
+
+        super(Content, cls).__register__(module_name)
+
+    @classmethod
+    def create_contents(cls, vlist):
+        """
+        Creates the content records. The records of the digests created
+        meanwhile by a concurrent transaction violate the unique constraint,
+        they are then skipped as the content is stored.
+
+        :param vlist: List of the values of the records
+        """
+        cursor = Transaction().cursor
+        if CONFIG['db_type'] == 'sqlite':
+            # The constraint is not added on SQLite which has a single writer
+            cls.create(vlist)
+            return
+        cursor.execute('SAVEPOINT content_create')
+        try:
+            cls.create(vlist)
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT content_create')
+            # The records of the concurrent transaction are committed, only
+            # a new transaction sees them
+            with Transaction().new_cursor():
+                stored = cls.get_sizes([v['digest'] for v in vlist])
+            if not stored:
+                raise
+            INSTRUMENTATION.count('dedup_conflicts', len(stored))
+            vlist = [v for v in vlist if v['digest'] not in stored]
+            if vlist:
+                cls.create_contents(vlist)
+        else:
+            cursor.execute('RELEASE SAVEPOINT content_create')
+
+    @classmethod
+    def _get_column(cls, digests, column):
+        """
+        Returns the values of the column of the contents of the digests
+
+        :param digests: List of digests
+        :param column: Name of the column
+        :return: Dictionary of the value per digest for the known digests
+        """
+        cursor = Transaction().cursor
+        digests = list(set(digests))
+        values = {}
+        for i in range(0, len(digests), cursor.IN_MAX):
+            sub_digests = digests[i:i + cursor.IN_MAX]
+            cursor.execute('SELECT digest, "' + column + '" '
+                'FROM "' + cls._table + '" '
+                'WHERE digest IN (' + ','.join(('%s',) * len(sub_digests))
+                + ')', sub_digests)
+            values.update(cursor.fetchall())
+        return values
+
+    @classmethod
+    def get_sizes(cls, digests):
+        """
+        Returns the size of the stored contents without reading them
+
+        :param digests: List of digests
+        :return: Dictionary of the size per digest for the known digests
+        """
+        return cls._get_column(digests, 'size')
+
+    @classmethod
+    def get_codecs(cls, digests):
+        """
+        Returns the codec of the stored contents
+
+        :param digests: List of digests
+        :return: Dictionary of the codec per digest for the known digests
+        """
+        return cls._get_column(digests, 'codec')
+
+    @classmethod
+    def get_parts(cls, digests):
+        """
+        Returns the attachments stored apart from the contents
+
+        :param digests: List of digests
+        :return: Dictionary of the list of the start and end positions and
+            of the digest of the attachments per digest of the contents
+            having some
+        """
+        return dict((d, json.loads(p))
+            for d, p in cls._get_column(digests, 'parts').iteritems() if p)
+
+    @classmethod
+    def open_content(cls, name, codec, parts=None):
+        """
+        Returns a file-like object reading the content stored under the
+        name or None. The attachments stored apart are read in turn with the
+        stored content.
+
+        :param name: Name of the content without codec
+        :param codec: Codec of the stored content
+        :param parts: Attachments stored apart as returned by get_parts
+        """
+        storage = get_storage()
+        file_p = storage.open(content_name(name, codec))
+        if file_p is None:
+            file_p = cls.open_packed(name)
+        file_p = decode_file(file_p, codec)
+        if file_p is None or not parts:
+            return file_p
+        digests = [p[2] for p in parts]
+        codecs = cls.get_codecs(digests)
+        sub_parts = cls.get_parts(digests)
+
+        def opener(digest):
+            return lambda: cls.open_content(digest, codecs.get(digest),
+                sub_parts.get(digest))
+        return SplicedFile(file_p,
+            [(start, end, opener(digest)) for start, end, digest in parts])
+
+    @classmethod
+    def open_packed(cls, digest):
+        """
+        Returns a file-like object reading the stored content of the digest
+        from its pack file or None when it is not packed
+        """
+        Pack = Pool().get('electronic_mail.pack')
+        cursor = Transaction().cursor
+        cursor.execute('SELECT p.name, c.pack_offset, c.pack_length '
+            'FROM "' + cls._table + '" AS c '
+                'JOIN "' + Pack._table + '" AS p ON p.id = c.pack '
+            'WHERE c.digest = %s', (digest,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return get_storage().open_slice(*row)
+
+    @classmethod
+    def pack_contents(cls, digests):
+        """
+        Moves the stored contents of the digests and of their attachments
+        stored apart into a new pack file. A pack file is the concatenation
+        of the stored contents followed by its index and by the length of
+        the index as an 8 bytes big-endian integer, so it can be read
+        without the records. The index is the JSON list of the digest, the
+        codec, the offset and the length of each content. The contents
+        already packed are skipped.
+
+        :param digests: List of digests
+        :return: List of the names of the stored files packed, to remove
+            once the transaction is committed
+        """
+        Pack = Pool().get('electronic_mail.pack')
+        cursor = Transaction().cursor
+        storage = get_storage()
+        rows = {}
+        digests = set(digests)
+        while digests:
+            digests = list(digests)
+            found = []
+            for i in range(0, len(digests), cursor.IN_MAX):
+                sub_digests = digests[i:i + cursor.IN_MAX]
+                cursor.execute('SELECT id, digest, codec, parts, pack '
+                    'FROM "' + cls._table + '" '
+                    'WHERE digest IN ('
+                        + ','.join(('%s',) * len(sub_digests)) + ')',
+                    sub_digests)
+                found.extend(cursor.fetchall())
+            digests = set()
+            for content_id, digest, codec, parts, pack_id in found:
+                rows[content_id] = (digest, codec, pack_id)
+                if parts:
+                    digests.update(p[2] for p in json.loads(parts))
+            digests -= set(r[0] for r in rows.itervalues())
+
+        datas, index, names = [], [], []
+        offset = 0
+        for content_id in sorted(rows):
+            digest, codec, pack_id = rows[content_id]
+            if pack_id:
+                continue
+            name = content_name(digest, codec)
+            data = storage.get(name)
+            if data is None:
+                continue
+            index.append((content_id, digest, codec, offset, len(data)))
+            datas.append(data)
+            names.append(name)
+            offset += len(data)
+        if not index:
+            return []
+        index_data = json.dumps([i[1:] for i in index])
+        datas.append(index_data)
+        datas.append(struct.pack('>Q', len(index_data)))
+        data = ''.join(datas)
+        name = hashlib.sha256(data).hexdigest() + '.pack'
+        storage.set(name, data)
+        pack, = Pack.create([{
+                    'name': name,
+                    'size': len(data),
+                    }])
+        for content_id, _, _, offset, length in index:
+            cursor.execute('UPDATE "' + cls._table + '" '
+                'SET pack = %s, pack_offset = %s, pack_length = %s '
+                'WHERE id = %s', (pack.id, offset, length, content_id))
+        return names
+
+    @classmethod
+    def revive(cls, digests):
+        """
+        Clears the orphaned mark of the contents of the digests so the
+        garbage collector keeps them. The update waits for a collection of
+        the contents in progress.
+
+        :param digests: List of digests
+        :return: None when no content is marked or else the dictionary of
+            the codec and the pack per digest of the marked contents which
+            are still stored
+        """
+        cursor = Transaction().cursor
+        orphaned = cls._get_column(digests, 'orphaned')
+        marked = [d for d, o in orphaned.iteritems() if o]
+        if not marked:
+            return None
+        revived = {}
+        for i in range(0, len(marked), cursor.IN_MAX):
+            sub_digests = marked[i:i + cursor.IN_MAX]
+            in_ = ','.join(('%s',) * len(sub_digests))
+            cursor.execute('UPDATE "' + cls._table + '" '
+                'SET orphaned = NULL WHERE digest IN (' + in_ + ')',
+                sub_digests)
+            cursor.execute('SELECT digest, codec, pack '
+                'FROM "' + cls._table + '" WHERE digest IN (' + in_ + ')',
+                sub_digests)
+            revived.update((d, (c, p)) for d, c, p in cursor.fetchall())
+        return revived
+
+    @classmethod
+    def get_referenced(cls, digests):
+        """
+        Returns the set of the digests referenced by a mail or by an
+        attachment. The attachments stored apart are contents without parts
+        so their digests are the ones of the attachments.
+        """
+        pool = Pool()
+        Mail = pool.get('electronic_mail')
+        Attachment = pool.get('electronic_mail.attachment')
+        cursor = Transaction().cursor
+        digests = list(set(digests))
+        referenced = set()
+        for i in range(0, len(digests), cursor.IN_MAX):
+            sub_digests = digests[i:i + cursor.IN_MAX]
+            in_ = ','.join(('%s',) * len(sub_digests))
+            cursor.execute('SELECT digest FROM "' + Mail._table + '" '
+                'WHERE digest IN (' + in_ + ') '
+                    'AND (collision = 0 OR collision IS NULL) '
+                'UNION SELECT digest FROM "' + Attachment._table + '" '
+                'WHERE digest IN (' + in_ + ')', sub_digests * 2)
+            referenced.update(r[0] for r in cursor.fetchall())
+        return referenced
+
+    @classmethod
+    def collect_garbage(cls, delay=24, batch_size=500, commit=True):
+        """
+        Removes the contents referenced by no mail nor attachment by
+        mark-and-sweep: a content found unreferenced is marked orphaned and
+        it is removed if it is still unreferenced after delay hours. A mail
+        storing the content again meanwhile revives it. A pack file is
+        removed with its last content. Then the stored files without
+        record are removed by collect_files.
+
+        :param delay: Hours before an orphaned content or a stored file
+            without record is removed
+        :param batch_size: Number of contents checked at once
+        :param commit: Commit the transaction after each batch
+        :return: Number of removed files
+        """
+        Pack = Pool().get('electronic_mail.pack')
+        cursor = Transaction().cursor
+        storage = get_storage()
+        now = datetime.now()
+        threshold = now - timedelta(hours=delay)
+        count = 0
+        last_id = 0
+        while True:
+            cursor.execute('SELECT id, digest, codec, pack, '
+                    'CASE WHEN orphaned IS NULL THEN 0 '
+                        'WHEN orphaned > %s THEN 1 ELSE 2 END '
+                'FROM "' + cls._table + '" '
+                'WHERE id > %s ORDER BY id LIMIT %s',
+                (threshold, last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            referenced = cls.get_referenced([r[1] for r in rows])
+            to_mark, to_clear, names, pack_ids = [], [], [], set()
+            for content_id, digest, codec, pack_id, orphaned in rows:
+                if digest in referenced:
+                    if orphaned:
+                        to_clear.append(content_id)
+                elif not orphaned:
+                    to_mark.append(content_id)
+                elif orphaned == 2:
+                    # The deletion waits for a revival in progress and
+                    # skips the content if it has been revived
+                    cursor.execute('DELETE FROM "' + cls._table + '" '
+                        'WHERE id = %s AND orphaned IS NOT NULL',
+                        (content_id,))
+                    if cursor.rowcount:
+                        names.append(content_name(digest, codec))
+                        if pack_id:
+                            pack_ids.add(pack_id)
+            for ids, value in ((to_mark, now), (to_clear, None)):
+                if ids:
+                    red_sql, red_ids = reduce_ids('id', ids)
+                    cursor.execute('UPDATE "' + cls._table + '" '
+                        'SET orphaned = %s WHERE ' + red_sql,
+                        [value] + red_ids)
+            if pack_ids:
+                red_sql, red_ids = reduce_ids('id', list(pack_ids))
+                cursor.execute('SELECT id, name FROM "' + Pack._table + '" '
+                    'WHERE ' + red_sql + ' AND id NOT IN ('
+                        'SELECT pack FROM "' + cls._table + '" '
+                        'WHERE pack IS NOT NULL)', red_ids)
+                packs = cursor.fetchall()
+                if packs:
+                    red_sql, red_ids = reduce_ids('id', [p[0] for p in packs])
+                    cursor.execute('DELETE FROM "' + Pack._table + '" '
+                        'WHERE ' + red_sql, red_ids)
+                    names.extend(p[1] for p in packs)
+            # The files are removed before the commit so a content is never
+            # left without file, a collection rolled back leaves orphaned
+            # records which are revived with their file
+            for name in names:
+                storage.delete(name)
+            count += len(names)
+            if commit:
+                cursor.commit()
+        return count + cls.collect_files(delay, batch_size, commit)
+
+    @classmethod
+    def collect_files(cls, delay=24, batch_size=500, commit=True):
+        """
+        Removes the stored files which have no record: the contents of
+        rolled back transactions, the contents left by recompress or
+        archive_mails and the temporary files of interrupted writes. Only
+        the files older than delay hours are removed so the contents being
+        stored are kept.
+
+        :param delay: Hours before a file without record is removed
+        :param batch_size: Number of files checked at once
+        :param commit: Commit the transaction after each batch
+        :return: Number of removed files
+        """
+        cursor = Transaction().cursor
+        storage = get_storage()
+        threshold = time() - delay * 3600
+        count = 0
+        names = []
+        for name, mtime in storage.iter_names():
+            if mtime > threshold:
+                continue
+            names.append(name)
+            if len(names) >= batch_size:
+                count += cls._collect_files(names, threshold)
+                names = []
+                if commit:
+                    cursor.commit()
+        if names:
+            count += cls._collect_files(names, threshold)
+            if commit:
+                cursor.commit()
+        return count
+
+    @classmethod
+    def _collect_files(cls, names, threshold):
+        "Removes the files of the names without record"
+        pool = Pool()
+        Mail = pool.get('electronic_mail')
+        Pack = pool.get('electronic_mail.pack')
+        cursor = Transaction().cursor
+        storage = get_storage()
+        live = set()
+        recorded = set()
+        digests = list(set(n.split('-', 1)[0].split('.', 1)[0]
+                for n in names))
+        for i in range(0, len(digests), cursor.IN_MAX):
+            sub_digests = digests[i:i + cursor.IN_MAX]
+            in_ = ','.join(('%s',) * len(sub_digests))
+            cursor.execute('SELECT digest, codec, pack '
+                'FROM "' + cls._table + '" WHERE digest IN (' + in_ + ')',
+                sub_digests)
+            for digest, codec, pack_id in cursor.fetchall():
+                recorded.add(digest)
+                if not pack_id:
+                    live.add(content_name(digest, codec))
+            # The contents stored before the records are named by the mails
+            cursor.execute('SELECT digest, collision '
+                'FROM "' + Mail._table + '" WHERE digest IN (' + in_ + ')',
+                sub_digests)
+            for digest, collision in cursor.fetchall():
+                if collision:
+                    live.add('%s-%s' % (digest, collision))
+                elif digest not in recorded:
+                    live.add(digest)
+        for i in range(0, len(names), cursor.IN_MAX):
+            sub_names = names[i:i + cursor.IN_MAX]
+            cursor.execute('SELECT name FROM "' + Pack._table + '" '
+                'WHERE name IN (' + ','.join(('%s',) * len(sub_names)) + ')',
+                sub_names)
+            live.update(r[0] for r in cursor.fetchall())
+        count = 0
+        for name in names:
+            if name in live:
+                continue
+            # The file may have been written again since it was listed
+            mtime = storage.mtime(name)
+            if mtime is None or mtime > threshold:
+                continue
+            storage.delete(name)
+            count += 1
+        return count
+
+    @classmethod
+    def recompress(cls, codec=False, batch_size=100, commit=True):
+        """
+        Stores again the contents which are not compressed with the codec.
+        The content compressed by the previous codec is removed once the
+        new one is committed so readers always find a content. Without
+        commit it is left to be garbage collected.
+
+        :param codec: Name of the codec, the configured one when False
+        :param batch_size: Number of contents recompressed per commit
+        :param commit: Commit the transaction after each batch
+        :return: Number of recompressed contents
+        """
+        cursor = Transaction().cursor
+        storage = get_storage()
+        if codec is False:
+            codec = get_codec()
+        codec = codec or None
+        domain = [('codec', '!=', codec)]
+        if codec:
+            domain = ['OR', domain[0], ('codec', '=', None)]
+        count = 0
+        last_id = 0
+        while True:
+            contents = cls.search([
+                    ('id', '>', last_id),
+                    ('pack', '=', None),
+                    domain,
+                    ], order=[('id', 'ASC')], limit=batch_size)
+            if not contents:
+                break
+            last_id = contents[-1].id
+            previous_names = []
+            for content in contents:
+                previous_name = content_name(content.digest, content.codec)
+                data = decode(storage.get(previous_name), content.codec)
+                if data is None:
+                    continue
+                storage.set(content_name(content.digest, codec),
+                    encode(data, codec))
+                cls.write([content], {'codec': codec})
+                previous_names.append(previous_name)
+                count += 1
+            if commit:
+                cursor.commit()
+                for previous_name in previous_names:
+                    storage.delete(previous_name)
+        return count
+
+
+class Attachment(ModelSQL, ModelView):
+    """
+    E-mail Attachment
+
+    The attachments are listed and read without parsing their email: the
+    position of their body in the email is recorded when it is stored.
+    """
+    __name__ = 'electronic_mail.attachment'
+
+    mail = fields.Many2One('electronic_mail', 'E-mail', required=True,
+        ondelete='CASCADE', select=1)
+    filename = fields.Char('Filename')
+    content_type = fields.Char('Content Type')
+    encoding = fields.Char('Encoding',
+        help='Content-Transfer-Encoding of the attachment in the e-mail')
+    size = fields.Integer('Size', help='Size of the decoded attachment')
+    digest = fields.Char('Digest', size=64, select=1,
+        help='SHA-256 digest of the attachment as encoded in the e-mail')
+    start = fields.Integer('Start',
+        help='Position of the attachment in the e-mail')
+    end = fields.Integer('End',
+        help='Position after the attachment in the e-mail')
+    data = fields.Function(fields.Binary('Data', filename='filename'),
+        'get_data')
+
+    @classmethod
+    def get_data(cls, attachments, name):
+        """
+        Returns the decoded attachments by reading only their slice of the
+        email
+        """
+        result = {}
+        for attachment in attachments:
+            data = attachment.mail.read_email(attachment.start,
+                attachment.end - attachment.start)
+            result[attachment.id] = buffer(
+                decode_body(data, attachment.encoding))
+        return result
+
+
+class Address(ModelSQL, ModelView):
+    """
+    E-mail Address
+
+    The addresses of the senders and the recipients of the mails in lower
+    case, one row per mail, role and address, so the mails of a
+    correspondent are found by an index seek.
+    """
+    __name__ = 'electronic_mail.address'
+
+    mail = fields.Many2One('electronic_mail', 'E-mail', required=True,
+        ondelete='CASCADE', select=1)
+    role = fields.Selection([
+            ('from', 'From'),
+            ('sender', 'Sender'),
+            ('to', 'To'),
+            ('cc', 'CC'),
+            ('bcc', 'BCC'),
+            ], 'Role', required=True)
+    address = fields.Char('Address', required=True,
+        help='Address in lower case')
+    name = fields.Char('Name', help='Display name of the address')
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().cursor
+        created = not TableHandler.table_exist(cursor, cls._table)
+
+        super(Address, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['address', 'role'], 'add')
+        # Migration from 2.8.1: the addresses are parsed from the mails
+        if created:
+            cls.update_mails(commit=False)
+
+    @staticmethod
+    def get_values(values):
+        """
+        Returns the values of the addresses of the values of a mail
+
+        :param values: Dictionary with the address headers of the mail by
+            column as from_
+        :return: List of the values of the addresses without mail
+        """
+        result = []
+        for role, column in ADDRESS_ROLES:
+            seen = set()
+            for name, address in parse_addresses(values.get(column)):
+                if address in seen:
+                    continue
+                seen.add(address)
+                result.append({
+                        'role': role,
+                        'address': address,
+                        'name': name,
+                        })
+        return result
+
+    @classmethod
+    def update_mails(cls, batch_size=500, commit=True):
+        """
+        Creates the addresses of the mails having none from their address
+        columns, the stored emails are not read
+
+        :param batch_size: Number of mails parsed at once
+        :param commit: Commit the transaction after each batch
+        :return: Number of mails updated
+        """
+        Mail = Pool().get('electronic_mail')
+        cursor = Transaction().cursor
+        columns = [c for _, c in ADDRESS_ROLES]
+        count = 0
+        last_id = 0
+        while True:
+            cursor.execute('SELECT id, '
+                + ', '.join('"%s"' % c for c in columns) + ' '
+                'FROM "' + Mail._table + '" '
+                'WHERE id > %s AND id NOT IN ('
+                    'SELECT mail FROM "' + cls._table + '") '
+                'ORDER BY id LIMIT %s', (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            with Transaction().set_user(0):
+                cls.create([dict(a, mail=row[0]) for row in rows
+                        for a in cls.get_values(dict(zip(columns, row[1:])))])
+            count += len(rows)
+            if commit:
+                cursor.commit()
+        return count
+
+
+class HeaderLine(ModelSQL):
+    "Header Line"
+    __name__ = 'electronic_mail.header.line'
+
+    name = fields.Char('Name', help='Name of Header Field')
+    value = fields.Char('Value', help='Value of Header Field')
+    electronic_mail = fields.Many2One('electronic_mail', 'e-mail', select=1)
+
+    @classmethod
+    def __register__(cls, module_name):
+        Mail = Pool().get('electronic_mail')
+        cursor = Transaction().cursor
+
+        # Migration from 2.8.1: the header lines are stored in their own
+        # table behind the header view
+        migrate = TableHandler.table_exist(cursor, 'electronic_mail_header')
+        if migrate:
+            for index in ('electronic_mail_header_electronic_mail_index',
+                    'electronic_mail_header_name_electronic_mail_index'):
+                cursor.execute('DROP INDEX IF EXISTS "%s"' % index)
+            TableHandler.table_rename(cursor, 'electronic_mail_header',
+                cls._table)
+
+        super(HeaderLine, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['name', 'electronic_mail'], 'add')
+
+        if migrate:
+            for name, column in PROMOTED_HEADERS:
+                cursor.execute('UPDATE "' + Mail._table + '" '
+                    'SET "' + column + '" = ('
+                        'SELECT MIN(value) FROM "' + cls._table + '" '
+                        'WHERE name = %s '
+                            'AND electronic_mail = "' + Mail._table + '".id)',
+                    (name,))
 
 
 class Header(ModelSQL, ModelView):
-    "Header fields"
+    """
+    Header fields
+
+    View of the header lines and of the headers of the mails stored
+    compactly. The header lines have even IDs. The headers of a compact mail
+    have odd IDs in a range per mail: the headers promoted to columns come
+    first and are queried in SQL, the others are parsed from the raw headers
+    of the mail when the headers of given mails are searched, as the headers
+    One2Many does.
+    """
     __name__ = 'electronic_mail.header'
 
     name = fields.Char('Name', help='Name of Header Field')
     value = fields.Char('Value', help='Value of Header Field')
     electronic_mail = fields.Many2One('electronic_mail', 'e-mail')
 
+    @classmethod
+    def __setup__(cls):
+        super(Header, cls).__setup__()
+        cls._error_messages.update({
+                'promoted_header': 'The header "%s" stored in the mail '
+                    'can not be modified.',
+                })
+
+    @staticmethod
+    def table_query():
+        pool = Pool()
+        Mail = pool.get('electronic_mail')
+        HeaderLine = pool.get('electronic_mail.header.line')
+        columns = ('create_uid, create_date, write_uid, write_date')
+        queries = ['SELECT id * 2 AS id, ' + columns + ', '
+            'electronic_mail, name, value FROM "' + HeaderLine._table + '"']
+        args = []
+        for index, (name, column) in enumerate(PROMOTED_HEADERS):
+            queries.append('SELECT (CAST(id AS BIGINT) * %s + %s) * 2 + 1 '
+                    'AS id, ' + columns + ', '
+                'id AS electronic_mail, CAST(%s AS VARCHAR) AS name, '
+                    'CAST("' + column + '" AS VARCHAR) AS value '
+                'FROM "' + Mail._table + '" '
+                'WHERE raw_headers IS NOT NULL '
+                    'AND "' + column + '" IS NOT NULL')
+            args.extend([HEADER_SLOTS, index, name])
+        return ' UNION ALL '.join(queries), args
+
+    @staticmethod
+    def _is_parsed(header_id):
+        "Tells if the header is parsed from the raw headers of its mail"
+        return (header_id % 2 == 1
+            and header_id // 2 % HEADER_SLOTS >= len(PROMOTED_HEADERS))
+
+    @classmethod
+    def _get_searched_mails(cls, domain):
+        """
+        Returns the IDs of the mails stored compactly whose headers are
+        searched or None when the domain does not only select the headers of
+        given mails
+        """
+        Mail = Pool().get('electronic_mail')
+        mail_ids = None
+        for clause in domain:
+            if clause == 'AND':
+                continue
+            if (not isinstance(clause, (list, tuple)) or len(clause) != 3
+                    or clause[0] != 'electronic_mail'
+                    or clause[1] not in ('=', 'in')):
+                return None
+            ids = set(clause[1] == 'in' and clause[2] or [clause[2]])
+            mail_ids = ids if mail_ids is None else mail_ids & ids
+        if not mail_ids:
+            return None
+        return [m.id for m in Mail.search([
+                    ('id', 'in', [i for i in mail_ids if i]),
+                    ('raw_headers', '!=', None),
+                    ])]
+
+    @classmethod
+    def _get_parsed(cls, mail_ids):
+        """
+        Returns the values of the headers parsed from the raw headers of the
+        mails, the first header of each promoted name is not included as it
+        is the row of its column
+        """
+        Mail = Pool().get('electronic_mail')
+        start = len(PROMOTED_HEADERS)
+        headers = []
+        for mail in Mail.browse(mail_ids):
+            if not mail.raw_headers:
+                continue
+            promoted = set(n.lower() for n, _ in PROMOTED_HEADERS)
+            items = parse_headers(mail.raw_headers.encode('utf-8')).items()
+            for index, (name, value) in enumerate(
+                    items[:HEADER_SLOTS - start]):
+                if name.lower() in promoted:
+                    promoted.remove(name.lower())
+                    continue
+                headers.append({
+                        'id': (mail.id * HEADER_SLOTS + start + index) * 2 + 1,
+                        'electronic_mail': mail.id,
+                        'name': unicode(name, 'utf-8', 'replace'),
+                        'value': unicode(value, 'utf-8', 'replace'),
+                        })
+        return headers
+
+    @classmethod
+    def search(cls, domain, offset=0, limit=None, order=None, count=False,
+            query_string=False):
+        mail_ids = not query_string and cls._get_searched_mails(domain)
+        if not mail_ids:
+            return super(Header, cls).search(domain, offset=offset,
+                limit=limit, order=order, count=count,
+                query_string=query_string)
+        # The parsed headers are merged by ID with the rows of the view
+        ids = [h.id for h in super(Header, cls).search(domain)]
+        ids.extend(h['id'] for h in cls._get_parsed(mail_ids))
+        ids.sort()
+        if limit is not None:
+            ids = ids[offset:offset + limit]
+        else:
+            ids = ids[offset:]
+        if count:
+            return len(ids)
+        return cls.browse(ids)
+
+    @classmethod
+    def read(cls, ids, fields_names=None):
+        Mail = Pool().get('electronic_mail')
+        parsed_ids = set(i for i in ids if cls._is_parsed(i))
+        result = super(Header, cls).read(
+            [i for i in ids if i not in parsed_ids], fields_names)
+        if parsed_ids:
+            if not fields_names:
+                fields_names = cls._fields.keys()
+            mail_ids = list(set(i // 2 // HEADER_SLOTS for i in parsed_ids))
+            related = [f.split('.', 1)[1] for f in fields_names
+                if f.startswith('electronic_mail.')]
+            mails = {}
+            if related:
+                mails = dict((m['id'], m) for m in Mail.read(mail_ids,
+                        related))
+            for header in cls._get_parsed(mail_ids):
+                if header['id'] not in parsed_ids:
+                    continue
+                values = {'id': header['id']}
+                for name in fields_names:
+                    if name == 'rec_name':
+                        values[name] = header['name']
+                    elif name.startswith('electronic_mail.'):
+                        values[name] = mails[header['electronic_mail']].get(
+                            name.split('.', 1)[1])
+                    else:
+                        values[name] = header.get(name)
+                result.append(values)
+        index = dict((i, p) for p, i in enumerate(ids))
+        result.sort(key=lambda r: index[r['id']])
+        return result
+
+    @classmethod
+    def _lines(cls, headers):
+        "Returns the header lines of the headers"
+        HeaderLine = Pool().get('electronic_mail.header.line')
+        for header in headers:
+            if header.id % 2:
+                cls.raise_user_error('promoted_header', (header.name,))
+        return HeaderLine.browse([h.id // 2 for h in headers])
+
+    @classmethod
+    def create(cls, vlist):
+        HeaderLine = Pool().get('electronic_mail.header.line')
+        return cls.browse([l.id * 2 for l in HeaderLine.create(vlist)])
+
+    @classmethod
+    def write(cls, headers, values):
+        HeaderLine = Pool().get('electronic_mail.header.line')
+        HeaderLine.write(cls._lines(headers), values)
+
+    @classmethod
+    def delete(cls, headers):
+        HeaderLine = Pool().get('electronic_mail.header.line')
+        HeaderLine.delete(cls._lines(headers))
+
     @classmethod
     def create_from_email(cls, mail, mail_id):
         """
         :param mail: Email object
         :param mail_id: ID of the email from electronic_mail
         """
+        return cls.create_from_emails([mail], [mail_id])
+
+    @classmethod
+    def create_from_emails(cls, mails, mail_ids):
+        """
+        Creates the header lines of several emails at once unless the
+        headers are stored compactly in the mails
+
+        :param mails: List of email objects
+        :param mail_ids: List of the IDs of the emails from electronic_mail
+        """
+        return cls.create_from_items([m.items() for m in mails], mail_ids)
+
+    @classmethod
+    def create_from_items(cls, items, mail_ids):
+        """
+        Creates the header lines of several emails from their header items
+        unless the headers are stored compactly in the mails
+
+        :param items: List of the lists of the header names and values of
+            each email
+        :param mail_ids: List of the IDs of the emails from electronic_mail
+        """
+        if get_header_storage() == 'compact':
+            return []
         values = []
-        for name, value in mail.items():
-            values.append({
-                'electronic_mail':mail_id,
-                'name':name,
-                'value':value,
-            })
+        for mail_items, mail_id in zip(items, mail_ids):
+            for name, value in mail_items:
+                values.append({
+                    'electronic_mail':mail_id,
+                    'name':name,
+                    'value':value,
+                })
         return cls.create(values)
-
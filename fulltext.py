@@ -0,0 +1,257 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+"Full-Text Index"
+
+import re
+import unicodedata
+from HTMLParser import HTMLParser, HTMLParseError
+from htmlentitydefs import name2codepoint
+from email.header import decode_header
+
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+from trytond.backend import TableHandler
+
+
+__all__ = ['fold', 'decode_header_text', 'html_to_text', 'extract_text',
+    'FullTextIndex', 'PostgreSQLIndex', 'SQLiteIndex', 'INDEXES',
+    'has_index', 'get_index']
+
+# The body text indexed per mail is truncated to keep the PostgreSQL
+# tsvector under its 1MB limit
+MAX_TEXT_SIZE = 256 * 1024
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def fold(text):
+    """
+    Returns the text lower cased without accents so the words match
+    whatever the case and the charset the mail used
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text)
+    return u''.join(c for c in text
+        if not unicodedata.combining(c)).lower()
+
+
+def _to_unicode(data, charset):
+    if isinstance(data, unicode):
+        return data
+    for charset in (charset, 'utf-8', 'latin-1'):
+        if not charset:
+            continue
+        try:
+            return data.decode(charset)
+        except (LookupError, UnicodeDecodeError):
+            continue
+    return data.decode('latin-1', 'replace')
+
+
+def decode_header_text(value):
+    "Returns the unicode text of a header value encoded as RFC 2047 words"
+    if not value:
+        return u''
+    try:
+        parts = decode_header(value)
+    except Exception:
+        # Malformed encoded words are indexed as they are
+        parts = [(value, None)]
+    return u' '.join(_to_unicode(data, charset) for data, charset in parts)
+
+
+class _TextExtractor(HTMLParser):
+    "Collects the text of a HTML document out of the scripts and styles"
+    skipped = ('script', 'style', 'head')
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.texts = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skipped:
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.skipped and self.skip:
+            self.skip -= 1
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.texts.append(data)
+
+    def handle_entityref(self, name):
+        if not self.skip and name in name2codepoint:
+            self.texts.append(unichr(name2codepoint[name]))
+
+    def handle_charref(self, name):
+        if self.skip:
+            return
+        try:
+            if name[:1] in ('x', 'X'):
+                self.texts.append(unichr(int(name[1:], 16)))
+            else:
+                self.texts.append(unichr(int(name)))
+        except (ValueError, OverflowError):
+            pass
+
+
+def html_to_text(html):
+    "Returns the text of the HTML document"
+    extractor = _TextExtractor()
+    try:
+        extractor.feed(html)
+        extractor.close()
+    except HTMLParseError:
+        pass
+    return u' '.join(extractor.texts)
+
+
+def extract_text(message):
+    """
+    Returns the folded text of the text parts of the email.message, the
+    HTML parts are stripped of their markup
+    """
+    texts = []
+    size = 0
+    for part in message.walk():
+        if part.get_content_maintype() != 'text' or part.get_filename():
+            continue
+        payload = part.get_payload(decode=True)
+        if not payload:
+            continue
+        text = _to_unicode(payload, part.get_content_charset())
+        if part.get_content_subtype() == 'html':
+            text = html_to_text(text)
+        texts.append(text)
+        size += len(text)
+        if size >= MAX_TEXT_SIZE:
+            break
+    return fold(u'\n'.join(texts)[:MAX_TEXT_SIZE])
+
+
+class FullTextIndex(object):
+    """
+    Base class of the full-text indexes of the mails, implemented per
+    database backend in a table outside of the ORM. Each mail is indexed
+    with a title made of its subject and addresses and with its body text.
+    """
+    table = 'electronic_mail_fulltext'
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def create(self):
+        "Creates the index table unless it exists"
+        raise NotImplementedError
+
+    def set(self, values):
+        """
+        Indexes the mails
+
+        :param values: List of tuples of the mail ID, the title and the body
+        """
+        raise NotImplementedError
+
+    def delete(self, mail_ids):
+        "Removes the mails from the index"
+        for i in range(0, len(mail_ids), self.cursor.IN_MAX):
+            sub_ids = mail_ids[i:i + self.cursor.IN_MAX]
+            self.cursor.execute('DELETE FROM "' + self.table + '" '
+                'WHERE ' + self.id_column + ' IN ('
+                + ','.join(('%s',) * len(sub_ids)) + ')', sub_ids)
+
+    def clear(self):
+        "Removes all the mails from the index"
+        self.cursor.execute('DELETE FROM "' + self.table + '"')
+
+    def search(self, text):
+        """
+        Returns the query and its arguments selecting the IDs of the mails
+        matching all the words of the text
+        """
+        raise NotImplementedError
+
+    def indexed(self):
+        "Returns the query selecting the IDs of the indexed mails"
+        return 'SELECT ' + self.id_column + ' FROM "' + self.table + '"'
+
+
+class PostgreSQLIndex(FullTextIndex):
+    """
+    Stores a tsvector per mail in a table with a GIN index. The text search
+    configuration is set by the email_fulltext_config option of the
+    configuration, 'simple' by default.
+    """
+    id_column = 'mail'
+
+    @property
+    def config(self):
+        return CONFIG.get('email_fulltext_config') or 'simple'
+
+    def create(self):
+        if TableHandler.table_exist(self.cursor, self.table):
+            return
+        self.cursor.execute('CREATE TABLE "' + self.table + '" ('
+                'mail INTEGER PRIMARY KEY '
+                    'REFERENCES electronic_mail (id) ON DELETE CASCADE, '
+                'document TSVECTOR NOT NULL)')
+        self.cursor.execute('CREATE INDEX "' + self.table + '_document_index" '
+            'ON "' + self.table + '" USING GIN (document)')
+
+    def set(self, values):
+        self.delete([v[0] for v in values])
+        for mail_id, title, body in values:
+            # The words of the subject and addresses rank first
+            self.cursor.execute('INSERT INTO "' + self.table + '" '
+                '(mail, document) VALUES (%s, '
+                    'setweight(to_tsvector(%s, %s), \'A\') '
+                    '|| to_tsvector(%s, %s))',
+                (mail_id, self.config, title, self.config, body))
+
+    def search(self, text):
+        return ('SELECT mail FROM "' + self.table + '" '
+            'WHERE document @@ plainto_tsquery(%s, %s)',
+            [self.config, fold(text)])
+
+
+class SQLiteIndex(FullTextIndex):
+    "Stores the text of the mails in a FTS4 virtual table"
+    id_column = 'docid'
+
+    def create(self):
+        self.cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS '
+            '"' + self.table + '" USING fts4(title, body)')
+
+    def set(self, values):
+        self.delete([v[0] for v in values])
+        for value in values:
+            self.cursor.execute('INSERT INTO "' + self.table + '" '
+                '(docid, title, body) VALUES (%s, %s, %s)', value)
+
+    def search(self, text):
+        words = WORD.findall(fold(text))
+        return ('SELECT docid FROM "' + self.table + '" '
+            'WHERE "' + self.table + '" MATCH %s',
+            [u' '.join(u'"%s"' % w for w in words)])
+
+INDEXES = {
+    'postgresql': PostgreSQLIndex,
+    'sqlite': SQLiteIndex,
+    }
+
+
+def has_index():
+    "Returns True if the database backend has a full-text index"
+    return CONFIG['db_type'] in INDEXES
+
+
+def get_index():
+    """
+    Returns the full-text index of the database of the transaction or None
+    when its backend has none
+    """
+    index = INDEXES.get(CONFIG['db_type'])
+    if index:
+        return index(Transaction().cursor)
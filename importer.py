@@ -0,0 +1,447 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+"Mailbox Import"
+
+import os
+import re
+import time
+import logging
+import multiprocessing
+from collections import deque
+from email import message_from_string
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.backend import TableHandler
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+from trytond.transaction import Transaction
+from trytond.pyson import Eval
+from trytond.pool import Pool
+
+from .storage import get_codec
+from .instrumentation import INSTRUMENTATION
+
+
+__all__ = ['MailboxImport', 'ImportMailboxStart', 'ImportMailboxDone',
+    'ImportMailbox']
+
+_QUOTED_FROM_LINE = re.compile(r'^>+From ')
+
+
+def iter_mbox(path, offset=0):
+    """
+    Yields the messages of a mbox file one at a time without loading
+    the whole file. The lines starting with "From " quoted as in the mboxrd
+    format written by ElectronicMail.iter_mbox are unquoted.
+
+    :param path: Path of the mbox file
+    :param offset: Byte offset of the first message to read
+    :return: Generator of tuples of the message as string and the byte
+        offset of the next message
+    """
+    with open(path, 'rb') as file_p:
+        file_p.seek(offset)
+        position = offset
+        lines = []
+        while True:
+            line = file_p.readline()
+            if not line or line.startswith('From '):
+                if lines:
+                    # The blank line before the separator is not part
+                    # of the message
+                    if lines[-1] in ('\n', '\r\n'):
+                        lines.pop()
+                    yield ''.join(lines), position
+                    lines = []
+                if not line:
+                    break
+            elif _QUOTED_FROM_LINE.match(line):
+                lines.append(line[1:])
+            else:
+                lines.append(line)
+            position += len(line)
+
+
+def _list_maildir(path):
+    """
+    Returns a dictionary of the filename of the messages of a Maildir
+    directory per unique name, the name without the flags which does not
+    change when the message is moved from new to cur
+    """
+    filenames = {}
+    for subdir in ('cur', 'new'):
+        directory = os.path.join(path, subdir)
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            if not name.startswith('.'):
+                filenames[name.split(':', 1)[0]] = os.path.join(directory,
+                    name)
+    return filenames
+
+
+def iter_maildir(path, last_name=None):
+    """
+    Yields the messages of a Maildir directory one at a time in the order
+    of their unique names, which start with their time of delivery
+
+    :param path: Path of the Maildir directory
+    :param last_name: Unique name of the last message read, the messages
+        up to it are skipped
+    :return: Generator of tuples of the message as string and its unique
+        name
+    """
+    filenames = _list_maildir(path)
+    for name in sorted(filenames):
+        if last_name is not None and name <= last_name:
+            continue
+        try:
+            file_p = open(filenames[name], 'rb')
+        except IOError:
+            # The message was moved or its flags changed since the listing
+            filename = _list_maildir(path).get(name)
+            if filename is None:
+                continue
+            file_p = open(filename, 'rb')
+        with file_p:
+            data = file_p.read()
+        yield data, name
+
+# The reader of each type of source with the field of the import holding
+# the position where it resumes
+READERS = {
+    'mbox': (iter_mbox, 'offset'),
+    'maildir': (iter_maildir, 'last_name'),
+    }
+
+
+def prepare_emails(db_name, datas, codec):
+    """
+    Parses the messages and returns the values to store them computed by
+    prepare_email. It runs in the processes of the import pool.
+    """
+    Mail = Pool(db_name).get('electronic_mail')
+    return [Mail.prepare_email(message_from_string(data), codec)
+        for data in datas]
+
+
+def prepare_emails_measured(db_name, datas, codec):
+    """
+    Returns the result of prepare_emails with the instrumentation of the
+    process while preparing them, to be merged by the importing process
+    """
+    if not INSTRUMENTATION.enabled:
+        return prepare_emails(db_name, datas, codec), None
+    INSTRUMENTATION.reset()
+    prepared = prepare_emails(db_name, datas, codec)
+    return prepared, INSTRUMENTATION.dump()
+
+
+def iter_prepared(db_name, messages, codec, workers=0, batch_size=50):
+    """
+    Yields the messages prepared to be stored in the order of messages
+
+    :param db_name: Name of the database
+    :param messages: Iterator of tuples of the message as string and the
+        position after it in the source
+    :param codec: Codec of the stored contents
+    :param workers: Number of processes preparing the messages, none to
+        prepare them in the current process
+    :param batch_size: Number of messages sent at once to a process
+    :return: Generator of tuples of the values returned by prepare_email
+        and the position after the message in the source
+    """
+    if not workers:
+        for data, offset in messages:
+            yield prepare_emails(db_name, [data], codec)[0], offset
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        # Bound the batches in progress so the source is not read faster
+        # than the messages are stored
+        pending = deque()
+
+        def results():
+            result, offsets = pending.popleft()
+            prepared, stats = result.get()
+            INSTRUMENTATION.merge(stats)
+            return zip(prepared, offsets)
+
+        datas, offsets = [], []
+        for data, offset in messages:
+            datas.append(data)
+            offsets.append(offset)
+            if len(datas) >= batch_size:
+                pending.append((pool.apply_async(prepare_emails_measured,
+                            (db_name, datas, codec)), offsets))
+                datas, offsets = [], []
+                if len(pending) > workers * 2:
+                    for result in results():
+                        yield result
+        if datas:
+            pending.append((pool.apply_async(prepare_emails_measured,
+                        (db_name, datas, codec)), offsets))
+        while pending:
+            for result in results():
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class MailboxImport(ModelSQL, ModelView):
+    "Mailbox Import"
+    __name__ = 'electronic_mail.import'
+
+    path = fields.Char('Path', required=True,
+        states={'readonly': Eval('state') != 'draft'}, depends=['state'],
+        help='Path of the mbox file or Maildir directory on the server')
+    type_ = fields.Selection([
+            ('mbox', 'mbox'),
+            ('maildir', 'Maildir'),
+            ], 'Type', required=True,
+        states={'readonly': Eval('state') != 'draft'}, depends=['state'])
+    mailbox = fields.Many2One('electronic_mail.mailbox', 'Mailbox',
+        required=True,
+        states={'readonly': Eval('state') != 'draft'}, depends=['state'])
+    chunk_size = fields.Integer('Chunk Size', required=True,
+        help='Number of messages created and committed at once')
+    workers = fields.Integer('Workers', required=True,
+        help='Number of processes parsing, hashing and compressing the '
+        'messages, none to do it in the server process')
+    offset = fields.BigInteger('Offset', readonly=True,
+        help='Position in the mbox file where the import resumes')
+    last_name = fields.Char('Last Message', readonly=True,
+        help='Unique name of the last message imported from the Maildir '
+        'directory')
+    imported = fields.Integer('Imported', readonly=True)
+    duration = fields.Float('Duration', readonly=True,
+        help='Time spent importing in seconds')
+    rate = fields.Function(fields.Float('Messages/Second'), 'get_rate')
+    state = fields.Selection([
+            ('draft', 'Draft'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ], 'State', readonly=True, required=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+
+        # Migration: the offsets in the mbox files over 2GB do not fit in an
+        # integer column
+        if (table.column_exist('offset')
+                and table._columns['offset']['typname'] == 'int4'):
+            table.alter_type('offset', 'int8')
+
+        super(MailboxImport, cls).__register__(module_name)
+
+    @classmethod
+    def __setup__(cls):
+        super(MailboxImport, cls).__setup__()
+        cls._buttons.update({
+                'process': {
+                    'invisible': Eval('state') == 'done',
+                    },
+                })
+
+    @staticmethod
+    def default_type_():
+        return 'mbox'
+
+    @staticmethod
+    def default_chunk_size():
+        return 500
+
+    @staticmethod
+    def default_workers():
+        return 0
+
+    @staticmethod
+    def default_offset():
+        return 0
+
+    @staticmethod
+    def default_imported():
+        return 0
+
+    @staticmethod
+    def default_duration():
+        return 0.0
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @classmethod
+    def get_rate(cls, imports, name):
+        return dict([(i.id, i.duration and i.imported / i.duration or 0.0)
+                for i in imports])
+
+    @classmethod
+    @ModelView.button
+    def process(cls, imports):
+        for import_ in imports:
+            import_._process()
+
+    def _process(self, commit=True):
+        """
+        Streams the messages of the source into the mailbox from the
+        recorded position. Progress is saved after each chunk. The messages
+        are prepared by the pool of workers while the records are created
+        in the current transaction.
+
+        :param commit: Commit the transaction after each chunk so an
+            interrupted run can resume from the recorded position
+        """
+        Mail = Pool().get('electronic_mail')
+        logger = logging.getLogger('electronic_mail')
+        reader, position = READERS[self.type_]
+        mailbox_id = self.mailbox.id
+        chunk_size = self.chunk_size
+        workers = self.workers or 0
+        path = self.path
+        previous_imported = self.imported or 0
+        previous_duration = self.duration or 0.0
+        values = {
+            'offset': self.offset or 0,
+            'last_name': self.last_name,
+            'imported': previous_imported,
+            'duration': previous_duration,
+            }
+        self.write([self], {'state': 'running'})
+
+        chunk = []
+        start = time.time()
+        measured = [INSTRUMENTATION.dump()]
+
+        def flush():
+            if chunk:
+                Mail.create_from_prepared(chunk, mailbox_id)
+                values['imported'] += len(chunk)
+                del chunk[:]
+            duration = time.time() - start
+            values['duration'] = previous_duration + duration
+            self.write([self], values)
+            if commit:
+                Transaction().cursor.commit()
+            logger.info('%s: %s messages imported (%.1f messages/s)',
+                path, values['imported'], duration
+                and (values['imported'] - previous_imported) / duration
+                or 0.0)
+            if INSTRUMENTATION.enabled:
+                # The stages of the chunk
+                logger.info('%s: %s', path,
+                    INSTRUMENTATION.summary(measured[0]))
+                measured[0] = INSTRUMENTATION.dump()
+
+        prepared = iter_prepared(Transaction().cursor.dbname,
+            reader(path, values[position]), get_codec(), workers)
+        for prepared_mail, offset in prepared:
+            chunk.append(prepared_mail)
+            values[position] = offset
+            if len(chunk) >= chunk_size:
+                flush()
+        flush()
+        self.write([self], {'state': 'done'})
+        if commit:
+            Transaction().cursor.commit()
+
+
+class ImportMailboxStart(ModelView):
+    'Import Mailbox'
+    __name__ = 'electronic_mail.import_mailbox.start'
+
+    path = fields.Char('Path', required=True,
+        help='Path of the mbox file or Maildir directory on the server')
+    type_ = fields.Selection([
+            ('mbox', 'mbox'),
+            ('maildir', 'Maildir'),
+            ], 'Type', required=True)
+    mailbox = fields.Many2One('electronic_mail.mailbox', 'Mailbox',
+        required=True)
+    chunk_size = fields.Integer('Chunk Size', required=True,
+        help='Number of messages created and committed at once')
+    workers = fields.Integer('Workers', required=True,
+        help='Number of processes parsing, hashing and compressing the '
+        'messages, none to do it in the server process')
+
+    @staticmethod
+    def default_type_():
+        return 'mbox'
+
+    @staticmethod
+    def default_chunk_size():
+        return 500
+
+    @staticmethod
+    def default_workers():
+        return 0
+
+
+class ImportMailboxDone(ModelView):
+    'Import Mailbox'
+    __name__ = 'electronic_mail.import_mailbox.done'
+
+    imported = fields.Integer('Imported', readonly=True)
+    rate = fields.Float('Messages/Second', readonly=True)
+
+
+class ImportMailbox(Wizard):
+    'Import Mailbox'
+    __name__ = 'electronic_mail.import_mailbox'
+
+    start = StateView('electronic_mail.import_mailbox.start',
+        'electronic_mail.import_mailbox_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+    done = StateView('electronic_mail.import_mailbox.done',
+        'electronic_mail.import_mailbox_done_view_form', [
+            Button('Close', 'end', 'tryton-close'),
+            ])
+
+    def _get_import(self):
+        "Returns the unfinished import of the source or a new one"
+        MailboxImport = Pool().get('electronic_mail.import')
+        imports = MailboxImport.search([
+                ('path', '=', self.start.path),
+                ('type_', '=', self.start.type_),
+                ('mailbox', '=', self.start.mailbox.id),
+                ('state', '!=', 'done'),
+                ], limit=1)
+        if imports:
+            import_, = imports
+            MailboxImport.write(imports, {
+                    'chunk_size': self.start.chunk_size,
+                    'workers': self.start.workers,
+                    })
+            return import_
+        import_, = MailboxImport.create([{
+                    'path': self.start.path,
+                    'type_': self.start.type_,
+                    'mailbox': self.start.mailbox.id,
+                    'chunk_size': self.start.chunk_size,
+                    'workers': self.start.workers,
+                    }])
+        return import_
+
+    def transition_import_(self):
+        MailboxImport = Pool().get('electronic_mail.import')
+        MailboxImport.process([self._get_import()])
+        return 'done'
+
+    def default_done(self, fields):
+        MailboxImport = Pool().get('electronic_mail.import')
+        import_, = MailboxImport.search([
+                ('path', '=', self.start.path),
+                ('type_', '=', self.start.type_),
+                ('mailbox', '=', self.start.mailbox.id),
+                ], order=[('id', 'DESC')], limit=1)
+        return {
+            'imported': import_.imported,
+            'rate': import_.rate,
+            }
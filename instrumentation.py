@@ -0,0 +1,216 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+"Instrumentation"
+
+import time
+from threading import Lock
+
+from trytond.config import CONFIG
+
+
+__all__ = ['BUCKETS', 'Instrumentation', 'INSTRUMENTATION']
+
+# The upper bounds in milliseconds of the buckets of the latency histograms
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+
+class _NullStage(object):
+    "Context of a stage when the instrumentation is disabled"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    "Context timing a stage"
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.instrumentation.record(self.name,
+            (time.time() - self.start) * 1000)
+
+
+class _CountedExecute(object):
+    "Context counting the statements executed by a cursor"
+
+    def __init__(self, instrumentation, cursor, name):
+        self.instrumentation = instrumentation
+        self.cursor = cursor
+        self.name = name
+
+    def __enter__(self):
+        self.previous = self.cursor.__dict__.get('execute')
+        execute = self.cursor.execute
+        count = self.instrumentation.count
+        name = self.name
+
+        def counted_execute(*args, **kwargs):
+            count(name)
+            return execute(*args, **kwargs)
+        self.cursor.execute = counted_execute
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.previous is None:
+            del self.cursor.execute
+        else:
+            self.cursor.execute = self.previous
+
+
+class Instrumentation(object):
+    """
+    Per-process latency histograms of the stages of the storage and of the
+    ingestion of the emails and counters of their I/O and SQL statements.
+    It is enabled by the email_instrumentation option of the
+    configuration, when disabled a stage costs a lookup of the option.
+    """
+
+    def __init__(self):
+        self._stages = {}
+        self._counters = {}
+        self._lock = Lock()
+
+    @property
+    def enabled(self):
+        return bool(CONFIG.get('email_instrumentation'))
+
+    def stage(self, name):
+        "Returns a context recording the time spent in it under the name"
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def count_statements(self, cursor, name='sql_statements'):
+        """
+        Returns a context counting under the name the statements executed
+        by the cursor in it
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _CountedExecute(self, cursor, name)
+
+    def record(self, name, elapsed):
+        "Adds a duration in milliseconds to the histogram of the stage"
+        index = len(BUCKETS)
+        for i, bound in enumerate(BUCKETS):
+            if elapsed <= bound:
+                index = i
+                break
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = {
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'histogram': [0] * (len(BUCKETS) + 1),
+                    }
+            stage['count'] += 1
+            stage['total_ms'] += elapsed
+            stage['max_ms'] = max(stage['max_ms'], elapsed)
+            stage['histogram'][index] += 1
+
+    def count(self, name, value=1):
+        "Adds the value to the counter"
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def dump(self):
+        "Returns a copy of the raw histograms and counters"
+        with self._lock:
+            return {
+                'stages': dict((n, dict(s, histogram=list(s['histogram'])))
+                    for n, s in self._stages.iteritems()),
+                'counters': dict(self._counters),
+                }
+
+    def merge(self, data):
+        "Adds the histograms and counters returned by dump of a process"
+        if not data:
+            return
+        with self._lock:
+            for name, value in data['counters'].iteritems():
+                self._counters[name] = self._counters.get(name, 0) + value
+            for name, other in data['stages'].iteritems():
+                stage = self._stages.get(name)
+                if stage is None:
+                    self._stages[name] = dict(other,
+                        histogram=list(other['histogram']))
+                    continue
+                stage['count'] += other['count']
+                stage['total_ms'] += other['total_ms']
+                stage['max_ms'] = max(stage['max_ms'], other['max_ms'])
+                stage['histogram'] = [x + y for x, y
+                    in zip(stage['histogram'], other['histogram'])]
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+
+    def stats(self, since=None):
+        """
+        Returns a dictionary with the counters and per stage the number of
+        calls, the total, mean and maximum milliseconds and the histogram
+        as the list of the upper bound of the buckets and their count, the
+        last bound being None
+
+        :param since: The dump from which the stats are computed, from the
+            start when None. The maximum is the one since the start.
+        """
+        data = self.dump()
+        since = since or {'stages': {}, 'counters': {}}
+        stats = {}
+        for name, value in data['counters'].iteritems():
+            value -= since['counters'].get(name, 0)
+            if value:
+                stats[name] = value
+        bounds = BUCKETS + [None]
+        for name, stage in data['stages'].iteritems():
+            previous = since['stages'].get(name)
+            count, total = stage['count'], stage['total_ms']
+            histogram = stage['histogram']
+            if previous:
+                count -= previous['count']
+                total -= previous['total_ms']
+                histogram = [x - y for x, y
+                    in zip(histogram, previous['histogram'])]
+            if not count:
+                continue
+            stats[name] = {
+                'count': count,
+                'total_ms': total,
+                'mean_ms': total / count,
+                'max_ms': stage['max_ms'],
+                'histogram': [[b, c] for b, c in zip(bounds, histogram)
+                    if c],
+                }
+        return stats
+
+    def summary(self, since=None):
+        "Returns the stats as a line of text"
+        items = []
+        for name, value in sorted(self.stats(since).iteritems()):
+            if isinstance(value, dict):
+                items.append('%s %sx %.1fms (mean %.2fms, max %.2fms)'
+                    % (name, value['count'], value['total_ms'],
+                        value['mean_ms'], value['max_ms']))
+            else:
+                items.append('%s=%s' % (name, value))
+        return ', '.join(items)
+
+INSTRUMENTATION = Instrumentation()
@@ -0,0 +1,183 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+"MIME parsing on buffers"
+
+import re
+import base64
+import binascii
+import quopri
+from datetime import datetime
+from email.parser import HeaderParser
+from email.utils import parsedate_tz, mktime_tz, getaddresses
+
+from .fulltext import decode_header_text
+
+
+__all__ = ['header_end', 'parse_headers', 'iter_parts', 'is_attachment',
+    'decode_body', 'parse_date', 'received_date', 'parse_addresses',
+    'mbox_from_line', 'mbox_quote']
+
+_FROM_LINE = re.compile(r'^>*From ')
+_DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+_MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+    'Oct', 'Nov', 'Dec']
+
+
+def header_end(buffer, start=0, end=None):
+    """
+    Returns the position of the body of the part in buffer[start:end]: just
+    after the blank line ending the headers or end when there is no body.
+    The buffer can be a string or a memory map, it is not copied.
+    """
+    if end is None:
+        end = len(buffer)
+    positions = []
+    for separator in ('\n\n', '\r\n\r\n'):
+        position = buffer.find(separator, start, end)
+        if position >= 0:
+            positions.append(position + len(separator))
+    return positions and min(positions) or end
+
+
+def parse_headers(buffer, start=0, end=None):
+    """
+    Returns an email.message holding the headers of the part in
+    buffer[start:end]. Only the header section is copied.
+    """
+    body = header_end(buffer, start, end)
+    return HeaderParser().parsestr(buffer[start:body])
+
+
+def iter_parts(buffer, start=0, end=None):
+    """
+    Yields the leaf parts of the message in buffer[start:end] as tuples of
+    the email.message of the headers, the start and the end of the body.
+    Multipart boundaries are located in the buffer so only the headers are
+    copied and the caller slices the bodies it needs.
+    """
+    if end is None:
+        end = len(buffer)
+    headers = parse_headers(buffer, start, end)
+    body = header_end(buffer, start, end)
+    boundary = None
+    if headers.get_content_maintype() == 'multipart':
+        boundary = headers.get_boundary()
+    if not boundary:
+        yield headers, body, end
+        return
+    delimiter = '--' + boundary
+    position = buffer.find(delimiter, body, end)
+    while position >= 0:
+        after = position + len(delimiter)
+        if buffer[after:after + 2] == '--':
+            # Close delimiter
+            break
+        line_end = buffer.find('\n', after, end)
+        if line_end < 0:
+            break
+        part_start = line_end + 1
+        next_position = buffer.find('\n' + delimiter, part_start, end)
+        if next_position < 0:
+            part_end = end
+        elif buffer[next_position - 1:next_position] == '\r':
+            # The line break before the delimiter belongs to it
+            part_end = next_position - 1
+        else:
+            part_end = next_position
+        for part in iter_parts(buffer, part_start, part_end):
+            yield part
+        if next_position < 0:
+            break
+        position = next_position + 1
+
+
+def is_attachment(headers):
+    "Returns True if the headers of the leaf part are of an attachment"
+    disposition = headers.get('Content-Disposition', '')
+    return bool(headers.get_filename()
+        or disposition.strip().lower().startswith('attachment'))
+
+
+def decode_body(body, encoding):
+    """
+    Returns the body of a part decoded from its Content-Transfer-Encoding.
+    A malformed body is returned as it is like email.message does.
+    """
+    encoding = (encoding or '').lower()
+    if encoding == 'base64':
+        try:
+            return base64.decodestring(body)
+        except binascii.Error:
+            return body
+    elif encoding == 'quoted-printable':
+        return quopri.decodestring(body)
+    return body
+
+
+def parse_date(value):
+    """
+    Returns the naive UTC datetime of a RFC 2822 date or None when it is
+    malformed. The dates without timezone are taken as UTC.
+    """
+    if not value:
+        return None
+    try:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        if parsed[9] is None:
+            parsed = parsed[:9] + (0,)
+        return datetime.utcfromtimestamp(mktime_tz(parsed))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def received_date(headers):
+    """
+    Returns the naive UTC datetime of the most recent Received header of
+    the email.message with a valid date or None
+    """
+    for received in headers.get_all('received') or []:
+        date = parse_date(received.rpartition(';')[2].strip())
+        if date:
+            return date
+    return None
+
+
+def parse_addresses(value):
+    """
+    Returns the list of the display names and the lower cased addresses of
+    a header value listing addresses
+    """
+    if not value:
+        return []
+    addresses = []
+    for name, address in getaddresses([value]):
+        address = address.strip().lower()
+        if address:
+            addresses.append((decode_header_text(name) or None, address))
+    return addresses
+
+
+def mbox_from_line(address, date):
+    """
+    Returns the line separating the messages of a mbox file
+
+    :param address: Address of the sender, MAILER-DAEMON when None
+    :param date: Naive UTC datetime of the message
+    """
+    # The date is formatted as by asctime which rejects the old years
+    return 'From %s %s %s %2d %02d:%02d:%02d %d\n' % (
+        address or 'MAILER-DAEMON', _DAYS[date.weekday()],
+        _MONTHS[date.month - 1], date.day, date.hour, date.minute,
+        date.second, date.year)
+
+
+def mbox_quote(line):
+    """
+    Returns the line of a message quoted as in the mboxrd format, where the
+    lines starting with "From " after any number of ">" get one more ">"
+    """
+    if _FROM_LINE.match(line):
+        return '>' + line
+    return line
@@ -0,0 +1,662 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+"Email Storage"
+
+import os
+import mmap
+import zlib
+from StringIO import StringIO
+import bz2
+from itertools import count
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+from trytond.tools import OrderedDict
+
+from .instrumentation import INSTRUMENTATION
+
+
+__all__ = ['Storage', 'FileSystemStorage', 'STORAGES', 'get_storage',
+    'CODECS', 'get_codec', 'content_name', 'encode', 'decode',
+    'DecodedFile', 'decode_file', 'SplicedFile', 'SliceFile', 'WriteBehind',
+    'get_write_behind', 'ContentCache', 'CACHE']
+
+
+class Storage(object):
+    """
+    Base class of the backends storing the email contents
+
+    The contents are addressed by name: the SHA-256 digest of the data
+    followed by the codec when it is compressed or, for the contents stored
+    before, the MD5 digest followed by the collision index when it is not 0.
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+
+    def exists(self, name):
+        "Returns True if a content is stored under the name"
+        raise NotImplementedError
+
+    def get(self, name):
+        "Returns the content stored under the name or None"
+        raise NotImplementedError
+
+    def open(self, name):
+        """
+        Returns a file-like object reading the content stored under the name
+        or None. The caller must close it.
+        """
+        data = self.get(name)
+        if data is None:
+            return None
+        return StringIO(data)
+
+    def open_slice(self, name, offset, length):
+        """
+        Returns a file-like object reading length bytes from the offset of
+        the content stored under the name or None. The caller must close it.
+        """
+        file_p = self.open(name)
+        if file_p is None:
+            return None
+        file_p.seek(offset)
+        return SliceFile(file_p, length)
+
+    def map(self, name):
+        """
+        Returns a read-only buffer of the content stored under the name or
+        None. Backends which can map the content in memory return the map
+        to avoid copying it, the caller must close it.
+        """
+        return self.get(name)
+
+    def set(self, name, data):
+        "Stores the data under the name"
+        raise NotImplementedError
+
+    def stage(self, name, data):
+        """
+        Prepares the storage of the data under the name without making it
+        readable and returns the token to publish or discard it. It can be
+        called from other threads.
+        """
+        return data
+
+    def publish(self, name, token):
+        "Makes the data staged under the name readable"
+        self.set(name, token)
+
+    def discard(self, token):
+        "Removes the data staged"
+        pass
+
+    def delete(self, name):
+        "Removes the content stored under the name if any"
+        raise NotImplementedError
+
+    def mtime(self, name):
+        """
+        Returns the time of the last modification of the content stored
+        under the name or None
+        """
+        raise NotImplementedError
+
+    def iter_names(self):
+        """
+        Yields the names of all the stored contents in a stable order with
+        the time of their last modification, including the temporary names
+        of the contents being written
+        """
+        raise NotImplementedError
+
+
+class FileSystemStorage(Storage):
+    """
+    Stores the contents as files under <DATA PATH>/<DB NAME>/email
+
+    The files are sharded on two levels of directories by the first four
+    characters of the digest. The files named by MD5 digests keep the
+    previous layout with one level.
+    """
+    # Directories known to exist, shared by all the instances
+    _directories = set()
+    # Numbers of the temporary files of the process
+    _temp_numbers = count()
+
+    def __init__(self, db_name):
+        super(FileSystemStorage, self).__init__(db_name)
+        self.directory = os.path.join(CONFIG['data_path'], db_name, 'email')
+
+    def path(self, name):
+        "Returns the filename of the name"
+        digest = name.split('-', 1)[0].split('.', 1)[0]
+        if len(digest) == 32:
+            return os.path.join(self.directory, digest[0:2], name)
+        return os.path.join(self.directory, digest[0:2], digest[2:4], name)
+
+    def makedirs(self, directory):
+        "Creates the directory unless it is known to exist"
+        if directory in self._directories:
+            return
+        if not os.path.isdir(directory):
+            INSTRUMENTATION.count('makedirs')
+            try:
+                os.makedirs(directory, 0770)
+            except OSError:
+                # Created meanwhile by another process
+                if not os.path.isdir(directory):
+                    raise
+        self._directories.add(directory)
+
+    def exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def get(self, name):
+        try:
+            with open(self.path(name), 'rb') as file_p:
+                INSTRUMENTATION.count('file_opens')
+                data = file_p.read()
+        except IOError:
+            return None
+        INSTRUMENTATION.count('bytes_read', len(data))
+        return data
+
+    def open(self, name):
+        try:
+            file_p = open(self.path(name), 'rb')
+        except IOError:
+            return None
+        INSTRUMENTATION.count('file_opens')
+        return file_p
+
+    def map(self, name):
+        file_p = self.open(name)
+        if file_p is None:
+            return None
+        with file_p:
+            try:
+                mapped = mmap.mmap(file_p.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can not be mapped
+                return ''
+        INSTRUMENTATION.count('bytes_mapped', len(mapped))
+        return mapped
+
+    def set(self, name, data):
+        self.publish(name, self.stage(name, data))
+
+    def stage(self, name, data):
+        """
+        Writes the data to a temporary file renamed into place by publish
+        so a content is never read partially written. The temporary file
+        is unique to the call so concurrent writers of a name do not mix
+        their data. It is synced to the disk when the email_fsync option of
+        the configuration is set.
+        """
+        filename = self.path(name)
+        directory = os.path.dirname(filename)
+        self.makedirs(directory)
+        temp_filename = '%s.tmp-%s-%s' % (filename, os.getpid(),
+            self._temp_numbers.next())
+        try:
+            file_p = open(temp_filename, 'wb')
+        except IOError:
+            # The directory has been removed since it was cached
+            self._directories.discard(directory)
+            self.makedirs(directory)
+            file_p = open(temp_filename, 'wb')
+        with file_p:
+            file_p.write(data)
+            if CONFIG.get('email_fsync'):
+                file_p.flush()
+                os.fsync(file_p.fileno())
+        INSTRUMENTATION.count('file_opens')
+        INSTRUMENTATION.count('bytes_written', len(data))
+        return temp_filename
+
+    def publish(self, name, token):
+        # The rename replaces atomically the file of a concurrent writer
+        # which holds the same data
+        os.rename(token, self.path(name))
+
+    def discard(self, token):
+        try:
+            os.remove(token)
+        except OSError:
+            pass
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except OSError:
+            pass
+
+    def mtime(self, name):
+        try:
+            return os.path.getmtime(self.path(name))
+        except OSError:
+            return None
+
+    def iter_names(self):
+        for root, directories, names in os.walk(self.directory):
+            directories.sort()
+            for name in sorted(names):
+                try:
+                    mtime = os.path.getmtime(os.path.join(root, name))
+                except OSError:
+                    # Removed meanwhile
+                    continue
+                yield name, mtime
+
+STORAGES = {
+    'filesystem': FileSystemStorage,
+    }
+
+
+# The compress function, the decompress function and the factory of
+# incremental decompressors of each codec
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompress, zlib.decompressobj),
+    'bz2': (bz2.compress, bz2.decompress, bz2.BZ2Decompressor),
+    }
+if lzma:
+    CODECS['lzma'] = (lzma.compress, lzma.decompress, lzma.LZMADecompressor)
+
+
+def get_codec():
+    """
+    Returns the codec compressing the new contents of the database of the
+    transaction or None. It is selected by the email_codec_<DB NAME> option
+    of the configuration or else by the email_codec option.
+    """
+    db_name = Transaction().cursor.dbname
+    codec = (CONFIG.get('email_codec_%s' % db_name)
+        or CONFIG.get('email_codec') or None)
+    if codec and codec not in CODECS:
+        raise ValueError('Unknown email codec "%s"' % codec)
+    return codec
+
+
+def content_name(digest, codec):
+    "Returns the name of the content of the digest compressed by the codec"
+    if codec:
+        return '%s.%s' % (digest, codec)
+    return digest
+
+
+def encode(data, codec):
+    "Compresses the data with the codec"
+    if not codec:
+        return data
+    return CODECS[codec][0](data)
+
+
+def decode(data, codec):
+    "Decompresses the data with the codec"
+    if not codec or data is None:
+        return data
+    return CODECS[codec][1](data)
+
+
+class DecodedFile(object):
+    """
+    Read-only file-like object decompressing a stored content on the fly so
+    only a chunk of the content is held in memory
+    """
+    chunk_size = 65536
+
+    def __init__(self, file_p, codec):
+        self.file_p = file_p
+        self.decompressor = CODECS[codec][2]()
+        self.buffer = ''
+        self.start = 0
+        self.position = 0
+        self.eof = False
+
+    def _read_chunk(self):
+        "Returns the next decompressed data, maybe empty, and sets eof"
+        chunk = self.file_p.read(self.chunk_size)
+        if chunk:
+            return self.decompressor.decompress(chunk)
+        self.eof = True
+        if hasattr(self.decompressor, 'flush'):
+            return self.decompressor.flush()
+        return ''
+
+    def _buffered(self):
+        "Returns the number of bytes of the buffer not read yet"
+        return len(self.buffer) - self.start
+
+    def _fill(self, size=None):
+        """
+        Reads until the buffer holds size bytes not read yet or the end.
+        The bytes read are dropped from the buffer only when it is filled
+        so reading it by lines does not copy the rest of it each time.
+        """
+        chunks = []
+        length = self._buffered()
+        while not self.eof and (size is None or length < size):
+            chunk = self._read_chunk()
+            if chunk:
+                chunks.append(chunk)
+                length += len(chunk)
+        if chunks:
+            self.buffer = self.buffer[self.start:] + ''.join(chunks)
+            self.start = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            self._fill()
+            size = self._buffered()
+        else:
+            self._fill(size)
+        data = self.buffer[self.start:self.start + size]
+        self.start += len(data)
+        if self.start >= len(self.buffer):
+            self.buffer, self.start = '', 0
+        self.position += len(data)
+        return data
+
+    def readline(self):
+        index = self.buffer.find('\n', self.start)
+        while index < 0 and not self.eof:
+            searched = self._buffered()
+            # The buffer grows geometrically so a long line is not read
+            # again for each chunk
+            self._fill(2 * searched + self.chunk_size)
+            index = self.buffer.find('\n', self.start + searched)
+        return self.read(index < 0 and -1 or index - self.start + 1)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        "Moves forward by decompressing and dropping the data"
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence != os.SEEK_SET or offset < self.position:
+            raise IOError('DecodedFile can only seek forward')
+        while self.position < offset:
+            if not self.read(min(offset - self.position, self.chunk_size)):
+                break
+
+    def tell(self):
+        return self.position
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.chunk_size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self.file_p.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def decode_file(file_p, codec):
+    "Returns a file-like object decompressing file_p with the codec"
+    if not codec or file_p is None:
+        return file_p
+    return DecodedFile(file_p, codec)
+
+
+class SplicedFile(DecodedFile):
+    """
+    Read-only file-like object of a content whose parts are stored apart:
+    the stored skeleton is read with the parts inserted at their position
+    """
+
+    def __init__(self, file_p, parts):
+        """
+        :param file_p: File-like object of the skeleton
+        :param parts: List of tuples of the start and end positions of the
+            parts in the content and of a function opening the part
+        """
+        self.file_p = file_p
+        self.parts = sorted(parts)
+        self.part_p = None
+        self.offset = 0
+        self.buffer = ''
+        self.start = 0
+        self.position = 0
+        self.eof = False
+
+    def _read_chunk(self):
+        "Returns the next data of the skeleton or of the part being read"
+        if self.part_p is not None:
+            chunk = self.part_p.read(self.chunk_size)
+            if not chunk:
+                self.part_p.close()
+                self.part_p = None
+        elif self.parts and self.parts[0][0] <= self.offset:
+            _, _, open_part = self.parts.pop(0)
+            self.part_p = open_part()
+            if self.part_p is None:
+                raise IOError('A part of the content is missing')
+            return ''
+        else:
+            length = self.chunk_size
+            if self.parts:
+                length = min(length, self.parts[0][0] - self.offset)
+            chunk = self.file_p.read(length)
+            if not chunk:
+                self.eof = True
+        self.offset += len(chunk)
+        return chunk
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        "Moves forward without reading the parts before the offset"
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence != os.SEEK_SET or offset < self.position:
+            raise IOError('SplicedFile can only seek forward')
+        while (self.part_p is None and not self._buffered() and self.parts
+                and self.parts[0][1] <= offset):
+            start, end, _ = self.parts[0]
+            DecodedFile.seek(self, start)
+            if self._buffered() or self.part_p is not None:
+                break
+            # Skip the part as if it was read
+            self.parts.pop(0)
+            self.offset = self.position = end
+        DecodedFile.seek(self, offset)
+
+    def close(self):
+        if self.part_p is not None:
+            self.part_p.close()
+        self.file_p.close()
+
+
+class SliceFile(DecodedFile):
+    """
+    Read-only file-like object reading a slice of a file, as a content
+    stored in a pack file
+    """
+
+    def __init__(self, file_p, length):
+        """
+        :param file_p: File-like object positioned at the start of the slice
+        :param length: Length of the slice
+        """
+        self.file_p = file_p
+        self.remaining = length
+        self.buffer = ''
+        self.start = 0
+        self.position = 0
+        self.eof = False
+
+    def _read_chunk(self):
+        "Returns the next data of the slice"
+        chunk = self.file_p.read(min(self.chunk_size, self.remaining))
+        if not chunk:
+            self.eof = True
+        self.remaining -= len(chunk)
+        return chunk
+
+
+class WriteBehind(object):
+    """
+    Stages the contents in a pool of threads while the transaction goes on
+    and publishes them when it is joined, before the transaction is
+    committed. When it is aborted the staged contents are discarded so a
+    rolled back transaction leaves no file.
+    """
+    _pools = {}
+    _lock = Lock()
+
+    def __init__(self, storage, workers):
+        self.storage = storage
+        self.pending = []
+        with self._lock:
+            self.pool = self._pools.get(workers)
+            if self.pool is None:
+                self.pool = self._pools[workers] = ThreadPool(workers)
+
+    def set(self, name, data):
+        "Stages the data to be stored under the name"
+        self.pending.append((name,
+                self.pool.apply_async(self.storage.stage, (name, data))))
+
+    def _wait(self):
+        "Returns the staged tokens by name and the first error"
+        staged, error = [], None
+        pending, self.pending = self.pending, []
+        for name, result in pending:
+            try:
+                staged.append((name, result.get()))
+            except Exception, exception:
+                error = error or exception
+        return staged, error
+
+    def join(self):
+        "Waits for the staged contents and publishes them"
+        staged, error = self._wait()
+        if error:
+            for _, token in staged:
+                self.storage.discard(token)
+            raise error
+        for name, token in staged:
+            self.storage.publish(name, token)
+
+    def abort(self):
+        "Waits for the staged contents and discards them"
+        staged, _ = self._wait()
+        for _, token in staged:
+            self.storage.discard(token)
+
+
+def get_write_behind():
+    """
+    Returns a WriteBehind of the storage of the database of the transaction
+    or None. Its number of threads is set by the email_write_behind option
+    of the configuration, none disables it. It is disabled by the
+    email_paranoid_dedup option which reads the contents just stored.
+    """
+    workers = int(CONFIG.get('email_write_behind') or 0)
+    if not workers or CONFIG.get('email_paranoid_dedup'):
+        return None
+    return WriteBehind(get_storage(), workers)
+
+
+def get_storage():
+    """
+    Returns the storage of the database of the transaction, selected by the
+    email_storage option of the configuration
+    """
+    name = CONFIG.get('email_storage') or 'filesystem'
+    return STORAGES[name](Transaction().cursor.dbname)
+
+
+class ContentCache(object):
+    """
+    Per-process LRU cache of the stored contents and of their parsed
+    messages bounded by the total size in bytes set by the email_cache_size
+    option of the configuration. The entries are keyed by the kind of value
+    and the database name, digest and collision of the content. Contents
+    are never modified once stored so the entries are never invalidated.
+    """
+    default_max_size = 32 * 1024 * 1024
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+        self._counters = {}
+
+    @property
+    def max_size(self):
+        max_size = CONFIG.get('email_cache_size')
+        if max_size is None:
+            return self.default_max_size
+        return int(max_size)
+
+    def _count(self, kind, counter):
+        counters = self._counters.setdefault(kind, {'hits': 0, 'misses': 0})
+        counters[counter] += 1
+
+    def get(self, kind, key):
+        "Returns the cached value or None"
+        with self._lock:
+            try:
+                value, size = self._entries.pop((kind,) + key)
+            except KeyError:
+                self._count(kind, 'misses')
+                return None
+            # Move the entry to the most recently used end
+            self._entries[(kind,) + key] = (value, size)
+            self._count(kind, 'hits')
+            return value
+
+    def set(self, kind, key, value, size):
+        "Caches the value accounting for size bytes"
+        max_size = self.max_size
+        if size > max_size:
+            return
+        with self._lock:
+            previous = self._entries.pop((kind,) + key, None)
+            if previous:
+                self._size -= previous[1]
+            self._entries[(kind,) + key] = (value, size)
+            self._size += size
+            while self._size > max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self._counters.clear()
+
+    def stats(self):
+        """
+        Returns a dictionary with the number of entries, the cached size,
+        the maximum size and the hits and misses per kind of value
+        """
+        with self._lock:
+            stats = {
+                'entries': len(self._entries),
+                'size': self._size,
+                'max_size': self.max_size,
+                }
+            for kind, counters in self._counters.iteritems():
+                for counter, value in counters.iteritems():
+                    stats['%s_%s' % (kind, counter)] = value
+            return stats
+
+CACHE = ContentCache()
@@ -0,0 +1,633 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Electronic Mail benchmarks
+
+The benchmarks run against the database of the tests: SQLite in memory
+unless the configuration of trytond sets another db_type, as PostgreSQL.
+The results are printed and can be written as JSON with --output. Given
+the JSON of a previous run with --baseline, the run fails when a result
+regresses by more than --threshold.
+"""
+
+import sys, os
+DIR = os.path.abspath(os.path.normpath(os.path.join(__file__,
+    '..', '..', '..', '..', '..', 'trytond')))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import time
+import random
+import resource
+import tempfile
+import shutil
+import cPickle
+import json
+import optparse
+
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+from email.utils import formatdate
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+from trytond.config import CONFIG
+from trytond.modules.electronic_mail.storage import CODECS, encode, decode, \
+    FileSystemStorage
+from trytond.modules.electronic_mail.mime import header_end, iter_parts
+from trytond.modules.electronic_mail.storage import CACHE
+
+WORDS = ('the', 'meeting', 'invoice', 'tryton', 'please', 'find', 'attached',
+    'regards', 'report', 'quarter', 'delivery', 'order', 'customer', 'thanks',
+    'schedule', 'update', 'review', 'project', 'module', 'server')
+
+# The sizes of the attachments of a corpus with their frequency
+ATTACHMENT_SIZES = [
+    (0, 60),
+    (8 * 1024, 20),
+    (64 * 1024, 15),
+    (512 * 1024, 5),
+    ]
+# The direction of the metrics: 1 when higher is better, -1 when lower is
+METRICS = {
+    'ratio': 1,
+    'encode_ms': -1,
+    'decode_ms': -1,
+    'mb_per_s': 1,
+    'peak_rss_kb': -1,
+    'ms': -1,
+    'per_s': 1,
+    'mails_per_s': 1,
+    'header_rows': -1,
+    'header_kb': -1,
+    'read_ms': -1,
+    'messages_per_s': 1,
+    'stored_kb': -1,
+    }
+
+
+def random_bytes(rand, size):
+    "Returns size random bytes drawn from rand"
+    if not size:
+        return ''
+    return ('%0*x' % (size * 2, rand.getrandbits(size * 8))).decode('hex')
+
+
+def make_message(index, body_lines=60, attachment_size=0, rand=None,
+        hops=4, attachment=None):
+    """
+    Returns a synthetic email.message with realistic headers, a text body
+    of body_lines lines and an attachment of attachment_size random bytes
+    or of the attachment data
+    """
+    rand = rand or random.Random(index)
+    message = MIMEMultipart()
+    message['Date'] = formatdate(1357000000 + index * 60)
+    message['From'] = 'sender%s@example.com' % (index % 50)
+    message['To'] = 'recipient%s@example.com' % (index % 200)
+    message['Subject'] = ' '.join(rand.choice(WORDS) for _ in xrange(6))
+    message['Message-ID'] = '<%s@benchmark.example.com>' % index
+    for hop in xrange(hops):
+        message['Received'] = 'from relay%s.example.com by mx.example.com ' \
+            'with ESMTP id %s' % (hop, rand.getrandbits(64))
+    message['X-Spam-Status'] = 'No, score=-1.0'
+    body = '\n'.join(' '.join(rand.choice(WORDS) for _ in xrange(12))
+        for _ in xrange(body_lines))
+    message.attach(MIMEText(body, 'plain'))
+    if attachment is None and attachment_size:
+        attachment = random_bytes(rand, attachment_size)
+    if attachment:
+        part = MIMEApplication(attachment, 'octet-stream')
+        part.add_header('Content-Disposition', 'attachment',
+            filename='attachment%s.bin' % index)
+        message.attach(part)
+    return message
+
+
+def make_corpus(count, duplicate_ratio=0.2, rand=None):
+    """
+    Returns a list of count email.message with 2 to 8 Received headers,
+    attachments sized as ATTACHMENT_SIZES and a share of duplicate_ratio
+    duplicates: the same message delivered again or a new message
+    forwarding an attachment already seen
+    """
+    rand = rand or random.Random(0)
+    sizes = [s for s, frequency in ATTACHMENT_SIZES for _ in xrange(frequency)]
+    messages, attachments = [], []
+    for index in xrange(count):
+        if messages and rand.random() < duplicate_ratio:
+            if attachments and rand.random() < 0.5:
+                messages.append(make_message(index, rand=rand,
+                        hops=rand.randint(2, 8),
+                        attachment=rand.choice(attachments)))
+            else:
+                messages.append(rand.choice(messages))
+            continue
+        attachment = random_bytes(rand, rand.choice(sizes))
+        if attachment:
+            attachments.append(attachment)
+        messages.append(make_message(index, body_lines=rand.randint(5, 200),
+                rand=rand, hops=rand.randint(2, 8), attachment=attachment))
+    return messages
+
+
+def benchmark_codecs(count=200, attachment_size=4096):
+    """
+    Measures for each codec the stored size and the time to store and to
+    read back the contents
+
+    :return: List of dictionaries with codec, ratio, encode_ms and
+        decode_ms per message
+    """
+    datas = [make_message(i, attachment_size=attachment_size).as_string()
+        for i in xrange(count)]
+    raw_size = sum(len(d) for d in datas)
+    results = []
+    for codec in [None] + sorted(CODECS):
+        start = time.time()
+        stored = [encode(d, codec) for d in datas]
+        encode_time = time.time() - start
+        start = time.time()
+        for data in stored:
+            decode(data, codec)
+        decode_time = time.time() - start
+        results.append({
+                'codec': codec or 'none',
+                'ratio': raw_size / float(sum(len(s) for s in stored)),
+                'encode_ms': encode_time * 1000 / count,
+                'decode_ms': decode_time * 1000 / count,
+                })
+    return results
+
+
+def memory():
+    """
+    Returns the current and the peak resident set size in kilobytes. On
+    Linux the peak is reset to the current size by reset_peak_memory.
+    """
+    try:
+        with open('/proc/self/status') as file_p:
+            status = dict(line.split(':', 1) for line in file_p)
+        return (int(status['VmRSS'].split()[0]),
+            int(status['VmHWM'].split()[0]))
+    except (IOError, KeyError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak, peak
+
+
+def reset_peak_memory():
+    try:
+        with open('/proc/self/clear_refs', 'w') as file_p:
+            file_p.write('5')
+    except IOError:
+        pass
+
+
+def measure(function, *args):
+    """
+    Runs the function in a child process and returns its result with the
+    elapsed time in seconds and the growth of the peak resident set size
+    in kilobytes
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_fd)
+        reset_peak_memory()
+        rss, _ = memory()
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        rss = memory()[1] - rss
+        with os.fdopen(write_fd, 'wb') as file_p:
+            cPickle.dump((result, elapsed, rss), file_p)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as file_p:
+        result = cPickle.load(file_p)
+    os.waitpid(pid, 0)
+    return result
+
+
+def _read_parts(storage, names):
+    "Extracts headers and part types by reading the whole files"
+    count = 0
+    for name in names:
+        data = storage.get(name)
+        data[:header_end(data)]
+        count += len(list(iter_parts(data)))
+    return count
+
+
+def _map_parts(storage, names):
+    "Extracts headers and part types from memory maps"
+    count = 0
+    for name in names:
+        buffer = storage.map(name)
+        try:
+            buffer[:header_end(buffer)]
+            count += len(list(iter_parts(buffer)))
+        finally:
+            buffer.close()
+    return count
+
+
+def benchmark_read_paths(count=5, attachment_size=4 * 1024 * 1024):
+    """
+    Compares reading multi-MB stored messages into strings with mapping
+    them in memory to extract their headers and locate their parts
+
+    :return: List of dictionaries with mode, mb_per_s and peak_rss_kb
+    """
+    directory = tempfile.mkdtemp()
+    data_path = CONFIG['data_path']
+    CONFIG['data_path'] = directory
+    try:
+        storage = FileSystemStorage('benchmark')
+        names = []
+        total = 0
+        for i in xrange(count):
+            data = make_message(i, attachment_size=attachment_size
+                ).as_string()
+            name = 'benchmark-%s' % i
+            storage.set(name, data)
+            names.append(name)
+            total += len(data)
+        results = []
+        for mode, function in (('read', _read_parts), ('mmap', _map_parts)):
+            _, elapsed, rss = measure(function, storage, names)
+            results.append({
+                    'mode': mode,
+                    'mb_per_s': total / elapsed / 1024 / 1024,
+                    'peak_rss_kb': rss,
+                    })
+        return results
+    finally:
+        CONFIG['data_path'] = data_path
+        shutil.rmtree(directory)
+
+
+def create_mailboxes(users=100, mailboxes=200, rand=None):
+    """
+    Creates users and mailboxes with an owner, 3 read users and 2 write
+    users chosen among them
+
+    :return: Tuple of the list of user IDs and the list of mailboxes
+    """
+    ModelData = POOL.get('ir.model.data')
+    User = POOL.get('res.user')
+    Mailbox = POOL.get('electronic_mail.mailbox')
+    rand = rand or random.Random(0)
+    groups = [ModelData.get_id('electronic_mail', name)
+        for name in ('group_email_admin', 'group_email_user')]
+    user_ids = [u.id for u in User.create([{
+                    'login': 'benchmark_%s' % i,
+                    'name': 'Benchmark %s' % i,
+                    'groups': [('set', groups)],
+                    } for i in xrange(users)])]
+    mailboxes = Mailbox.create([{
+                'name': 'Mailbox %s' % i,
+                'user': rand.choice(user_ids),
+                'read_users': [('set', rand.sample(user_ids, 3))],
+                'write_users': [('set', rand.sample(user_ids, 2))],
+                } for i in xrange(mailboxes)])
+    return user_ids, mailboxes
+
+
+def benchmark_acl_search(users=100, mailboxes=200, mails=10000, runs=20):
+    """
+    Measures the search of mails by users with the access rules active and
+    compares the single sub-query of the mailbox access users with the
+    previous clauses on the mailbox owner, read users and write users
+
+    :return: List of dictionaries with query and ms per search
+    """
+    trytond.tests.test_tryton.install_module('electronic_mail')
+    Mail = POOL.get('electronic_mail')
+    Mailbox = POOL.get('electronic_mail.mailbox')
+    rand = random.Random(0)
+    with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+        user_ids, mailbox_records = create_mailboxes(users, mailboxes, rand)
+        with Transaction().set_user(0):
+            Mail.create([{
+                        'mailbox': rand.choice(mailbox_records).id,
+                        'subject': 'Mail %s' % i,
+                        } for i in xrange(mails)])
+        searches = (
+            ('rules', lambda user_id: Mail.search([], count=True), True),
+            ('access field', lambda user_id: Mail.search([
+                        ('mailbox_read_access', '=', user_id),
+                        ], count=True), False),
+            ('owner/read/write', lambda user_id: Mail.search(['OR',
+                        ('mailbox.user', '=', user_id),
+                        ('mailbox.read_users', '=', user_id),
+                        ('mailbox.write_users', '=', user_id),
+                        ], count=True), False),
+            ('rules subject', lambda user_id: Mail.search([
+                        ('subject', 'ilike', '%1%'),
+                        ], limit=50, order=[('date', 'DESC')]), True),
+            ('rules mailboxes', lambda user_id: Mailbox.search([]), True),
+            )
+        results = []
+        run_ids = user_ids[:runs]
+        for name, search, with_rules in searches:
+            start = time.time()
+            for user_id in run_ids:
+                with Transaction().set_user(with_rules and user_id or 0):
+                    search(user_id)
+            results.append({
+                    'query': name,
+                    'ms': (time.time() - start) * 1000 / len(run_ids),
+                    })
+        transaction.cursor.rollback()
+    return results
+
+
+def benchmark_ingestion(count=500, duplicate_ratio=0.3):
+    """
+    Measures the creation of the mails of a corpus one at a time, the
+    storage of the duplicates by set_email, the reading of the mails from
+    the storage and from the content cache and the size of the stored
+    contents
+
+    :return: List of dictionaries with operation, ms and per_s per mail and
+        with stored_kb
+    """
+    trytond.tests.test_tryton.install_module('electronic_mail')
+    Mailbox = POOL.get('electronic_mail.mailbox')
+    Mail = POOL.get('electronic_mail')
+    messages = make_corpus(count, duplicate_ratio)
+    datas = [m.as_string() for m in messages]
+    directory = tempfile.mkdtemp()
+    data_path = CONFIG['data_path']
+    CONFIG['data_path'] = directory
+    results = []
+
+    def result(operation, elapsed, count, stored=False):
+        results.append({
+                'operation': operation,
+                'ms': elapsed * 1000 / count,
+                'per_s': count / elapsed,
+                })
+        if stored:
+            results[-1]['stored_kb'] = stored_kb(directory)
+    try:
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mailbox, = Mailbox.create([{
+                        'name': 'Benchmark',
+                        'user': USER,
+                        }])
+            start = time.time()
+            mails = [Mail.create_from_email(m, mailbox.id) for m in messages]
+            result('create_from_email', time.time() - start, count, True)
+
+            copies = Mail.create([{
+                        'mailbox': mailbox.id,
+                        'subject': 'Copy %s' % i,
+                        } for i in xrange(count)])
+            start = time.time()
+            for copy, data in zip(copies, datas):
+                Mail.set_email([copy], 'email', data)
+            result('set_email duplicates', time.time() - start, count, True)
+
+            CACHE.clear()
+            start = time.time()
+            Mail.get_email(mails, 'email')
+            result('get_email', time.time() - start, count)
+            start = time.time()
+            Mail.get_email(mails, 'email')
+            result('get_email cached', time.time() - start, count)
+            transaction.cursor.rollback()
+    finally:
+        CONFIG['data_path'] = data_path
+        shutil.rmtree(directory)
+    return results
+
+
+def stored_kb(directory):
+    "Returns the size of the files under the directory in kilobytes"
+    size = 0
+    for root, _, names in os.walk(directory):
+        size += sum(os.path.getsize(os.path.join(root, n)) for n in names)
+    return size / 1024
+
+
+def benchmark_header_storage(count=2000, chunk_size=200):
+    """
+    Measures the creation of mails with their headers stored as header
+    lines and stored compactly in the mails, the rows and bytes the headers
+    take and the reading of the headers of a chunk of mails through the
+    header view
+
+    :return: List of dictionaries with storage, mails_per_s, header_rows,
+        header_kb and read_ms
+    """
+    trytond.tests.test_tryton.install_module('electronic_mail')
+    Mailbox = POOL.get('electronic_mail.mailbox')
+    Mail = POOL.get('electronic_mail')
+    HeaderLine = POOL.get('electronic_mail.header.line')
+    messages = [make_message(i) for i in xrange(count)]
+    header_storage = CONFIG.get('email_header_storage')
+    results = []
+    for storage in ('rows', 'compact'):
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            cursor = transaction.cursor
+            mailbox, = Mailbox.create([{
+                        'name': 'Benchmark',
+                        'user': USER,
+                        }])
+            CONFIG['email_header_storage'] = storage
+            try:
+                mails = []
+                start = time.time()
+                for i in xrange(0, count, chunk_size):
+                    mails.extend(Mail.create_from_emails(
+                            messages[i:i + chunk_size], mailbox.id))
+                elapsed = time.time() - start
+                start = time.time()
+                Mail.read([m.id for m in mails[:chunk_size]], ['headers'])
+                read = time.time() - start
+            finally:
+                CONFIG['email_header_storage'] = header_storage
+            cursor.execute('SELECT COUNT(*), '
+                    'SUM(LENGTH(name) + LENGTH(value)) '
+                'FROM "' + HeaderLine._table + '"')
+            rows, size = cursor.fetchone()
+            cursor.execute('SELECT SUM(LENGTH(raw_headers)) '
+                'FROM "' + Mail._table + '"')
+            size = (size or 0) + (cursor.fetchone()[0] or 0)
+            results.append({
+                    'storage': storage,
+                    'mails_per_s': count / elapsed,
+                    'header_rows': rows,
+                    'header_kb': size / 1024,
+                    'read_ms': read * 1000,
+                    })
+            cursor.rollback()
+    return results
+
+
+def benchmark_import(count=1000, workers=(0, 1, 2, 4), codec='zlib'):
+    """
+    Measures the import of a mbox file with a number of processes
+    preparing the messages
+
+    :return: List of dictionaries with workers and messages_per_s
+    """
+    trytond.tests.test_tryton.install_module('electronic_mail')
+    Mailbox = POOL.get('electronic_mail.mailbox')
+    Import = POOL.get('electronic_mail.import')
+    directory = tempfile.mkdtemp()
+    data_path = CONFIG['data_path']
+    email_codec = CONFIG.get('email_codec')
+    CONFIG['email_codec'] = codec
+    path = os.path.join(directory, 'mbox')
+    try:
+        with open(path, 'wb') as file_p:
+            for i in xrange(count):
+                file_p.write('From benchmark@example.com\n')
+                file_p.write(make_message(i, attachment_size=8192
+                        ).as_string() + '\n\n')
+        results = []
+        for worker_count in workers:
+            # Store the contents anew for each run
+            CONFIG['data_path'] = tempfile.mkdtemp(dir=directory)
+            with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+                mailbox, = Mailbox.create([{
+                            'name': 'Benchmark',
+                            'user': USER,
+                            }])
+                import_, = Import.create([{
+                            'path': path,
+                            'type_': 'mbox',
+                            'mailbox': mailbox.id,
+                            'chunk_size': 200,
+                            'workers': worker_count,
+                            }])
+                start = time.time()
+                import_._process(commit=False)
+                elapsed = time.time() - start
+                results.append({
+                        'workers': worker_count,
+                        'messages_per_s': count / elapsed,
+                        })
+                transaction.cursor.rollback()
+        return results
+    finally:
+        CONFIG['data_path'] = data_path
+        CONFIG['email_codec'] = email_codec
+        shutil.rmtree(directory)
+
+
+BENCHMARKS = [
+    ('codecs', 'Codecs: stored size and latency per message',
+        benchmark_codecs, {'count': 200},
+        ['codec', 'ratio', 'encode_ms', 'decode_ms']),
+    ('read_paths', 'Read paths: headers and parts of multi-MB messages',
+        benchmark_read_paths, {'count': 5},
+        ['mode', 'mb_per_s', 'peak_rss_kb']),
+    ('ingestion', 'Ingestion and retrieval of a corpus with duplicates',
+        benchmark_ingestion, {'count': 500},
+        ['operation', 'ms', 'per_s', 'stored_kb']),
+    ('acl_search', 'Searches per user with the access rules',
+        benchmark_acl_search, {'users': 100, 'mailboxes': 200,
+            'mails': 10000},
+        ['query', 'ms']),
+    ('header_storage', 'Header storage: mails created by chunks of 200',
+        benchmark_header_storage, {'count': 2000},
+        ['storage', 'mails_per_s', 'header_rows', 'header_kb', 'read_ms']),
+    ('import', 'Import of messages of 8KB attachments compressed by zlib',
+        benchmark_import, {'count': 1000},
+        ['workers', 'messages_per_s']),
+    ]
+
+
+def print_table(title, columns, rows):
+    "Prints the columns of the rows of a benchmark"
+    cells = [[isinstance(r.get(c), float) and '%.2f' % r[c]
+            or str(r.get(c, '')) for c in columns] for r in rows]
+    widths = [max(len(x) for x in [c] + [l[i] for l in cells])
+        for i, c in enumerate(columns)]
+    print title
+    for line in [columns] + cells:
+        print '  '.join(x.rjust(w) for x, w in zip(line, widths))
+    print
+
+
+def row_key(row):
+    "Returns the values identifying the row of a benchmark"
+    return tuple(sorted((k, v) for k, v in row.iteritems()
+            if k not in METRICS))
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the descriptions of the metrics of the results worse than in
+    the baseline by more than the threshold, a fraction of the baseline
+    """
+    regressions = []
+    for name, rows in results.iteritems():
+        previous = dict((row_key(r), r) for r in baseline.get(name, []))
+        for row in rows:
+            base = previous.get(row_key(row))
+            if not base:
+                continue
+            for metric, direction in METRICS.iteritems():
+                if metric not in row or not base.get(metric):
+                    continue
+                change = (row[metric] - base[metric]) / float(base[metric])
+                if change * direction < -threshold:
+                    regressions.append('%s %s %s: %.2f instead of %.2f'
+                        % (name, dict(row_key(row)), metric, row[metric],
+                            base[metric]))
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]',
+        description='Benchmarks: '
+        + ', '.join(b[0] for b in BENCHMARKS))
+    parser.add_option('-o', '--output', dest='output',
+        help='write the results as JSON to the file')
+    parser.add_option('-b', '--baseline', dest='baseline',
+        help='compare the results with the JSON of a previous run')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float',
+        default=0.2, help='fraction of the baseline a result may regress by '
+        '[default: %default]')
+    parser.add_option('-s', '--scale', dest='scale', type='float',
+        default=1.0, help='scale of the corpora [default: %default]')
+    options, names = parser.parse_args()
+    unknown = set(names) - set(b[0] for b in BENCHMARKS)
+    if unknown:
+        parser.error('Unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+
+    results = {}
+    for name, title, function, sizes, columns in BENCHMARKS:
+        if names and name not in names:
+            continue
+        kwargs = dict((k, max(int(v * options.scale), 1))
+            for k, v in sizes.iteritems())
+        results[name] = function(**kwargs)
+        print_table(title, columns, results[name])
+
+    if options.output:
+        with open(options.output, 'wb') as file_p:
+            json.dump({
+                    'db_type': CONFIG['db_type'],
+                    'scale': options.scale,
+                    'results': results,
+                    }, file_p, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline, 'rb') as file_p:
+            baseline = json.load(file_p)['results']
+        regressions = compare(results, baseline, options.threshold)
+        for regression in regressions:
+            print 'Regression: %s' % regression
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -10,16 +10,31 @@ DIR = os.path.abspath(os.path.normpath(os.path.join(__file__,
 if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
 import unittest
+import base64
+import hashlib
+import tempfile
+import shutil
+import datetime
+from StringIO import StringIO
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
 from email.utils import formatdate
+from email import message_from_string
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT, \
     test_view, test_depends
 from trytond.transaction import Transaction
 from trytond.config import CONFIG
+from trytond.exceptions import UserError
+from trytond.modules.electronic_mail.importer import iter_mbox, \
+    iter_maildir, iter_prepared
+from trytond.modules.electronic_mail.storage import FileSystemStorage, \
+    WriteBehind, content_name, encode, decode_file, CACHE
+from trytond.modules.electronic_mail.mime import iter_parts
+from trytond.modules.electronic_mail.instrumentation import INSTRUMENTATION
 
 # Set a data path since the module stores email attachment content in data dir
 CONFIG['data_path'] = '/tmp/'
@@ -218,6 +233,1490 @@ class ElectronicMailTestCase(unittest.TestCase):
             self.assertEqual(mail.from_, message['From'])
             self.assertEqual(mail.to, message['To'])
 
+    def test0040_create_from_emails(self):
+        """
+        Creating mails in a batch gives the same records, files and headers
+        as creating them one by one
+        """
+        messages = []
+        for index in xrange(3):
+            message = MIMEText('Body of mail %s' % index, 'plain')
+            message['date'] = formatdate()
+            message['Subject'] = 'Batch %s' % index
+            message['From'] = 'pythonistas@example.com'
+            message['To'] = 'trytonistas@example.com'
+            messages.append(message)
+        # A duplicate inside the batch must share the stored file
+        messages.append(messages[0])
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mailbox, = self.Mailbox.create(
+                [{
+                    'name': 'Mailbox',
+                    'user': USER,
+                    'read_users': [('set', [USER])],
+                    'write_users': [('set', [USER])],
+                    }])
+            single = self.Mail.create_from_email(messages[0], mailbox)
+            mails = self.Mail.create_from_emails(messages, mailbox)
+
+            self.assertEqual(len(mails), len(messages))
+            for mail, message in zip(mails, messages):
+                self.assertEqual(mail.subject, message['Subject'])
+                self.assert_(mail.size)
+                self.assertEqual(len(mail.headers), len(message.items()))
+                self.assertEqual(mail._get_email(), message.as_string())
+            self.assertEqual(
+                (mails[0].digest, mails[0].collision),
+                (single.digest, single.collision))
+            self.assertEqual(
+                (mails[3].digest, mails[3].collision),
+                (mails[0].digest, mails[0].collision))
+            self.assertEqual(mails[0].size, single.size)
+
+            transaction.cursor.rollback()
+
+    def test0050_import_mbox(self):
+        """
+        Import a mbox file in chunks and resume an import from its offset
+        """
+        self.Import = POOL.get('electronic_mail.import')
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'mbox')
+        with open(path, 'w') as file_p:
+            for index in xrange(5):
+                message = MIMEText('Body of mail %s' % index, 'plain')
+                message['Subject'] = 'Mbox %s' % index
+                message['From'] = 'pythonistas@example.com'
+                file_p.write('From pythonistas@example.com %s\n' % index)
+                file_p.write(message.as_string() + '\n\n')
+        try:
+            messages = list(iter_mbox(path))
+            self.assertEqual(len(messages), 5)
+            self.assertEqual(messages[-1][1], os.path.getsize(path))
+
+            with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+                mailbox, = self.Mailbox.create(
+                    [{
+                        'name': 'Mailbox',
+                        'user': USER,
+                        'read_users': [('set', [USER])],
+                        'write_users': [('set', [USER])],
+                        }])
+                # Resume after the second message
+                import_, = self.Import.create([{
+                            'path': path,
+                            'type_': 'mbox',
+                            'mailbox': mailbox.id,
+                            'chunk_size': 2,
+                            'offset': messages[1][1],
+                            'imported': 2,
+                            }])
+                import_._process(commit=False)
+                import_ = self.Import(import_.id)
+
+                self.assertEqual(import_.state, 'done')
+                self.assertEqual(import_.imported, 5)
+                self.assertEqual(import_.offset, os.path.getsize(path))
+                mails = self.Mail.search([('mailbox', '=', mailbox.id)],
+                    order=[('id', 'ASC')])
+                self.assertEqual([m.subject for m in mails],
+                    ['Mbox 2', 'Mbox 3', 'Mbox 4'])
+
+                # The offsets of the mbox files over 2GB are stored
+                self.Import.write([import_], {'offset': 5 * 2 ** 30})
+                self.assertEqual(self.Import(import_.id).offset, 5 * 2 ** 30)
+
+                transaction.cursor.rollback()
+        finally:
+            shutil.rmtree(directory)
+
+    def test0055_import_maildir(self):
+        "Resume the import of a Maildir whose messages moved meanwhile"
+        self.Import = POOL.get('electronic_mail.import')
+        directory = tempfile.mkdtemp()
+        for subdir in ('cur', 'new', 'tmp'):
+            os.mkdir(os.path.join(directory, subdir))
+        for index in xrange(4):
+            message = MIMEText('Body of mail %s' % index, 'plain')
+            message['Subject'] = 'Maildir %s' % index
+            name = '13570000%02d.M%sP1.example' % (index, index)
+            subdir = index % 2 and 'new' or 'cur'
+            if subdir == 'cur':
+                name += ':2,S'
+            with open(os.path.join(directory, subdir, name), 'w') as file_p:
+                file_p.write(message.as_string())
+        try:
+            messages = list(iter_maildir(directory))
+            self.assertEqual([n for _, n in messages],
+                ['13570000%02d.M%sP1.example' % (i, i) for i in xrange(4)])
+
+            # The second message is read then moved to cur with a flag
+            os.rename(
+                os.path.join(directory, 'new', messages[1][1]),
+                os.path.join(directory, 'cur', messages[1][1] + ':2,RS'))
+            with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+                mailbox, = self.Mailbox.create([{
+                            'name': 'Maildir',
+                            'user': USER,
+                            }])
+                import_, = self.Import.create([{
+                            'path': directory,
+                            'type_': 'maildir',
+                            'mailbox': mailbox.id,
+                            'last_name': messages[1][1],
+                            'imported': 2,
+                            }])
+                import_._process(commit=False)
+                import_ = self.Import(import_.id)
+                self.assertEqual(import_.imported, 4)
+                self.assertEqual(import_.last_name, messages[3][1])
+                mails = self.Mail.search([('mailbox', '=', mailbox.id)],
+                    order=[('id', 'ASC')])
+                self.assertEqual([m.subject for m in mails],
+                    ['Maildir 2', 'Maildir 3'])
+
+                transaction.cursor.rollback()
+        finally:
+            shutil.rmtree(directory)
+
+    def test0060_storage(self):
+        """
+        Contents are stored under their SHA-256 digest in two levels of
+        directories and mails stored with MD5 digests still resolve
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mailbox, = self.Mailbox.create(
+                [{
+                    'name': 'Mailbox',
+                    'user': USER,
+                    'read_users': [('set', [USER])],
+                    'write_users': [('set', [USER])],
+                    }])
+            storage = FileSystemStorage(transaction.cursor.dbname)
+
+            message = MIMEText('Stored body', 'plain')
+            mail = self.Mail.create_from_email(message, mailbox)
+            self.assertEqual(len(mail.digest), 64)
+            self.assertEqual(mail.collision, 0)
+            filename = storage.path(mail.digest)
+            self.assertEqual(filename, os.path.join(storage.directory,
+                    mail.digest[0:2], mail.digest[2:4], mail.digest))
+            self.assert_(os.path.isfile(filename))
+
+            legacy_digest = 'd41d8cd98f00b204e9800998ecf8427e'
+            storage.set(legacy_digest + '-1', 'Legacy mail')
+            self.assertEqual(storage.path(legacy_digest + '-1'),
+                os.path.join(storage.directory, legacy_digest[0:2],
+                    legacy_digest + '-1'))
+            legacy, = self.Mail.create([{
+                        'mailbox': mailbox,
+                        'digest': legacy_digest,
+                        'collision': 1,
+                        }])
+            self.assertEqual(legacy._get_email(), 'Legacy mail')
+
+            transaction.cursor.rollback()
+
+    def test0070_deduplication(self):
+        """
+        Duplicates are detected from the content records without reading
+        the stored content unless the paranoid mode is enabled
+        """
+        self.Content = POOL.get('electronic_mail.content')
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mailbox, = self.Mailbox.create(
+                [{
+                    'name': 'Mailbox',
+                    'user': USER,
+                    'read_users': [('set', [USER])],
+                    'write_users': [('set', [USER])],
+                    }])
+            storage = FileSystemStorage(transaction.cursor.dbname)
+            message = MIMEText('Deduplicated body', 'plain')
+            data = message.as_string()
+
+            mail = self.Mail.create_from_email(message, mailbox)
+            self.assertEqual(self.Content.get_sizes([mail.digest]),
+                {mail.digest: len(data)})
+
+            # Alter the stored content to detect whether it is read
+            storage.set(mail.digest, data.upper())
+            try:
+                duplicate = self.Mail.create_from_email(message, mailbox)
+                self.assertEqual(duplicate.digest, mail.digest)
+                self.assertEqual(self.Content.search([
+                            ('digest', '=', mail.digest),
+                            ], count=True), 1)
+
+                CONFIG['email_paranoid_dedup'] = True
+                self.assertRaises(Exception, self.Mail.create_from_email,
+                    message, mailbox)
+            finally:
+                CONFIG['email_paranoid_dedup'] = False
+                storage.set(mail.digest, data)
+
+            transaction.cursor.rollback()
+
+    def test0080_compression(self):
+        """
+        Contents are compressed by the configured codec, decompressed
+        transparently and recompressed on demand
+        """
+        self.Content = POOL.get('electronic_mail.content')
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mailbox, = self.Mailbox.create(
+                [{
+                    'name': 'Mailbox',
+                    'user': USER,
+                    'read_users': [('set', [USER])],
+                    'write_users': [('set', [USER])],
+                    }])
+            storage = FileSystemStorage(transaction.cursor.dbname)
+            message = MIMEText('Compressed body\n' * 100, 'plain')
+            data = message.as_string()
+
+            CONFIG['email_codec'] = 'zlib'
+            try:
+                mail = self.Mail.create_from_email(message, mailbox)
+            finally:
+                CONFIG['email_codec'] = None
+            self.assertEqual(
+                self.Content.get_codecs([mail.digest]), {mail.digest: 'zlib'})
+            stored = storage.get(mail.digest + '.zlib')
+            self.assert_(len(stored) < len(data))
+            self.assertEqual(mail._get_email(), data)
+            self.assertEqual(base64.decodestring(mail.email), data)
+
+            self.assertEqual(self.Content.recompress(commit=False), 1)
+            self.assertEqual(
+                self.Content.get_codecs([mail.digest]), {mail.digest: None})
+            self.assertEqual(storage.get(mail.digest), data)
+            self.assertEqual(self.Mail(mail.id)._get_email(), data)
+
+            transaction.cursor.rollback()
+
+    def test0090_streaming(self):
+        """
+        Stored emails are read by ranges, chunks or headers only, whether
+        they are compressed or not
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mailbox, = self.Mailbox.create(
+                [{
+                    'name': 'Mailbox',
+                    'user': USER,
+                    'read_users': [('set', [USER])],
+                    'write_users': [('set', [USER])],
+                    }])
+            for codec in (None, 'zlib', 'bz2'):
+                message = MIMEText('Streamed body\n' * 1000, 'plain')
+                message['Subject'] = 'Streaming %s' % codec
+                data = message.as_string()
+                headers = data[:data.index('\n\n') + 1]
+
+                CONFIG['email_codec'] = codec
+                try:
+                    mail = self.Mail.create_from_email(message, mailbox)
+                finally:
+                    CONFIG['email_codec'] = None
+                self.assertEqual(mail.read_email(100, 50), data[100:150])
+                self.assertEqual(mail.read_email(len(data) - 10),
+                    data[-10:])
+                self.assertEqual(''.join(mail.iter_email(chunk_size=1000)),
+                    data)
+                self.assertEqual(mail.email_headers, headers)
+                self.assertEqual(
+                    self.Mail.read_email_range([mail], 0, 20),
+                    {mail.id: base64.encodestring(data[:20])})
+                # The lines are read whatever their length
+                file_p = mail.open_email()
+                with file_p:
+                    file_p.read(7)
+                    lines = list(iter(file_p.readline, ''))
+                self.assertEqual(''.join(lines), data[7:])
+                self.assertEqual(lines[-1], 'Streamed body\n')
+
+            # A line longer than the chunks
+            encoded = encode('%s\n%s' % ('x' * 200000, 'y' * 10), 'zlib')
+            file_p = decode_file(StringIO(encoded), 'zlib')
+            self.assertEqual(file_p.readline(), 'x' * 200000 + '\n')
+            self.assertEqual(file_p.tell(), 200001)
+            self.assertEqual(file_p.readline(), 'y' * 10)
+            self.assertEqual(file_p.readline(), '')
+
+            transaction.cursor.rollback()
+
+    def test0100_memory_map(self):
+        """
+        Uncompressed stored emails are mapped in memory and their parts
+        are located without parsing the whole email
+        """
+        message = MIMEMultipart('alternative')
+        message['Subject'] = 'Mapped'
+        message.attach(MIMEText('Plain body', 'plain'))
+        message.attach(MIMEText('<p>HTML body</p>', 'html'))
+        data = message.as_string()
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mailbox, = self.Mailbox.create(
+                [{
+                    'name': 'Mailbox',
+                    'user': USER,
+                    'read_users': [('set', [USER])],
+                    'write_users': [('set', [USER])],
+                    }])
+            mail = self.Mail.create_from_email(message, mailbox)
+            buffer = mail.map_email()
+            try:
+                self.assertEqual(len(buffer), len(data))
+                self.assertEqual(buffer[:], data)
+                parts = [(headers.get_content_type(),
+                        buffer[start:end].strip())
+                    for headers, start, end in iter_parts(buffer)]
+            finally:
+                buffer.close()
+            self.assertEqual(parts, [
+                    ('text/plain', 'Plain body'),
+                    ('text/html', '<p>HTML body</p>'),
+                    ])
+
+            transaction.cursor.rollback()
+
+    def test0110_content_cache(self):
+        """
+        Stored emails and parsed messages are served from the content cache
+        """
+        message = MIMEText('Cached body', 'plain')
+        message['Subject'] = 'Cached'
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mailbox, = self.Mailbox.create(
+                [{
+                    'name': 'Mailbox',
+                    'user': USER,
+                    'read_users': [('set', [USER])],
+                    'write_users': [('set', [USER])],
+                    }])
+            mail = self.Mail.create_from_email(message, mailbox)
+            CACHE.clear()
+
+            self.assertEqual(mail._get_email(), message.as_string())
+            self.assertEqual(mail._get_email(), message.as_string())
+            parsed = mail.get_message()
+            self.assertEqual(parsed['Subject'], 'Cached')
+            self.assert_(mail.get_message() is parsed)
+
+            stats = self.Mail.get_cache_stats()
+            self.assertEqual(stats['data_misses'], 1)
+            self.assertEqual(stats['data_hits'], 2)
+            self.assertEqual(stats['message_misses'], 1)
+            self.assertEqual(stats['message_hits'], 1)
+            self.assertEqual(stats['entries'], 2)
+
+            transaction.cursor.rollback()
+
+    def test0120_mail_access_rules(self):
+        """
+        Mails are read and written according to the access users of their
+        mailbox computed per mailbox
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            user_set_1, user_set_2 = self.create_users(no_of_sets=2)
+            user_o, user_r, user_w = user_set_1
+            mailbox_1, mailbox_2 = self.Mailbox.create([{
+                        'name': 'Mailbox 1',
+                        'user': user_o,
+                        'read_users': [('set', [user_r])],
+                        'write_users': [('set', [user_w])],
+                        }, {
+                        'name': 'Mailbox 2',
+                        'user': user_set_2[0],
+                        'read_users': [('set', [user_r, user_set_2[1]])],
+                        'write_users': [('set', [user_set_2[2]])],
+                        }])
+            mails = []
+            for owner, mailbox, count in ((user_o, mailbox_1, 3),
+                    (user_set_2[0], mailbox_2, 2)):
+                with Transaction().set_user(owner):
+                    mails.extend(self.Mail.create([{
+                                    'mailbox': mailbox.id,
+                                    'subject': 'Mail %s' % index,
+                                    } for index in xrange(count)]))
+            with Transaction().set_user(0):
+                mails = self.Mail.browse([m.id for m in mails])
+
+                self.assertEqual(mails[0].mailbox_owner.id, user_o)
+                self.assertEqual(
+                    sorted(u.id for u in mails[0].mailbox_read_access),
+                    sorted(user_set_1))
+                self.assertEqual(
+                    sorted(u.id for u in mails[0].mailbox_write_access),
+                    sorted([user_o, user_w]))
+                self.assertEqual(
+                    sorted(u.id for u in mails[3].mailbox_read_users),
+                    sorted([user_r, user_set_2[1]]))
+                self.assertEqual(
+                    [u.id for u in mails[3].mailbox_write_users],
+                    [user_set_2[2]])
+                self.assertEqual(self.Mail.search([
+                            ('mailbox_read_access', 'in', [user_set_2[1]]),
+                            ], count=True), 2)
+                self.assertEqual(self.Mail.search([
+                            ('mailbox_write_access', '=', user_w),
+                            ], count=True), 3)
+
+            # The write rules apply to reading too
+            expected_results = {
+                user_o: 3, user_r: 0, user_w: 3,
+                user_set_2[0]: 2, user_set_2[1]: 0, user_set_2[2]: 2,
+                }
+            for user_id, mail_count in expected_results.items():
+                with Transaction().set_user(user_id):
+                    self.assertEqual(self.Mail.search([], count=True),
+                        mail_count)
+
+            with Transaction().set_user(user_r):
+                self.assertRaises(Exception, self.Mail.write,
+                    [mails[0]], {'flag_seen': True})
+            with Transaction().set_user(user_w):
+                self.Mail.write([mails[0]], {'flag_seen': True})
+
+            transaction.cursor.rollback()
+
+    def explain(self, query, args):
+        "Returns the query plan of the query as a string"
+        cursor = Transaction().cursor
+        if CONFIG['db_type'] == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + query, args)
+            return '\n'.join(row[-1] for row in cursor.fetchall())
+        # The tables of the tests are too small for the planner to prefer
+        # an index to a sequential scan
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute('EXPLAIN ' + query, args)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def test0130_indexes(self):
+        "The lookups on mails and headers use indexes"
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mail_table = self.Mail._table
+            header_table = POOL.get('electronic_mail.header.line')._table
+            queries = (
+                ('SELECT id FROM "' + mail_table + '" WHERE mailbox = %s '
+                    'ORDER BY date DESC', [1],
+                    mail_table + '_mailbox_date_index'),
+                ('SELECT id FROM "' + mail_table + '" WHERE digest = %s '
+                    'AND collision != 0', ['0' * 32],
+                    mail_table + '_digest_collision_index'),
+                ('SELECT id FROM "' + mail_table + '" '
+                    'WHERE message_id = %s', ['<1@example.com>'],
+                    mail_table + '_message_id_index'),
+                ('SELECT id FROM "' + mail_table + '" '
+                    'WHERE in_reply_to = %s', ['<1@example.com>'],
+                    mail_table + '_in_reply_to_index'),
+                ('SELECT value FROM "' + header_table + '" '
+                    'WHERE name = %s AND electronic_mail = %s',
+                    ['Received', 1],
+                    header_table + '_name_electronic_mail_index'),
+                ('SELECT name, value FROM "' + header_table + '" '
+                    'WHERE electronic_mail IN (%s, %s)', [1, 2],
+                    header_table + '_electronic_mail_index'),
+                )
+            for query, args, index in queries:
+                self.assertTrue(index in self.explain(query, args),
+                    '%s does not use %s' % (query, index))
+            transaction.cursor.rollback()
+
+    def test0140_threads(self):
+        "Mails are filed in threads whatever their order of arrival"
+        Thread = POOL.get('electronic_mail.thread')
+
+        def make_message(name, *ancestors):
+            message = MIMEText('Body of %s' % name, 'plain')
+            message['Date'] = formatdate(1357000000 + ord(name) * 60)
+            message['Subject'] = 'Thread %s' % name
+            message['Message-ID'] = '<%s@example.com>' % name
+            if ancestors:
+                message['In-Reply-To'] = '<%s@example.com>' % ancestors[-1]
+                message['References'] = ' '.join('<%s@example.com>' % a
+                    for a in ancestors)
+            return message
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mailbox, = self.Mailbox.create([{
+                        'name': 'Mailbox',
+                        'user': USER,
+                        }])
+            # The replies arrive before the messages they reply to
+            mail_c, = self.Mail.create_from_emails(
+                [make_message('C', 'A', 'B')], mailbox.id)
+            mail_d, mail_a = self.Mail.create_from_emails(
+                [make_message('D'), make_message('A')], mailbox.id)
+            self.assertNotEqual(mail_d.thread, mail_a.thread)
+            self.assertEqual(mail_c.thread, mail_a.thread)
+            mail_b, = self.Mail.create_from_emails(
+                [make_message('B', 'A')], mailbox.id)
+
+            thread = mail_a.thread
+            self.assertEqual(thread.root, mail_a)
+            self.assertEqual(thread.subject, 'Thread A')
+            mails = self.Mail.search([
+                    ('thread', '=', thread.id),
+                    ], order=[('thread_path', 'ASC')])
+            self.assertEqual(mails, [mail_a, mail_b, mail_c])
+            self.assertEqual([m.thread_depth for m in mails], [0, 1, 2])
+            self.assertEqual([m.thread_parent for m in mails],
+                [None, mail_a, mail_b])
+
+            # Without B, C is attached to its nearest ancestor A
+            self.Mail.delete([mail_b])
+            mail_c = self.Mail(mail_c.id)
+            self.assertEqual(mail_c.thread_parent, mail_a)
+            self.assertEqual(mail_c.thread_depth, 1)
+
+            # The mails dated before 1900 are filed too
+            old = make_message('H', 'A')
+            old.replace_header('Date', 'Mon, 1 Jan 1850 00:00:00 +0000')
+            mail_h, = self.Mail.create_from_emails([old], mailbox.id)
+            self.assertEqual(mail_h.date, datetime.datetime(1850, 1, 1))
+            self.assertEqual(mail_h.thread, thread)
+            self.assertEqual(mail_h.thread_parent, mail_a)
+            self.assertEqual(self.Mail.search([
+                        ('thread', '=', thread.id),
+                        ('thread_parent', '=', mail_a.id),
+                        ], order=[('thread_path', 'ASC')])[0], mail_h)
+            self.Mail.delete([mail_h])
+
+            # The mails created before the threads are filed by the backfill
+            mail_e, = self.Mail.create([{
+                        'mailbox': mailbox.id,
+                        'subject': 'Re: Thread D',
+                        'message_id': '<E@example.com>',
+                        'in_reply_to': '<D@example.com>',
+                        }])
+            self.assertEqual(mail_e.thread, None)
+            self.assertEqual(Thread.backfill(commit=False), 1)
+            mail_e = self.Mail(mail_e.id)
+            self.assertEqual(mail_e.thread, mail_d.thread)
+            self.assertEqual(mail_e.thread_parent, mail_d)
+
+            # A mail linking two threads merges them
+            mail_g, = self.Mail.create_from_emails(
+                [make_message('G', 'F')], mailbox.id)
+            self.assertNotEqual(mail_g.thread, mail_d.thread)
+            mail_f, = self.Mail.create_from_emails(
+                [make_message('F', 'D')], mailbox.id)
+            mail_g = self.Mail(mail_g.id)
+            self.assertEqual(mail_g.thread, mail_d.thread)
+            self.assertEqual(mail_g.thread_depth, 2)
+
+            # The threads are read by the users reading one of their mails
+            ThreadMessage = POOL.get('electronic_mail.thread.message')
+            owner_id, reader_id, _ = self.create_users()[0]
+            user, = self.User.create([{
+                        'login': 'thread_user',
+                        'name': 'thread_user',
+                        'groups': [('set', [self.ModelData.get_id(
+                                        'electronic_mail',
+                                        'group_email_user')])],
+                        }])
+            other, = self.Mailbox.create([{
+                        'name': 'Other',
+                        'user': owner_id,
+                        'read_users': [('set', [user.id])],
+                        }])
+            with transaction.set_user(owner_id):
+                mail_i, = self.Mail.create_from_emails(
+                    [make_message('I', 'A')], other.id)
+            self.assertEqual(mail_i.thread, thread)
+            self.assertEqual(sorted(u.id
+                    for u in Thread(thread.id).mailbox_read_access),
+                sorted([USER, owner_id, user.id]))
+            with transaction.set_user(owner_id):
+                self.assertEqual(Thread.search([]), [thread])
+                self.assertEqual(Thread.search([
+                            ('mailbox_read_access', 'in', [owner_id]),
+                            ]), [thread])
+            with transaction.set_user(reader_id):
+                self.assertEqual(Thread.search([]), [])
+                self.assertRaises(Exception, Thread.read, [thread.id],
+                    ['date'])
+            # The subject and root of the thread are the ones of the mails
+            # the user reads
+            with transaction.set_user(owner_id):
+                self.assertEqual(Thread.read([thread.id], ['subject', 'root']),
+                    [{'id': thread.id, 'subject': 'Thread I',
+                            'root': mail_i.id}])
+                self.assertEqual(Thread.search([
+                            ('subject', '=', 'Thread A'),
+                            ]), [])
+            self.assertEqual(Thread(thread.id).subject, 'Thread A')
+            with transaction.set_user(user.id):
+                self.assertRaises(Exception, ThreadMessage.read,
+                    [m.id for m in thread.message_ids], ['message_id'])
+
+            transaction.cursor.rollback()
+
+    def test0150_search_text(self):
+        "Mails are searched by the words of their subject and text parts"
+        message = MIMEMultipart('alternative')
+        message['Subject'] = '=?utf-8?q?Caf=C3=A9_meeting?='
+        message['From'] = 'pythonistas@example.com'
+        message['To'] = 'trytonistas@example.com'
+        message.attach(MIMEText(u'Bring the quarterly r\xe9sum\xe9'.encode(
+                    'latin-1'), 'plain', 'latin-1'))
+        message.attach(MIMEText('<html><head><style>p {color: red}</style>'
+                '</head><body><p>Invoice &amp; <b>delivery</b></p>'
+                '<script>var hidden;</script></body></html>', 'html'))
+        other = MIMEText('Nothing to see', 'plain')
+        other['Subject'] = 'Other'
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mailbox, = self.Mailbox.create([{
+                        'name': 'Mailbox',
+                        'user': USER,
+                        }])
+            mail, _ = self.Mail.create_from_emails([message, other],
+                mailbox.id)
+
+            def search(text):
+                return self.Mail.search([('search_text', '=', text)])
+
+            self.assertEqual(search('cafe'), [mail])
+            self.assertEqual(search('RESUME quarterly'), [mail])
+            self.assertEqual(search('invoice delivery'), [mail])
+            self.assertEqual(search('trytonistas'), [mail])
+            self.assertEqual(search('red'), [])
+            self.assertEqual(search('hidden'), [])
+            self.assertEqual(search('invoice nothing'), [])
+
+            # The stored email replaced later is indexed again
+            self.Mail.write([mail], {
+                    'email': MIMEText('Tryton rocks').as_string(),
+                    })
+            self.assertEqual(search('rocks'), [mail])
+            self.assertEqual(search('delivery'), [])
+
+            # The subject and addresses written are indexed again
+            self.Mail.write([mail], {
+                    'subject': 'Agenda',
+                    'to': 'erlangers@example.com',
+                    })
+            self.assertEqual(search('agenda'), [mail])
+            self.assertEqual(search('erlangers rocks'), [mail])
+            self.assertEqual(search('cafe'), [])
+            self.assertEqual(search('trytonistas'), [])
+
+            # The mails missing from the index are indexed incrementally
+            # and the whole index can be rebuilt
+            self.assertEqual(self.Mail.update_text_index(commit=False), 0)
+            self.assertEqual(
+                self.Mail.rebuild_text_index(commit=False), 2)
+            self.assertEqual(search('rocks'), [mail])
+
+            transaction.cursor.rollback()
+
+    def test0160_compact_headers(self):
+        "The headers stored compactly are still read through the header view"
+        HeaderLine = POOL.get('electronic_mail.header.line')
+        message = MIMEText('Body', 'plain')
+        message['Subject'] = 'Compact'
+        message['Received'] = 'from relay.example.com by mx.example.com'
+        message['List-Id'] = '<tryton.example.com>'
+        message['References'] = '<1@example.com> <2@example.com>'
+        message['X-Spam-Status'] = 'No, score=-1.5'
+
+        header_storage = CONFIG.get('email_header_storage')
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mailbox, = self.Mailbox.create([{
+                        'name': 'Mailbox',
+                        'user': USER,
+                        }])
+            try:
+                CONFIG['email_header_storage'] = 'compact'
+                compact, = self.Mail.create_from_emails([message],
+                    mailbox.id)
+            finally:
+                CONFIG['email_header_storage'] = header_storage
+            rows, = self.Mail.create_from_emails([message], mailbox.id)
+
+            self.assertEqual(HeaderLine.search([
+                        ('electronic_mail', '=', compact.id),
+                        ], count=True), 0)
+            self.assertEqual(HeaderLine.search([
+                        ('electronic_mail', '=', rows.id),
+                        ], count=True), len(message.items()))
+            for mail in (compact, rows):
+                self.assertEqual(mail.list_id, '<tryton.example.com>')
+                self.assertEqual(mail.spam_score, -1.5)
+                self.assertEqual(self.Mail.search([
+                            ('list_id', '=', '<tryton.example.com>'),
+                            ('id', '=', mail.id),
+                            ], count=True), 1)
+            self.assertEqual(compact.email_headers, compact.raw_headers)
+            self.assert_('Received: from relay' in compact.raw_headers)
+            self.assertEqual(rows.raw_headers, None)
+
+            self.assertEqual(
+                sorted((h.name, h.value) for h in compact.headers),
+                sorted(message.items()))
+            self.assertEqual(self.Header.search([
+                        ('electronic_mail', 'in', [compact.id, rows.id]),
+                        ], count=True), len(message.items()) * 2)
+            received, = [h for h in compact.headers if h.name == 'Received']
+            self.assertEqual(self.Header.read([received.id],
+                    ['value', 'electronic_mail']), [{
+                        'id': received.id,
+                        'value': 'from relay.example.com by mx.example.com',
+                        'electronic_mail': compact.id,
+                        }])
+            self.assertRaises(Exception, self.Header.delete, [received])
+            self.assertEqual(
+                [(h.name, h.value) for h in rows.headers], message.items())
+            self.assertEqual(self.Header.search([
+                        ('name', '=', 'List-Id'),
+                        ], count=True), 2)
+            self.assertRaises(Exception, self.Header.write,
+                [h for h in compact.headers if h.name == 'List-Id'],
+                {'value': 'Changed'})
+
+            header, = self.Header.create([{
+                        'electronic_mail': compact.id,
+                        'name': 'X-Note',
+                        'value': 'Added',
+                        }])
+            self.Header.write([header], {'value': 'Changed'})
+            self.assertEqual(self.Header(header.id).value, 'Changed')
+            self.Header.delete([header])
+
+            transaction.cursor.rollback()
+
+    def test0170_parallel_import(self):
+        "Messages prepared by a pool of processes are stored in order"
+        Import = POOL.get('electronic_mail.import')
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'mbox')
+        with open(path, 'w') as file_p:
+            for index in xrange(7):
+                message = MIMEText('Parallel body %s' % index, 'plain')
+                message['Subject'] = 'Parallel %s' % index
+                message['Date'] = formatdate(1357000000 + index)
+                file_p.write('From pythonistas@example.com %s\n' % index)
+                file_p.write(message.as_string() + '\n\n')
+        try:
+            with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+                serial = list(iter_prepared(DB_NAME, iter_mbox(path), 'zlib'))
+                parallel = list(iter_prepared(DB_NAME, iter_mbox(path),
+                        'zlib', workers=2, batch_size=2))
+                self.assertEqual(parallel, serial)
+
+                mailbox, = self.Mailbox.create([{
+                            'name': 'Mailbox',
+                            'user': USER,
+                            }])
+                import_, = Import.create([{
+                            'path': path,
+                            'type_': 'mbox',
+                            'mailbox': mailbox.id,
+                            'chunk_size': 3,
+                            'workers': 2,
+                            }])
+                import_._process(commit=False)
+                import_ = Import(import_.id)
+                self.assertEqual(import_.imported, 7)
+                self.assertEqual(import_.offset, os.path.getsize(path))
+                mails = self.Mail.search([('mailbox', '=', mailbox.id)],
+                    order=[('id', 'ASC')])
+                self.assertEqual([m.subject for m in mails],
+                    ['Parallel %s' % i for i in xrange(7)])
+                self.assertEqual(mails[3]._get_email(),
+                    message_from_string(
+                        list(iter_mbox(path))[3][0]).as_string())
+                self.assertEqual(self.Mail.search([
+                            ('search_text', '=', 'parallel body'),
+                            ], count=True), 7)
+
+                transaction.cursor.rollback()
+        finally:
+            shutil.rmtree(directory)
+
+    def test0180_mailbox_closure(self):
+        "The counts and searches of a mailbox include its descendants"
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            root, other = self.Mailbox.create([{
+                        'name': 'Root',
+                        'user': USER,
+                        }, {
+                        'name': 'Other',
+                        'user': USER,
+                        }])
+            child, = self.Mailbox.create([{
+                        'name': 'Child',
+                        'user': USER,
+                        'parents': [('set', [root.id])],
+                        }])
+            grandchild, = self.Mailbox.create([{
+                        'name': 'Grandchild',
+                        'user': USER,
+                        'parents': [('set', [child.id, other.id])],
+                        }])
+            for mailbox, subject in ((root, 'Root 1'), (root, 'Root 2'),
+                    (grandchild, 'Grandchild')):
+                message = MIMEText('Closure body', 'plain')
+                message['Subject'] = subject
+                self.Mail.create_from_email(message, mailbox.id)
+            mail, = self.Mail.search([('subject', '=', 'Grandchild')])
+            self.Mail.write([mail], {'flag_seen': True})
+
+            root = self.Mailbox(root.id)
+            self.assertEqual(root.total_mails, 3)
+            self.assertEqual(root.unseen_mails, 2)
+            self.assertTrue(root.mails_size > 0)
+            self.assertEqual(
+                [(m.total_mails, m.unseen_mails) for m in
+                    self.Mailbox.browse([child.id, other.id])],
+                [(1, 0), (1, 0)])
+            self.assertEqual(self.Mail.search([
+                        ('mailbox_ancestors', '=', root.id),
+                        ], count=True), 3)
+            self.assertEqual([m.id for m in mail.mailbox_ancestors][0],
+                grandchild.id)
+            self.assertEqual(set(m.id for m in mail.mailbox_ancestors),
+                set([root.id, child.id, grandchild.id, other.id]))
+
+            self.Mailbox.write([grandchild], {
+                    'parents': [('unlink', [child.id])],
+                    })
+            self.assertEqual(self.Mailbox(root.id).total_mails, 2)
+            self.Mailbox.write([grandchild], {
+                    'parents': [('add', [child.id])],
+                    })
+            self.Mailbox.delete([child])
+            self.assertEqual(self.Mailbox(root.id).total_mails, 2)
+            self.assertEqual(self.Mailbox(other.id).total_mails, 1)
+            self.assertEqual(self.Mail.search([
+                        ('mailbox_ancestors', 'in', [root.id, other.id]),
+                        ], count=True), 3)
+
+            # The cycles are refused, the transaction is then rolled back
+            self.assertRaises(UserError, self.Mailbox.write, [other], {
+                    'parents': [('add', [grandchild.id])],
+                    })
+
+            transaction.cursor.rollback()
+
+    def test0190_mailbox_counters(self):
+        "The counters of the mailboxes follow the changes of the mails"
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            inbox, archive = self.Mailbox.create([{
+                        'name': 'Inbox',
+                        'user': USER,
+                        }, {
+                        'name': 'Archive',
+                        'user': USER,
+                        }])
+
+            def counters(mailbox):
+                mailbox = self.Mailbox(mailbox.id)
+                return (mailbox.mail_count, mailbox.unseen_count,
+                    mailbox.flagged_count, mailbox.recent_count,
+                    mailbox.mail_size)
+
+            self.assertEqual(counters(inbox), (0, 0, 0, 0, 0))
+            mails = []
+            for index in xrange(3):
+                message = MIMEText('Counter body %s' % index, 'plain')
+                message['Subject'] = 'Counter %s' % index
+                mails.append(self.Mail.create_from_email(message, inbox.id))
+            size = sum(m.size for m in mails)
+            self.assertEqual(counters(inbox), (3, 3, 0, 0, size))
+
+            self.Mail.write(mails[:2], {
+                    'flag_seen': True,
+                    'flag_flagged': True,
+                    })
+            self.Mail.write(mails[2:], {'flag_recent': True})
+            self.assertEqual(counters(inbox), (3, 1, 2, 1, size))
+
+            self.Mail.write(mails[:1], {'mailbox': archive.id})
+            self.assertEqual(counters(inbox),
+                (2, 1, 1, 1, size - mails[0].size))
+            self.assertEqual(counters(archive), (1, 0, 1, 0, mails[0].size))
+
+            self.Mail.delete(mails[1:2])
+            self.assertEqual(counters(inbox),
+                (1, 1, 0, 1, mails[2].size))
+
+            # The counters changed by SQL are repaired
+            transaction.cursor.execute('UPDATE "' + self.Mailbox._table
+                + '" SET mail_count = 42, unseen_count = NULL')
+            self.Mailbox.reconcile_counters()
+            self.assertEqual(counters(inbox),
+                (1, 1, 0, 1, mails[2].size))
+            self.assertEqual(counters(archive), (1, 0, 1, 0, mails[0].size))
+
+            transaction.cursor.rollback()
+
+    def test0200_set_flags(self):
+        "The flags are set on ranges of UIDs within the mail write access"
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            _, read_id, write_id = self.create_users()[0]
+            mailbox, other = self.Mailbox.create([{
+                        'name': 'UIDs',
+                        'user': USER,
+                        'read_users': [('set', [read_id])],
+                        'write_users': [('set', [write_id])],
+                        }, {
+                        'name': 'Other',
+                        'user': USER,
+                        }])
+            self.assertTrue(mailbox.uid_validity)
+            mails = []
+            for index in xrange(6):
+                message = MIMEText('UID body %s' % index, 'plain')
+                message['Subject'] = 'UID %s' % index
+                mails.append(self.Mail.create_from_email(message,
+                        mailbox.id))
+            self.assertEqual([m.uid for m in mails], range(1, 7))
+            self.assertEqual(self.Mailbox(mailbox.id).uid_next, 7)
+
+            def flags():
+                return [(m.uid, m.flag_seen, m.flag_answered) for m in
+                    self.Mail.search([('mailbox', '=', mailbox.id)],
+                        order=[('uid', 'ASC')])]
+
+            with transaction.set_user(write_id):
+                updated = self.Mail.set_flags(mailbox.id, '2:3,5:*',
+                    add=['\\Seen', 'answered'])
+            self.assertEqual(sorted(updated),
+                sorted(m.id for m in mails if m.uid in (2, 3, 5, 6)))
+            self.assertEqual(flags(), [
+                    (1, False, False),
+                    (2, True, True),
+                    (3, True, True),
+                    (4, False, False),
+                    (5, True, True),
+                    (6, True, True),
+                    ])
+            self.assertEqual(self.Mailbox(mailbox.id).unseen_count, 2)
+            self.Mail.set_flags(mailbox.id, '6:2', remove=['answered'])
+            self.assertEqual([f[2] for f in flags()], [False] * 6)
+
+            self.assertRaises(UserError, self.Mail.set_flags, mailbox.id,
+                '1', add=['\\Deleted'])
+            self.assertRaises(UserError, self.Mail.set_flags, mailbox.id,
+                '0:2', add=['seen'])
+            with transaction.set_user(read_id):
+                self.assertRaises(UserError, self.Mail.set_flags,
+                    mailbox.id, '1:*', add=['seen'])
+            self.assertFalse(self.Mail(mails[0].id).flag_seen)
+
+            # The mails moved are numbered after those of their mailbox
+            message = MIMEText('UID body', 'plain')
+            message['Subject'] = 'UID other'
+            self.Mail.create_from_email(message, other.id)
+            self.Mail.write(mails[3:5], {'mailbox': other.id})
+            self.assertEqual([self.Mail(m.id).uid for m in mails[3:5]],
+                [2, 3])
+
+            transaction.cursor.rollback()
+
+    def test0210_sizes(self):
+        "The size of the mails is the octet count of their content"
+        Content = POOL.get('electronic_mail.content')
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            cursor = transaction.cursor
+            mailbox, = self.Mailbox.create([{
+                        'name': 'Sizes',
+                        'user': USER,
+                        }])
+            mails = []
+            for index in xrange(3):
+                message = MIMEText('Size body %s\n' % index * (index + 1),
+                    'plain')
+                mail = self.Mail.create_from_email(message, mailbox.id)
+                self.assertEqual(mail.size, len(message.as_string()))
+                mails.append(mail)
+            sizes = [m.size for m in mails]
+            self.assertEqual(self.Mailbox(mailbox.id).mail_size, sum(sizes))
+
+            # A mail stored before the content records
+            data = mails[2]._get_email()
+            digest = hashlib.md5(data).hexdigest()
+            FileSystemStorage(cursor.dbname).set(digest, data)
+            cursor.execute('UPDATE "' + self.Mail._table + '" '
+                'SET digest = %s WHERE id = %s', (digest, mails[2].id))
+            cursor.execute('UPDATE "' + self.Mail._table + '" '
+                'SET size = size + 37')
+            self.assertEqual(self.Mail.update_sizes(batch_size=1,
+                    commit=False), 3)
+            self.assertEqual([self.Mail(m.id).size for m in mails], sizes)
+            self.assertEqual(Content.get_sizes([digest]), {digest: sizes[2]})
+            self.assertEqual(self.Mailbox(mailbox.id).mail_size, sum(sizes))
+            self.assertEqual(self.Mail.update_sizes(commit=False), 0)
+
+            # The mails without content record are measured once
+            data = mails[1]._get_email()
+            FileSystemStorage(cursor.dbname).set(digest + '-1', data)
+            cursor.execute('UPDATE "' + self.Mail._table + '" '
+                'SET digest = %s, collision = 1, size = 0 WHERE id = %s',
+                (digest, mails[1].id))
+            cursor.execute('UPDATE "' + self.Mail._table + '" '
+                'SET digest = %s WHERE id = %s', ('0' * 32, mails[0].id))
+            self.assertEqual(self.Mail.update_sizes(commit=False), 1)
+            self.assertEqual(self.Mail(mails[1].id).size, sizes[1])
+            self.assertEqual([self.Mail(m.id).size_measured
+                    for m in mails], [True, True, False])
+
+            # The content record of the digest is not the one of the mail
+            # stored apart because of the collision
+            self.assertTrue(Content.recompress('zlib', commit=False))
+            collision = self.Mail(mails[1].id)
+            self.assertEqual(collision.read_email(), data)
+            self.assertEqual(self.Mail.read_email_range([collision], 0, 10),
+                {collision.id: base64.encodestring(data[:10])})
+            self.assertTrue(data in ''.join(self.Mail.iter_mbox([collision])))
+            self.assertEqual(self.Mail(mails[2].id).read_email(),
+                mails[2]._get_email())
+            FileSystemStorage(cursor.dbname).delete(digest + '-1')
+            self.assertEqual(self.Mail.update_sizes(commit=False), 0)
+
+            transaction.cursor.rollback()
+
+    def test0220_attachments(self):
+        "The attachments are stored once and read without their email"
+        Attachment = POOL.get('electronic_mail.attachment')
+        Content = POOL.get('electronic_mail.content')
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            owner_id, _, write_id = self.create_users()[0]
+            mailbox, = self.Mailbox.create([{
+                        'name': 'Attachments',
+                        'user': owner_id,
+                        'write_users': [('set', [write_id])],
+                        }])
+            pdf = ''.join(chr(i % 251) for i in xrange(20000))
+            datas, mails = [], []
+            with transaction.set_user(owner_id):
+                for subject in ('Report', 'Fwd: Report'):
+                    message = MIMEMultipart()
+                    message['Subject'] = subject
+                    message.attach(MIMEText('See the report', 'plain'))
+                    for filename, data in (('report.pdf', pdf),
+                            ('note.txt', 'Small note')):
+                        part = MIMEApplication(data, 'pdf')
+                        part.add_header('Content-Disposition', 'attachment',
+                            filename=filename)
+                        message.attach(part)
+                    mails.append(self.Mail.create_from_email(message,
+                            mailbox.id))
+                    datas.append(message.as_string())
+
+            digest = mails[0].attachments[0].digest
+            self.assertEqual(mails[1].attachments[0].digest, digest)
+            self.assertEqual(len(Content.search([('digest', '=', digest)])),
+                1)
+            storage = FileSystemStorage(transaction.cursor.dbname)
+            with transaction.set_user(owner_id):
+                for mail, data in zip(self.Mail.browse(mails), datas):
+                    self.assertEqual(mail.size, len(data))
+                    self.assertTrue(
+                        len(storage.get(mail.digest)) < len(data) - 20000)
+                    self.assertEqual(mail._get_email(), data)
+                    self.assertEqual(mail.map_email(), data)
+                    for offset, length in ((0, 10), (400, 27000),
+                            (900, None)):
+                        self.assertEqual(mail.read_email(offset, length),
+                            data[offset:length and offset + length])
+
+            with transaction.set_user(write_id):
+                attachments = Attachment.search([
+                        ('mail', '=', mails[1].id),
+                        ], order=[('id', 'ASC')])
+                self.assertEqual([(a.filename, a.content_type, a.size)
+                        for a in attachments], [
+                        ('report.pdf', 'application/pdf', 20000),
+                        ('note.txt', 'application/pdf', 10),
+                        ])
+                self.assertEqual([str(a.data) for a in attachments],
+                    [pdf, 'Small note'])
+            with transaction.set_user(self.create_user('stranger')[0].id):
+                self.assertEqual(Attachment.search([], count=True), 0)
+
+            transaction.cursor.rollback()
+
+    def test0230_archive_and_collect(self):
+        "The mails are archived in pack files and their contents collected"
+        Content = POOL.get('electronic_mail.content')
+        Pack = POOL.get('electronic_mail.pack')
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            owner_id, _, _ = self.create_users()[0]
+            mailbox, = self.Mailbox.create([{
+                        'name': 'Retention',
+                        'user': owner_id,
+                        'archive_days': 30,
+                        }])
+            pdf = ''.join(chr(i % 251) for i in xrange(20000))
+            messages = []
+            for subject, date in (('Old report', 'Mon, 01 Jan 2001 10:00:00'),
+                    ('Old note', 'Tue, 02 Jan 2001 10:00:00'),
+                    ('Recent note', formatdate())):
+                message = MIMEMultipart()
+                message['Subject'] = subject
+                message['Date'] = date
+                message.attach(MIMEText(subject, 'plain'))
+                if subject == 'Old report':
+                    part = MIMEApplication(pdf, 'pdf')
+                    part.add_header('Content-Disposition', 'attachment',
+                        filename='report.pdf')
+                    message.attach(part)
+                messages.append(message)
+            datas = [m.as_string() for m in messages]
+            with transaction.set_user(owner_id):
+                report, note, recent = [
+                    self.Mail.create_from_email(m, mailbox.id)
+                    for m in messages]
+            attachment_digest = report.attachments[0].digest
+            report_digest, recent_digest = report.digest, recent.digest
+
+            self.assertEqual(self.Mailbox.archive_mails([mailbox.id],
+                    commit=False), 2)
+            self.Mailbox.write([mailbox], {'archive_size': 0})
+            self.assertEqual(self.Mailbox.archive_mails([mailbox.id],
+                    commit=False), 1)
+            self.assertEqual(self.Mailbox.archive_mails([mailbox.id],
+                    commit=False), 0)
+            self.assertEqual(Pack.search([], count=True), 2)
+            contents = Content.search([('pack', '!=', None)])
+            self.assertEqual(len(contents), 4)
+            # The stored files of the packed contents are collected when
+            # the archive is not committed
+            storage = FileSystemStorage(transaction.cursor.dbname)
+            Content.collect_files(delay=0, commit=False)
+            for content in contents:
+                self.assertFalse(storage.exists(
+                        content_name(content.digest, content.codec)))
+            with transaction.set_user(owner_id):
+                mails = self.Mail.browse([report, note, recent])
+                self.assertTrue(all(m.archived for m in mails))
+                for mail, data in zip(mails, datas):
+                    self.assertEqual(mail._get_email(), data)
+                    self.assertEqual(mail.map_email(), data)
+                    self.assertEqual(mail.read_email(100, 5000),
+                        data[100:5100])
+                self.assertEqual(str(mails[0].attachments[0].data), pdf)
+
+            # The contents are marked then removed if still unreferenced
+            with transaction.set_user(owner_id):
+                self.Mail.delete([report, recent])
+            Content.collect_garbage(delay=0, commit=False)
+            orphaned = Content.search([('orphaned', '!=', None)])
+            self.assertEqual(set(c.digest for c in orphaned),
+                set([report_digest, recent_digest, attachment_digest]))
+            with transaction.set_user(owner_id):
+                again = self.Mail.create_from_email(messages[2], mailbox.id)
+            self.assertEqual(again.digest, recent_digest)
+            Content.collect_garbage(delay=0, commit=False)
+            self.assertEqual(set(c.digest for c in Content.search([
+                            ('digest', 'in', [report_digest,
+                                    attachment_digest, recent_digest]),
+                            ])), set([recent_digest]))
+            self.assertEqual(Pack.search([], count=True), 2)
+            with transaction.set_user(owner_id):
+                self.assertEqual(self.Mail(again.id)._get_email(), datas[2])
+                self.assertEqual(self.Mail(note.id)._get_email(), datas[1])
+
+            # A pack file is removed with its last content
+            with transaction.set_user(owner_id):
+                self.Mail.delete([self.Mail(note.id), again])
+            pack_names = [p.name for p in Pack.search([])]
+            Content.collect_garbage(delay=0, commit=False)
+            Content.collect_garbage(delay=0, commit=False)
+            self.assertEqual(Pack.search([], count=True), 0)
+            self.assertFalse(any(storage.exists(n) for n in pack_names))
+
+            # The stored files without record are removed once old enough
+            stray, recent_stray = hashlib.sha256('stray').hexdigest(), \
+                hashlib.sha256('recent stray').hexdigest()
+            storage.set(stray, 'stray')
+            storage.set(recent_stray, 'recent stray')
+            os.utime(storage.path(stray), (0, 0))
+            self.assertEqual(Content.collect_files(delay=1, commit=False), 1)
+            self.assertFalse(storage.exists(stray))
+            self.assertTrue(storage.exists(recent_stray))
+            storage.delete(recent_stray)
+
+            transaction.cursor.rollback()
+
+    def test0240_instrumentation(self):
+        "The stages of the ingestion are timed and their I/O counted"
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mailbox, = self.Mailbox.create([{
+                        'name': 'Instrumented',
+                        'user': USER,
+                        }])
+            messages = []
+            for subject in ('Measured', 'Measured', 'Other'):
+                message = MIMEText('Body of %s' % subject)
+                message['Subject'] = subject
+                messages.append(message)
+
+            INSTRUMENTATION.reset()
+            instrumentation = CONFIG.get('email_instrumentation')
+            try:
+                CONFIG['email_instrumentation'] = True
+                self.Mail.create_from_emails(messages, mailbox.id)
+                stats = self.Mail.get_instrumentation_stats()
+                CONFIG['email_instrumentation'] = False
+                self.Mail.create_from_emails(messages, mailbox.id)
+                self.assertEqual(self.Mail.get_instrumentation_stats(),
+                    stats)
+            finally:
+                CONFIG['email_instrumentation'] = instrumentation
+                INSTRUMENTATION.reset()
+
+            self.assertFalse('execute' in transaction.cursor.__dict__)
+            self.assertEqual(stats['dedup_hits'], 1)
+            self.assertEqual(stats['dedup_misses'], 2)
+            self.assertEqual(stats['file_opens'], 2)
+            self.assertEqual(stats['mails_created'], 3)
+            self.assertTrue(stats['bytes_written'] > 0)
+            self.assertTrue(stats['sql_statements'] > 0)
+            for stage, count in (('prepare', 3), ('hash', 3),
+                    ('encode', 3), ('create_from_prepared', 1),
+                    ('headers', 1), ('storage_write', 2)):
+                self.assertEqual(stats[stage]['count'], count)
+                self.assertEqual(
+                    sum(c for _, c in stats[stage]['histogram']), count)
+            self.assertEqual(INSTRUMENTATION.stats(), {})
+
+            transaction.cursor.rollback()
+
+    def test0250_addresses(self):
+        "The mails are dated in UTC and found by their correspondents"
+        Address = POOL.get('electronic_mail.address')
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mailbox, = self.Mailbox.create([{
+                        'name': 'Correspondents',
+                        'user': USER,
+                        }])
+            first = MIMEText('First')
+            first['From'] = 'Alice <Alice@Example.com>'
+            first['To'] = 'bob@example.com, "Carol" <carol@example.com>'
+            first['Cc'] = 'alice@example.com'
+            first['Date'] = 'Tue, 01 Jan 2013 10:00:00 +0200'
+            second = MIMEText('Second')
+            second['Received'] = ('from relay.example.com by '
+                'mx.example.com; Wed, 02 Jan 2013 12:00:00 +0000')
+            second['From'] = 'dave@example.com'
+            second['To'] = 'alice@example.com'
+            second['Date'] = 'not a date'
+            first, second = self.Mail.create_from_emails([first, second],
+                mailbox.id)
+
+            self.assertEqual(first.date, datetime.datetime(2013, 1, 1, 8))
+            self.assertEqual(second.date, datetime.datetime(2013, 1, 2, 12))
+            self.assertEqual(sorted((a.role, a.address, a.name)
+                    for a in first.addresses), [
+                    ('cc', 'alice@example.com', None),
+                    ('from', 'alice@example.com', 'Alice'),
+                    ('to', 'bob@example.com', None),
+                    ('to', 'carol@example.com', 'Carol'),
+                    ])
+            self.assertEqual(first.correspondent, 'alice@example.com')
+
+            def correspondents(operator, value):
+                return sorted(m.id for m in self.Mail.search([
+                            ('correspondent', operator, value),
+                            ]))
+            self.assertEqual(correspondents('=', 'ALICE@example.com'),
+                sorted([first.id, second.id]))
+            self.assertEqual(correspondents('=', 'carol@example.com'),
+                [first.id])
+            self.assertEqual(correspondents('in', ['dave@example.com',
+                        'nobody@example.com']), [second.id])
+            self.assertEqual(correspondents('ilike', '%carol%'), [first.id])
+
+            self.Mail.write([first], {'to': 'erin@example.com'})
+            self.assertEqual(correspondents('=', 'carol@example.com'), [])
+            self.assertEqual(correspondents('=', 'erin@example.com'),
+                [first.id])
+            copy, = self.Mail.copy([first])
+            self.assertEqual(len(copy.addresses), 3)
+
+            transaction.cursor.execute('DELETE FROM "' + Address._table
+                + '" WHERE mail = %s', (second.id,))
+            self.assertEqual(correspondents('=', 'dave@example.com'), [])
+            Address.update_mails(commit=False)
+            self.assertEqual(correspondents('=', 'dave@example.com'),
+                [second.id])
+
+            transaction.cursor.rollback()
+
+    def test0260_write_behind(self):
+        "The contents written behind are published before returning"
+        Content = POOL.get('electronic_mail.content')
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            storage = FileSystemStorage(transaction.cursor.dbname)
+            mailbox, = self.Mailbox.create([{
+                        'name': 'Write Behind',
+                        'user': USER,
+                        }])
+            CONFIG['email_write_behind'] = 2
+            try:
+                mails = self.Mail.create_from_emails(
+                    [MIMEText('Written behind %s' % i) for i in range(5)],
+                    mailbox.id)
+                self.Mail.write(mails[:1], {
+                        'email': MIMEText('Rewritten behind').as_string(),
+                        })
+            finally:
+                CONFIG['email_write_behind'] = 0
+            mails = self.Mail.browse([m.id for m in mails])
+            contents = Content.search([
+                    ('digest', 'in', [m.digest for m in mails]),
+                    ])
+            self.assertEqual(len(contents), len(mails))
+            for content in contents:
+                self.assertTrue(storage.exists(
+                        content_name(content.digest, content.codec)))
+            self.assertTrue('Rewritten behind' in mails[0]._get_email())
+            self.assertTrue('Written behind 4' in mails[4]._get_email())
+            directories = set(os.path.dirname(storage.path(
+                        content_name(c.digest, c.codec))) for c in contents)
+            for directory in directories:
+                self.assertFalse([n for n in os.listdir(directory)
+                        if '.tmp-' in n])
+
+            # The contents staged are discarded when aborted
+            writer = WriteBehind(storage, 2)
+            writer.set('write-behind-aborted', 'Aborted')
+            writer.abort()
+            self.assertFalse(storage.exists('write-behind-aborted'))
+            self.assertFalse([n for n in os.listdir(os.path.dirname(
+                            storage.path('write-behind-aborted')))
+                    if n.startswith('write-behind-aborted')])
+            writer.set('write-behind-joined', 'Joined')
+            writer.join()
+            self.assertEqual(storage.get('write-behind-joined'), 'Joined')
+            storage.delete('write-behind-joined')
+            # Concurrent writers of a name do not share a temporary file
+            first = storage.stage('write-behind-twice', 'Twice')
+            second = storage.stage('write-behind-twice', 'Twice')
+            self.assertNotEqual(first, second)
+            storage.discard(first)
+            storage.discard(second)
+
+            transaction.cursor.rollback()
+
+    def test0270_export_mbox(self):
+        "The mails changed after a cursor are streamed as mbox"
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            mailbox, = self.Mailbox.create([{
+                        'name': 'Export',
+                        'user': USER,
+                        }])
+            first = MIMEText('From the start\n>From a quote\n')
+            first['From'] = 'Alice <alice@example.com>'
+            first['Date'] = 'Tue, 01 Jan 2013 10:00:00 +0200'
+            second = MIMEText('Second')
+            first, second = self.Mail.create_from_emails([first, second],
+                mailbox.id)
+            domain = [('mailbox', '=', mailbox.id)]
+
+            mail_ids, cursor = self.Mail.get_changes(domain, limit=1)
+            self.assertEqual(mail_ids, [first.id])
+            mail_ids, cursor = self.Mail.get_changes(domain, cursor)
+            self.assertEqual(mail_ids, [second.id])
+            self.assertEqual(self.Mail.get_changes(domain, cursor),
+                ([], cursor))
+            self.Mail.set_flags(mailbox.id, str(first.uid), add=['seen'])
+            mail_ids, cursor = self.Mail.get_changes(domain, cursor)
+            self.assertEqual(mail_ids, [first.id])
+
+            # The changes committed after the cursor but dated before it
+            # are returned once
+            watermark = datetime.datetime.strptime(cursor.split('/')[0],
+                '%Y-%m-%dT%H:%M:%S.%f')
+            late = self.Mail.create([{
+                        'mailbox': mailbox.id,
+                        'subject': 'Late %s' % i,
+                        } for i in xrange(2)])
+            for mail, delta in zip(late, (60, 3600)):
+                transaction.cursor.execute('UPDATE "' + self.Mail._table
+                    + '" SET create_date = %s WHERE id = %s',
+                    (watermark - datetime.timedelta(seconds=delta), mail.id))
+            mail_ids, cursor = self.Mail.get_changes(domain, cursor)
+            self.assertEqual(mail_ids, [late[0].id])
+            self.assertEqual(self.Mail.get_changes(domain, cursor),
+                ([], cursor))
+            self.Mail.delete(late)
+            self.assertRaises(UserError, self.Mail.get_changes, domain,
+                'not a cursor')
+            self.assertRaises(UserError, self.Mail.get_changes, domain, 42)
+
+            directory = tempfile.mkdtemp()
+            try:
+                path = os.path.join(directory, 'export.mbox')
+                cursor = self.Mail.export_mbox(path, domain, batch_size=1)
+                self.assertEqual(self.Mail.export_mbox(path, domain, cursor),
+                    cursor)
+
+                with open(path, 'rb') as file_p:
+                    data = file_p.read()
+                # The mails are exported in the order of their changes
+                self.assertTrue(data.startswith('From MAILER-DAEMON '))
+                self.assertTrue('\n\nFrom alice@example.com '
+                    'Tue Jan  1 08:00:00 2013\n' in data)
+                # The email generator stored the first line quoted already
+                self.assertTrue('\n>>From the start\n>>From a quote\n'
+                    in data)
+                messages = [message_from_string(m)
+                    for m, _ in iter_mbox(path)]
+                self.assertEqual([m.get_payload() for m in messages], [
+                        'Second\n', '>From the start\n>From a quote\n'])
+
+                # The mails ending with a new line are imported back as
+                # they were stored
+                Import = POOL.get('electronic_mail.import')
+                copy, = self.Mailbox.create([{
+                            'name': 'Imported',
+                            'user': USER,
+                            }])
+                import_, = Import.create([{
+                            'path': path,
+                            'type_': 'mbox',
+                            'mailbox': copy.id,
+                            }])
+                import_._process(commit=False)
+                imported = self.Mail.search([('mailbox', '=', copy.id)],
+                    order=[('id', 'ASC')])
+                self.assertEqual(imported[1].digest, first.digest)
+                self.assertEqual(imported[1]._get_email(),
+                    first._get_email())
+
+                # An interrupted export resumes after the last batch saved
+                saved = []
+
+                def interrupt(cursor):
+                    saved.append(cursor)
+                    raise KeyboardInterrupt
+                resumed = os.path.join(directory, 'resumed.mbox')
+                self.assertRaises(KeyboardInterrupt, self.Mail.export_mbox,
+                    resumed, domain, batch_size=1, callback=interrupt)
+                self.assertEqual(self.Mail.export_mbox(resumed, domain,
+                        saved[-1], batch_size=1, callback=saved.append),
+                    cursor)
+                self.assertEqual(saved[-1], cursor)
+                with open(resumed, 'rb') as file_p:
+                    self.assertEqual(file_p.read(), data)
+            finally:
+                shutil.rmtree(directory)
+            self.assertEqual(''.join(self.Mail.iter_mbox([second],
+                        chunk_size=1)),
+                ''.join(self.Mail.iter_mbox([second])))
+
+            transaction.cursor.rollback()
+
 
 def suite():
     "Electronic mail test suite"